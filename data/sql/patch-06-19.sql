@@ -0,0 +1,17 @@
+-- Use GIN trigram indexes on the normalized columns used by the text
+-- searches (see QueryExecuter._parse_string_state), so searching for
+-- words contained in them doesn't need a sequential scan calling
+-- stoq_normalize_string for each row. GIN is a lot faster than GiST
+-- for those lookups, so replace the old sellable index.
+
+CREATE EXTENSION IF NOT EXISTS "pg_trgm";
+
+DROP INDEX IF EXISTS sellable_description_normalized_idx;
+CREATE INDEX sellable_description_normalized_idx ON sellable
+    USING gin (stoq_normalize_string(description) gin_trgm_ops);
+
+CREATE INDEX sellable_category_description_normalized_idx ON sellable_category
+    USING gin (stoq_normalize_string(description) gin_trgm_ops);
+
+CREATE INDEX person_name_normalized_idx ON person
+    USING gin (stoq_normalize_string(name) gin_trgm_ops);
@@ -0,0 +1,12 @@
+-- Index the columns used to find sellables by what the user typed or
+-- scanned (see Sellable.find_by_any_code). The lookups are case
+-- insensitive, so they need indexes on lower(), and the uniqueness
+-- checks (Sellable.check_barcode_exists/check_code_exists) compare the
+-- columns directly. storable_batch.batch_number is already UNIQUE.
+
+CREATE INDEX sellable_barcode_idx ON sellable (barcode);
+CREATE INDEX sellable_code_idx ON sellable (code);
+CREATE INDEX sellable_barcode_lower_idx ON sellable (lower(barcode));
+CREATE INDEX sellable_code_lower_idx ON sellable (lower(code));
+CREATE INDEX storable_batch_batch_number_lower_idx ON storable_batch
+    (lower(batch_number));
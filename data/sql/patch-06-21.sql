@@ -0,0 +1,116 @@
+-- Keep the stock of each storable summarized per branch, and on all the
+-- branches (with a NULL branch_id), so the stock views (see
+-- ProductFullStockView) don't need to aggregate product_stock_item on
+-- every search. product_stock_item is only changed by the
+-- upsert_stock_item trigger, so another trigger on it keeps the summary
+-- updated.
+
+CREATE TABLE storable_stock_summary (
+    id uuid PRIMARY KEY DEFAULT uuid_generate_v1(),
+    te_id bigint UNIQUE REFERENCES transaction_entry(id) DEFAULT new_te('storable_stock_summary'),
+    storable_id uuid NOT NULL REFERENCES storable(id)
+        ON UPDATE CASCADE ON DELETE CASCADE,
+    branch_id uuid REFERENCES branch(id)
+        ON UPDATE CASCADE ON DELETE CASCADE,
+    quantity numeric(20, 3) NOT NULL DEFAULT 0,
+    total_cost numeric(20, 8) NOT NULL DEFAULT 0,
+    UNIQUE (storable_id, branch_id)
+);
+CREATE RULE update_te AS ON UPDATE TO storable_stock_summary DO ALSO SELECT update_te(old.te_id, 'storable_stock_summary');
+
+-- UNIQUE doesn't consider NULLs, so the summary on all the branches
+-- needs an index of its own
+CREATE UNIQUE INDEX storable_stock_summary_all_branches_idx
+    ON storable_stock_summary (storable_id) WHERE branch_id IS NULL;
+
+INSERT INTO storable_stock_summary (storable_id, branch_id, quantity, total_cost)
+    SELECT storable_id, branch_id,
+           COALESCE(SUM(quantity), 0),
+           COALESCE(SUM(quantity * stock_cost), 0)
+    FROM product_stock_item
+    GROUP BY storable_id, branch_id;
+
+INSERT INTO storable_stock_summary (storable_id, branch_id, quantity, total_cost)
+    SELECT storable_id, NULL,
+           COALESCE(SUM(quantity), 0),
+           COALESCE(SUM(quantity * stock_cost), 0)
+    FROM product_stock_item
+    GROUP BY storable_id;
+
+-- Two transactions can try to create the same summary at the same time,
+-- so if the INSERT fails the row is updated again. ON CONFLICT can't be
+-- used since the table has an update_te rule.
+CREATE OR REPLACE FUNCTION add_to_storable_stock_summary(
+        storable_id_ uuid, branch_id_ uuid,
+        quantity_ numeric, total_cost_ numeric) RETURNS void AS $$
+BEGIN
+    LOOP
+        IF branch_id_ IS NULL THEN
+            UPDATE storable_stock_summary SET
+                    quantity = quantity + quantity_,
+                    total_cost = total_cost + total_cost_
+                WHERE storable_id = storable_id_ AND branch_id IS NULL;
+        ELSE
+            UPDATE storable_stock_summary SET
+                    quantity = quantity + quantity_,
+                    total_cost = total_cost + total_cost_
+                WHERE storable_id = storable_id_ AND branch_id = branch_id_;
+        END IF;
+
+        IF FOUND THEN
+            RETURN;
+        END IF;
+
+        BEGIN
+            INSERT INTO storable_stock_summary
+                    (storable_id, branch_id, quantity, total_cost)
+                VALUES
+                    (storable_id_, branch_id_, quantity_, total_cost_);
+            RETURN;
+        EXCEPTION WHEN unique_violation THEN
+            -- Created by another transaction, update it on the next loop
+        END;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION update_storable_stock_summary() RETURNS trigger AS $$
+BEGIN
+    IF (TG_OP = 'UPDATE' AND
+        NEW.storable_id = OLD.storable_id AND
+        NEW.branch_id = OLD.branch_id AND
+        NEW.quantity = OLD.quantity AND
+        NEW.stock_cost = OLD.stock_cost) THEN
+        RETURN NULL;
+    END IF;
+
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM add_to_storable_stock_summary(
+            OLD.storable_id, OLD.branch_id,
+            -COALESCE(OLD.quantity, 0),
+            -COALESCE(OLD.quantity * OLD.stock_cost, 0));
+        PERFORM add_to_storable_stock_summary(
+            OLD.storable_id, NULL,
+            -COALESCE(OLD.quantity, 0),
+            -COALESCE(OLD.quantity * OLD.stock_cost, 0));
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM add_to_storable_stock_summary(
+            NEW.storable_id, NEW.branch_id,
+            COALESCE(NEW.quantity, 0),
+            COALESCE(NEW.quantity * NEW.stock_cost, 0));
+        PERFORM add_to_storable_stock_summary(
+            NEW.storable_id, NULL,
+            COALESCE(NEW.quantity, 0),
+            COALESCE(NEW.quantity * NEW.stock_cost, 0));
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER update_storable_stock_summary_trigger
+    AFTER INSERT OR UPDATE OR DELETE ON product_stock_item
+    FOR EACH ROW
+    EXECUTE PROCEDURE update_storable_stock_summary();
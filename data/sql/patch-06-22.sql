@@ -0,0 +1,165 @@
+-- Keep the credit balances of each client (the payer of the payment
+-- groups) updated, so checking how much credit a client has left
+-- (see Client.credit_account_balance and Client.remaining_store_credit)
+-- doesn't need to go through all of their payments.
+--
+-- credit_balance is the paid value of the credit payments given to the
+-- client (out payments) minus the ones used by them (in payments).
+-- store_credit_debit is the value of the store credit payments the client
+-- still needs to pay (pending or confirmed in payments).
+
+CREATE TABLE client_credit_balance (
+    id uuid PRIMARY KEY DEFAULT uuid_generate_v1(),
+    te_id bigint UNIQUE REFERENCES transaction_entry(id) DEFAULT new_te('client_credit_balance'),
+    person_id uuid UNIQUE NOT NULL REFERENCES person(id)
+        ON UPDATE CASCADE ON DELETE CASCADE,
+    credit_balance numeric(20, 2) NOT NULL DEFAULT 0,
+    store_credit_debit numeric(20, 2) NOT NULL DEFAULT 0
+);
+CREATE RULE update_te AS ON UPDATE TO client_credit_balance DO ALSO SELECT update_te(old.te_id, 'client_credit_balance');
+
+-- Returns how much a payment adds to the credit_balance and to the
+-- store_credit_debit of its payer
+CREATE OR REPLACE FUNCTION payment_credit_values(
+        method_id_ uuid, payment_type_ payment_type, status_ payment_status,
+        value_ numeric, paid_value_ numeric,
+        OUT credit_balance_ numeric, OUT store_credit_debit_ numeric) AS $$
+DECLARE
+    method_name_ text;
+BEGIN
+    credit_balance_ := 0;
+    store_credit_debit_ := 0;
+    SELECT method_name INTO method_name_ FROM payment_method WHERE id = method_id_;
+
+    IF method_name_ = 'credit' AND status_ = 'paid' THEN
+        IF payment_type_ = 'out' THEN
+            credit_balance_ := COALESCE(paid_value_, 0);
+        ELSE
+            credit_balance_ := -COALESCE(paid_value_, 0);
+        END IF;
+    ELSIF (method_name_ = 'store_credit' AND payment_type_ = 'in' AND
+           status_ IN ('pending', 'confirmed')) THEN
+        store_credit_debit_ := COALESCE(value_, 0);
+    END IF;
+END;
+$$ LANGUAGE plpgsql STABLE;
+
+-- Two transactions can try to create the same balance at the same time,
+-- so if the INSERT fails the row is updated again. ON CONFLICT can't be
+-- used since the table has an update_te rule.
+CREATE OR REPLACE FUNCTION add_to_client_credit_balance(
+        person_id_ uuid, credit_balance_ numeric,
+        store_credit_debit_ numeric) RETURNS void AS $$
+BEGIN
+    IF person_id_ IS NULL OR (credit_balance_ = 0 AND store_credit_debit_ = 0) THEN
+        RETURN;
+    END IF;
+
+    LOOP
+        UPDATE client_credit_balance SET
+                credit_balance = credit_balance + credit_balance_,
+                store_credit_debit = store_credit_debit + store_credit_debit_
+            WHERE person_id = person_id_;
+
+        IF FOUND THEN
+            RETURN;
+        END IF;
+
+        BEGIN
+            INSERT INTO client_credit_balance
+                    (person_id, credit_balance, store_credit_debit)
+                VALUES
+                    (person_id_, credit_balance_, store_credit_debit_);
+            RETURN;
+        EXCEPTION WHEN unique_violation THEN
+            -- Created by another transaction, update it on the next loop
+        END;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+INSERT INTO client_credit_balance (person_id, credit_balance, store_credit_debit)
+    SELECT payment_group.payer_id,
+           SUM((values_).credit_balance_),
+           SUM((values_).store_credit_debit_)
+    FROM (SELECT group_id,
+                 payment_credit_values(method_id, payment_type, status,
+                                       value, paid_value) AS values_
+            FROM payment) AS payment
+    JOIN payment_group ON payment_group.id = payment.group_id
+    WHERE payment_group.payer_id IS NOT NULL
+    GROUP BY payment_group.payer_id
+    HAVING SUM((values_).credit_balance_) != 0 OR
+           SUM((values_).store_credit_debit_) != 0;
+
+CREATE OR REPLACE FUNCTION update_client_credit_balance() RETURNS trigger AS $$
+DECLARE
+    person_id_ uuid;
+    values_ record;
+BEGIN
+    IF (TG_OP = 'UPDATE' AND
+        NEW.group_id IS NOT DISTINCT FROM OLD.group_id AND
+        NEW.method_id IS NOT DISTINCT FROM OLD.method_id AND
+        NEW.payment_type = OLD.payment_type AND
+        NEW.status = OLD.status AND
+        NEW.value IS NOT DISTINCT FROM OLD.value AND
+        NEW.paid_value IS NOT DISTINCT FROM OLD.paid_value) THEN
+        RETURN NULL;
+    END IF;
+
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        SELECT payer_id INTO person_id_ FROM payment_group WHERE id = OLD.group_id;
+        SELECT * INTO values_ FROM payment_credit_values(
+            OLD.method_id, OLD.payment_type, OLD.status, OLD.value, OLD.paid_value);
+        PERFORM add_to_client_credit_balance(
+            person_id_, -values_.credit_balance_, -values_.store_credit_debit_);
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        SELECT payer_id INTO person_id_ FROM payment_group WHERE id = NEW.group_id;
+        SELECT * INTO values_ FROM payment_credit_values(
+            NEW.method_id, NEW.payment_type, NEW.status, NEW.value, NEW.paid_value);
+        PERFORM add_to_client_credit_balance(
+            person_id_, values_.credit_balance_, values_.store_credit_debit_);
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER update_client_credit_balance_trigger
+    AFTER INSERT OR UPDATE OR DELETE ON payment
+    FOR EACH ROW
+    EXECUTE PROCEDURE update_client_credit_balance();
+
+-- The payer of a group is usually set after its payments are created,
+-- so when it changes, the credits of the group payments move to the
+-- new payer
+CREATE OR REPLACE FUNCTION update_client_credit_balance_payer() RETURNS trigger AS $$
+DECLARE
+    values_ record;
+BEGIN
+    IF NEW.payer_id IS NOT DISTINCT FROM OLD.payer_id THEN
+        RETURN NULL;
+    END IF;
+
+    SELECT COALESCE(SUM((v).credit_balance_), 0) AS credit_balance_,
+           COALESCE(SUM((v).store_credit_debit_), 0) AS store_credit_debit_
+        INTO values_
+        FROM (SELECT payment_credit_values(method_id, payment_type, status,
+                                           value, paid_value) AS v
+                FROM payment WHERE group_id = NEW.id) AS payment;
+
+    PERFORM add_to_client_credit_balance(
+        OLD.payer_id, -values_.credit_balance_, -values_.store_credit_debit_);
+    PERFORM add_to_client_credit_balance(
+        NEW.payer_id, values_.credit_balance_, values_.store_credit_debit_);
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER update_client_credit_balance_payer_trigger
+    AFTER UPDATE ON payment_group
+    FOR EACH ROW
+    EXECUTE PROCEDURE update_client_credit_balance_payer();
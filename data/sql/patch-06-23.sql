@@ -0,0 +1,107 @@
+-- Keep the transaction values of each account summarized per month, so
+-- the account balances (see AccountView and
+-- Account.get_total_for_interval) only need to go through the
+-- transactions of the months that are not complete in the interval,
+-- instead of all the transactions of the account.
+--
+-- month is the beginning of the month, incoming is the value of the
+-- transactions to the account and outgoing is the value of the
+-- transactions from it.
+
+CREATE TABLE account_balance (
+    id uuid PRIMARY KEY DEFAULT uuid_generate_v1(),
+    te_id bigint UNIQUE REFERENCES transaction_entry(id) DEFAULT new_te('account_balance'),
+    account_id uuid NOT NULL REFERENCES account(id)
+        ON UPDATE CASCADE ON DELETE CASCADE,
+    month timestamp NOT NULL,
+    incoming numeric(20, 2) NOT NULL DEFAULT 0,
+    outgoing numeric(20, 2) NOT NULL DEFAULT 0,
+    UNIQUE (account_id, month)
+);
+CREATE RULE update_te AS ON UPDATE TO account_balance DO ALSO SELECT update_te(old.te_id, 'account_balance');
+
+-- The transactions of the partial months are searched by the account and
+-- a range of dates
+CREATE INDEX account_transaction_account_date_idx
+    ON account_transaction (account_id, date);
+CREATE INDEX account_transaction_source_account_date_idx
+    ON account_transaction (source_account_id, date);
+
+-- Two transactions can try to create the same balance at the same time,
+-- so if the INSERT fails the row is updated again. ON CONFLICT can't be
+-- used since the table has an update_te rule.
+CREATE OR REPLACE FUNCTION add_to_account_balance(
+        account_id_ uuid, date_ timestamp,
+        incoming_ numeric, outgoing_ numeric) RETURNS void AS $$
+DECLARE
+    month_ timestamp;
+BEGIN
+    IF incoming_ = 0 AND outgoing_ = 0 THEN
+        RETURN;
+    END IF;
+
+    month_ := date_trunc('month', date_);
+    LOOP
+        UPDATE account_balance SET
+                incoming = incoming + incoming_,
+                outgoing = outgoing + outgoing_
+            WHERE account_id = account_id_ AND month = month_;
+
+        IF FOUND THEN
+            RETURN;
+        END IF;
+
+        BEGIN
+            INSERT INTO account_balance (account_id, month, incoming, outgoing)
+                VALUES (account_id_, month_, incoming_, outgoing_);
+            RETURN;
+        EXCEPTION WHEN unique_violation THEN
+            -- Created by another transaction, update it on the next loop
+        END;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+INSERT INTO account_balance (account_id, month, incoming, outgoing)
+    SELECT account_id, month, SUM(incoming), SUM(outgoing)
+    FROM (SELECT account_id, date_trunc('month', date) AS month,
+                 COALESCE(value, 0) AS incoming, 0 AS outgoing
+            FROM account_transaction
+          UNION ALL
+          SELECT source_account_id, date_trunc('month', date),
+                 0, COALESCE(value, 0)
+            FROM account_transaction) AS account_transaction
+    GROUP BY account_id, month;
+
+CREATE OR REPLACE FUNCTION update_account_balance() RETURNS trigger AS $$
+BEGIN
+    IF (TG_OP = 'UPDATE' AND
+        NEW.account_id = OLD.account_id AND
+        NEW.source_account_id = OLD.source_account_id AND
+        NEW.date = OLD.date AND
+        NEW.value IS NOT DISTINCT FROM OLD.value) THEN
+        RETURN NULL;
+    END IF;
+
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM add_to_account_balance(
+            OLD.account_id, OLD.date, -COALESCE(OLD.value, 0), 0);
+        PERFORM add_to_account_balance(
+            OLD.source_account_id, OLD.date, 0, -COALESCE(OLD.value, 0));
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM add_to_account_balance(
+            NEW.account_id, NEW.date, COALESCE(NEW.value, 0), 0);
+        PERFORM add_to_account_balance(
+            NEW.source_account_id, NEW.date, 0, COALESCE(NEW.value, 0));
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER update_account_balance_trigger
+    AFTER INSERT OR UPDATE OR DELETE ON account_transaction
+    FOR EACH ROW
+    EXECUTE PROCEDURE update_account_balance();
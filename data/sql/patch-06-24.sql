@@ -0,0 +1,132 @@
+-- Keep the items of each work order summarized, so the work order views
+-- (see WorkOrderView) don't need to aggregate work_order_item on every
+-- search and checking the totals and the reservation state of a work
+-- order (see WorkOrder.get_total_amount and
+-- WorkOrder.is_items_totally_reserved) doesn't need to go through its
+-- items.
+--
+-- unreserved_items is the number of items of products that manage stock
+-- which were not totally decreased from the stock yet.
+
+CREATE TABLE work_order_summary (
+    id uuid PRIMARY KEY DEFAULT uuid_generate_v1(),
+    te_id bigint UNIQUE REFERENCES transaction_entry(id) DEFAULT new_te('work_order_summary'),
+    work_order_id uuid UNIQUE NOT NULL REFERENCES work_order(id)
+        ON UPDATE CASCADE ON DELETE CASCADE,
+    quantity numeric(20, 3) NOT NULL DEFAULT 0,
+    total numeric(20, 2) NOT NULL DEFAULT 0,
+    unreserved_items integer NOT NULL DEFAULT 0
+);
+CREATE RULE update_te AS ON UPDATE TO work_order_summary DO ALSO SELECT update_te(old.te_id, 'work_order_summary');
+
+-- The calendar searches the pending work orders by their estimated finish
+CREATE INDEX work_order_estimated_finish_idx ON work_order (estimated_finish);
+
+-- A work order has just a few items, so summarize all of them again
+-- instead of keeping track of what has changed
+CREATE OR REPLACE FUNCTION update_work_order_summary(
+        work_order_id_ uuid) RETURNS void AS $$
+DECLARE
+    summary_ record;
+BEGIN
+    IF work_order_id_ IS NULL THEN
+        RETURN;
+    END IF;
+
+    SELECT COALESCE(SUM(work_order_item.quantity), 0) AS quantity,
+           COALESCE(SUM(ROUND(work_order_item.quantity * work_order_item.price, 2)), 0) AS total,
+           COALESCE(SUM(CASE WHEN (product.manage_stock AND
+                                   work_order_item.quantity_decreased <> work_order_item.quantity)
+                        THEN 1 ELSE 0 END), 0) AS unreserved_items
+        INTO summary_
+        FROM work_order_item
+        LEFT JOIN product ON product.id = work_order_item.sellable_id
+        WHERE work_order_item.order_id = work_order_id_;
+
+    -- Two transactions can try to create the same summary at the same
+    -- time, so if the INSERT fails the row is updated again. ON CONFLICT
+    -- can't be used since the table has an update_te rule.
+    LOOP
+        UPDATE work_order_summary SET
+                quantity = summary_.quantity,
+                total = summary_.total,
+                unreserved_items = summary_.unreserved_items
+            WHERE work_order_id = work_order_id_;
+
+        IF FOUND THEN
+            RETURN;
+        END IF;
+
+        BEGIN
+            INSERT INTO work_order_summary
+                    (work_order_id, quantity, total, unreserved_items)
+                VALUES
+                    (work_order_id_, summary_.quantity, summary_.total,
+                     summary_.unreserved_items);
+            RETURN;
+        EXCEPTION WHEN unique_violation THEN
+            -- Created by another transaction, update it on the next loop
+        END;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT update_work_order_summary(id) FROM work_order;
+
+CREATE OR REPLACE FUNCTION update_work_order_summary_item() RETURNS trigger AS $$
+BEGIN
+    IF (TG_OP = 'UPDATE' AND
+        NEW.order_id IS NOT DISTINCT FROM OLD.order_id AND
+        NEW.sellable_id IS NOT DISTINCT FROM OLD.sellable_id AND
+        NEW.quantity IS NOT DISTINCT FROM OLD.quantity AND
+        NEW.quantity_decreased IS NOT DISTINCT FROM OLD.quantity_decreased AND
+        NEW.price IS NOT DISTINCT FROM OLD.price) THEN
+        RETURN NULL;
+    END IF;
+
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM update_work_order_summary(OLD.order_id);
+    END IF;
+
+    IF (TG_OP = 'INSERT' OR
+        (TG_OP = 'UPDATE' AND NEW.order_id IS DISTINCT FROM OLD.order_id)) THEN
+        PERFORM update_work_order_summary(NEW.order_id);
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER update_work_order_summary_item_trigger
+    AFTER INSERT OR UPDATE OR DELETE ON work_order_item
+    FOR EACH ROW
+    EXECUTE PROCEDURE update_work_order_summary_item();
+
+-- New work orders start with an empty summary
+CREATE OR REPLACE FUNCTION update_work_order_summary_order() RETURNS trigger AS $$
+BEGIN
+    PERFORM update_work_order_summary(NEW.id);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER update_work_order_summary_order_trigger
+    AFTER INSERT ON work_order
+    FOR EACH ROW
+    EXECUTE PROCEDURE update_work_order_summary_order();
+
+-- Only the items of products that manage stock need to be reserved
+CREATE OR REPLACE FUNCTION update_work_order_summary_product() RETURNS trigger AS $$
+BEGIN
+    PERFORM update_work_order_summary(order_id)
+        FROM (SELECT DISTINCT order_id FROM work_order_item
+                WHERE sellable_id = NEW.id) AS work_order_item;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER update_work_order_summary_product_trigger
+    AFTER UPDATE OF manage_stock ON product
+    FOR EACH ROW
+    WHEN (NEW.manage_stock IS DISTINCT FROM OLD.manage_stock)
+    EXECUTE PROCEDURE update_work_order_summary_product();
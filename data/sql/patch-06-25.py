@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+# The tables created after patch-06-04 still use new_te() and
+# update_te(old.te_id) without their names, so the listeners of the
+# new_te/update_te notifications don't know which table changed.
+# Apply the named default and rule to every table again.
+
+
+query = """
+ALTER TABLE {table} ALTER COLUMN te_id SET DEFAULT new_te('{table}');
+CREATE OR REPLACE RULE update_te AS ON UPDATE TO {table} DO ALSO SELECT
+  update_te(old.te_id, '{table}');
+"""
+
+tables_query = """
+SELECT DISTINCT
+    src_pg_class.relname AS srctable
+FROM pg_constraint
+JOIN pg_class AS src_pg_class
+    ON src_pg_class.oid = pg_constraint.conrelid
+JOIN pg_class AS ref_pg_class
+    ON ref_pg_class.oid = pg_constraint.confrelid
+JOIN pg_attribute AS src_pg_attribute
+    ON src_pg_class.oid = src_pg_attribute.attrelid
+JOIN pg_attribute AS ref_pg_attribute
+    ON ref_pg_class.oid = ref_pg_attribute.attrelid, generate_series(0,10) pos(n)
+WHERE
+    contype = 'f'
+    AND ref_pg_class.relname = 'transaction_entry'
+    AND ref_pg_attribute.attname = 'id'
+    AND src_pg_attribute.attnum = pg_constraint.conkey[n]
+    AND ref_pg_attribute.attnum = pg_constraint.confkey[n]
+    AND NOT src_pg_attribute.attisdropped
+    AND NOT ref_pg_attribute.attisdropped
+"""
+
+
+def apply_patch(store):
+    tables = store.execute(tables_query).get_all()
+
+    for (table,) in tables:
+        store.execute(query.format(table=table))
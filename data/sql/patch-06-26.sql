@@ -0,0 +1,31 @@
+-- Notify when the rows of the tables in the reference cache (the domain
+-- classes with is_reference_data set) get deleted, so the other
+-- processes can drop them from their caches. Only updates and inserts
+-- are notified by the update_te rule and new_te.
+
+CREATE OR REPLACE FUNCTION notify_delete_te() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('delete_te',
+                      COALESCE(OLD.te_id, 0)::text || ',' || TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER notify_delete_te_trigger
+    AFTER DELETE ON branch
+    FOR EACH ROW EXECUTE PROCEDURE notify_delete_te();
+CREATE TRIGGER notify_delete_te_trigger
+    AFTER DELETE ON branch_station
+    FOR EACH ROW EXECUTE PROCEDURE notify_delete_te();
+CREATE TRIGGER notify_delete_te_trigger
+    AFTER DELETE ON cfop_data
+    FOR EACH ROW EXECUTE PROCEDURE notify_delete_te();
+CREATE TRIGGER notify_delete_te_trigger
+    AFTER DELETE ON payment_method
+    FOR EACH ROW EXECUTE PROCEDURE notify_delete_te();
+CREATE TRIGGER notify_delete_te_trigger
+    AFTER DELETE ON sellable_tax_constant
+    FOR EACH ROW EXECUTE PROCEDURE notify_delete_te();
+CREATE TRIGGER notify_delete_te_trigger
+    AFTER DELETE ON sellable_unit
+    FOR EACH ROW EXECUTE PROCEDURE notify_delete_te();
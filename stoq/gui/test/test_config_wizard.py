@@ -48,6 +48,7 @@ class TestFirstTimeConfigWizard(GUITest):
     def create_wizard(self):
         options = mock.Mock()
         options.sqldebug = False
+        options.sqlprofile = False
         options.verbose = False
 
         if self.settings is None:
@@ -53,6 +53,11 @@ def get_option_parser():
     group.add_option('', '--sql',
                      action="store_true",
                      dest="sqldebug")
+    group.add_option('', '--sql-profile',
+                     action="store_true",
+                     dest="sqlprofile",
+                     help='Profile the sql statements and report the slow '
+                          'ones on exit or on SIGUSR1')
     group.add_option('', '--debug',
                      action="store_true",
                      dest="debug")
@@ -32,6 +32,7 @@ import sys
 from kiwi.component import provide_utility
 from stoqlib.database.migration import StoqlibSchemaMigration
 from stoqlib.database.debug import enable as enable_debugging
+from stoqlib.database.debug import enable_profiling
 from stoqlib.database.runtime import (get_default_store,
                                       set_current_branch_station)
 from stoqlib.exceptions import DatabaseError
@@ -112,6 +113,8 @@ def setup(config=None, options=None, register_station=True, check_schema=True,
 
     if options and options.sqldebug:
         enable_debugging()
+    if options and options.sqlprofile:
+        enable_profiling()
 
     from stoq.lib.applist import ApplicationDescriptions
     provide_utility(IApplicationDescriptions, ApplicationDescriptions(),
@@ -21,13 +21,20 @@
 ## Author(s): Stoq Team <stoq-devel@async.com.br>
 ##
 
+import atexit
+import collections
 import datetime
 import os
+import re
+import signal
 import sys
 import platform
 import struct
+import threading
+import time
 
 import psycopg2
+import psycopg2.extensions
 
 from storm.tracer import BaseStatementTracer, install_tracer
 
@@ -256,5 +263,225 @@ class StoqlibDebugTracer(BaseStatementTracer):
         self.header(pid, color, 'CLOSE')
 
 
+_NUMBER_RE = re.compile(r'\b\d+(\.\d+)?\b')
+_STRING_RE = re.compile(r"'(''|[^'])*'")
+_IN_LIST_RE = re.compile(r'\bIN\s*\((\s*(%s|\?)\s*,?)+\)', re.IGNORECASE)
+_SPACES_RE = re.compile(r'\s+')
+# SELECTs that would repeat their side effects (e.g. locking rows or
+# consuming sequences) if they were executed again by EXPLAIN ANALYZE
+_SIDE_EFFECTS_RE = re.compile(
+    r'\bFOR\s+(NO\s+KEY\s+)?(UPDATE|SHARE)\b|\bFOR\s+KEY\s+SHARE\b|'
+    r'\b(nextval|setval|new_te|update_te|pg_notify|pg_advisory_\w+)\s*\(',
+    re.IGNORECASE)
+
+
+def get_statement_fingerprint(statement):
+    """Normalizes a statement so that the same query with different
+    literals or number of IN items will be considered the same
+
+    :param statement: a sql statement
+    :returns: the normalized statement
+    """
+    statement = _STRING_RE.sub('?', statement)
+    statement = _NUMBER_RE.sub('?', statement)
+    statement = _IN_LIST_RE.sub('IN (...)', statement)
+    return _SPACES_RE.sub(' ', statement).strip()
+
+
+class _StatementStats(object):
+
+    # Histogram bucket limits, in seconds
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, float('inf'))
+
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.histogram = [0] * len(self.BUCKETS)
+        self.plan = None
+        self.plan_duration = 0
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+        for i, limit in enumerate(self.BUCKETS):
+            if duration <= limit:
+                self.histogram[i] += 1
+                break
+
+    def get_percentile(self, percentile):
+        """Get the upper limit of the bucket where percentile is"""
+        needed = self.count * percentile / 100.0
+        seen = 0
+        for limit, count in zip(self.BUCKETS, self.histogram):
+            seen += count
+            if seen >= needed:
+                return min(limit, self.max)
+        return self.max
+
+
+class StoqlibProfileTracer(BaseStatementTracer):
+    """A tracer that records how long the statements take
+
+    Unlike :class:`StoqlibDebugTracer`, this will not print anything
+    for each statement, so it is suitable to be used in production.
+    The statements are aggregated by their fingerprint (see
+    :func:`get_statement_fingerprint`) and a report ranked by the
+    total time spent on each of them can be written with
+    :meth:`.write_report`.
+
+    SELECTs slower than *threshold* will also have their plan captured
+    by running ``EXPLAIN (ANALYZE, BUFFERS)`` on them (the slowest one
+    of each fingerprint is kept). Other statements are not explained
+    since analyzing them would execute them again. Note that analyzing
+    also executes the SELECT again, so SELECTs that lock rows or call
+    functions with side effects only get a plain ``EXPLAIN``. The plan
+    is captured inside a savepoint, so a failure doesn't abort the
+    transaction that executed the statement.
+    """
+
+    def __init__(self, threshold=0.5, stream=None):
+        """
+        :param threshold: the duration, in seconds, after which a statement
+          is considered slow and its plan is captured, or ``None`` to
+          not capture any plans
+        :param stream: the stream to write the report to, sys.stderr
+          by default
+        """
+        self.threshold = threshold
+        if stream is None:
+            stream = sys.stderr
+        self._stream = stream
+        self._lock = threading.Lock()
+        # Mapping fingerprint -> _StatementStats
+        self._stats = collections.OrderedDict()
+        # Mapping cursor id -> the time it started executing
+        self._start_times = {}
+
+    def connection_raw_execute(self, connection, raw_cursor, statement,
+                               params):
+        self._start_times[id(raw_cursor)] = time.time()
+
+    def connection_raw_execute_error(self, connection, raw_cursor, statement,
+                                     params, error):
+        self._start_times.pop(id(raw_cursor), None)
+
+    def connection_raw_execute_success(self, connection, raw_cursor,
+                                       statement, params):
+        start_time = self._start_times.pop(id(raw_cursor), None)
+        if start_time is None:
+            return
+        duration = time.time() - start_time
+
+        fingerprint = get_statement_fingerprint(statement)
+        with self._lock:
+            stats = self._stats.get(fingerprint)
+            if stats is None:
+                stats = self._stats[fingerprint] = _StatementStats(fingerprint)
+            stats.add(duration)
+            explain = (self.threshold is not None and
+                       duration >= self.threshold and
+                       duration > stats.plan_duration and
+                       statement.lstrip().upper().startswith('SELECT'))
+
+        if explain:
+            plan = self._explain(connection, raw_cursor, statement, params)
+            with self._lock:
+                stats.plan = plan
+                stats.plan_duration = duration
+
+    def _explain(self, connection, raw_cursor, statement, params):
+        conn = raw_cursor.connection
+        # The plan is captured on the same transaction that executed the
+        # statement, so it can see the same data
+        if (conn.get_transaction_status() !=
+                psycopg2.extensions.TRANSACTION_STATUS_INTRANS):
+            return None
+
+        if _SIDE_EFFECTS_RE.search(statement):
+            explain = 'EXPLAIN '
+        else:
+            explain = 'EXPLAIN (ANALYZE, BUFFERS) '
+
+        cursor = conn.cursor()
+        try:
+            cursor.execute('SAVEPOINT stoq_profile_explain')
+            try:
+                cursor.execute(explain + statement,
+                               tuple(connection.to_database(params)))
+                plan = '\n'.join(row[0] for row in cursor.fetchall())
+            except psycopg2.Error as e:
+                plan = 'Could not explain the statement: %s' % (e, )
+            # Also undo anything the analyzed statement may have done
+            cursor.execute('ROLLBACK TO SAVEPOINT stoq_profile_explain')
+            cursor.execute('RELEASE SAVEPOINT stoq_profile_explain')
+            return plan
+        except psycopg2.Error as e:
+            return 'Could not explain the statement: %s' % (e, )
+        finally:
+            cursor.close()
+
+    def get_stats(self):
+        """Get the statistics ordered by the total time spent
+
+        :returns: a list of statistics, one for each fingerprint
+        """
+        with self._lock:
+            stats = list(self._stats.values())
+        return sorted(stats, key=lambda s: s.total, reverse=True)
+
+    def reset(self):
+        """Forget all the statistics recorded until now"""
+        with self._lock:
+            self._stats.clear()
+
+    def write_report(self, limit=30):
+        """Writes a report of the statements that took most time
+
+        :param limit: the maximum number of statements in the report
+        """
+        stats = self.get_stats()
+        lines = ['=' * 79,
+                 'SQL profile: %d statements, %d distinct, %.3f seconds' % (
+                     sum(s.count for s in stats), len(stats),
+                     sum(s.total for s in stats)),
+                 '=' * 79]
+        for i, s in enumerate(stats[:limit], 1):
+            lines.append(
+                '#%d total: %.3fs | count: %d | avg: %.4fs | p50: %.4fs | '
+                'p95: %.4fs | max: %.4fs' % (
+                    i, s.total, s.count, s.total / s.count,
+                    s.get_percentile(50), s.get_percentile(95), s.max))
+            lines.append(s.fingerprint)
+            if s.plan is not None:
+                lines.append('Plan (%.3fs):' % (s.plan_duration, ))
+                lines.append(s.plan)
+            lines.append('-' * 79)
+
+        self._stream.write('\n'.join(lines) + '\n')
+        self._stream.flush()
+
+
 def enable():
     install_tracer(StoqlibDebugTracer())
+
+
+def enable_profiling(threshold=0.5, stream=None):
+    """Enables the sql profiling
+
+    A report will be written when the process exits and also
+    every time it receives a SIGUSR1 signal (where available).
+
+    :param threshold: see :class:`StoqlibProfileTracer`
+    :param stream: see :class:`StoqlibProfileTracer`
+    :returns: the installed :class:`StoqlibProfileTracer`
+    """
+    tracer = StoqlibProfileTracer(threshold=threshold, stream=stream)
+    install_tracer(tracer)
+    atexit.register(tracer.write_report)
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1,
+                      lambda signum, frame: tracer.write_report())
+    return tracer
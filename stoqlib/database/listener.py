@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2016 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU Lesser General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+
+"""Listen to the changes notified by the database"""
+
+import logging
+import threading
+
+import psycopg2
+import psycopg2.extensions
+
+from stoqlib.database.settings import db_settings
+
+log = logging.getLogger(__name__)
+
+
+class DatabaseListener(object):
+    """Dispatches the notifications about changed rows
+
+    The ``new_te`` and ``update_te`` database functions notify the channel
+    of the same name every time a row of a domain table gets created or
+    updated, with ``"<te_id>,<table_name>"`` as the payload. The deletion
+    of the rows of the reference data tables is notified on ``delete_te``
+    with the same payload. Note that the
+    notifications are only sent when the transaction gets committed.
+
+    This listens to them on a connection of its own. Every notification
+    that arrived is dispatched to the subscribed callbacks when
+    :meth:`.poll` is called, so the callbacks will run on the thread
+    that called it.
+    """
+
+    _SINGLETON = None
+
+    #: The channels we listen to
+    CHANNELS = ['new_te', 'update_te', 'delete_te']
+
+    def __init__(self):
+        self._conn = None
+        self._failed = False
+        self._callbacks = []
+        self._lock = threading.RLock()
+
+    @classmethod
+    def get_instance(cls):
+        if cls._SINGLETON is None:
+            cls._SINGLETON = cls()
+        return cls._SINGLETON
+
+    #
+    #  Public API
+    #
+
+    def subscribe(self, callback):
+        """Subscribe to the notifications
+
+        :param callback: a callable that will receive the channel,
+            the te_id and the table name of each notification
+        """
+        with self._lock:
+            self._callbacks.append(callback)
+
+    def poll(self):
+        """Dispatch the notifications that arrived since the last poll
+
+        :returns: ``True`` if we are listening to the notifications,
+            ``False`` if that failed and some of them could have been lost
+        """
+        with self._lock:
+            if self._failed:
+                return False
+
+            try:
+                if self._conn is None:
+                    self._conn = self._listen()
+                self._conn.poll()
+            except psycopg2.Error as e:
+                log.warning("Could not listen to the database "
+                            "notifications: %s" % (e, ))
+                self._failed = True
+                return False
+
+            notifies = self._conn.notifies
+            while notifies:
+                notify = notifies.pop(0)
+                te_id, _, table_name = notify.payload.partition(',')
+                for callback in self._callbacks:
+                    callback(notify.channel, int(te_id), table_name)
+
+            return True
+
+    #
+    #  Private
+    #
+
+    def _listen(self):
+        conn = psycopg2.connect(db_settings.get_store_dsn())
+        conn.set_isolation_level(
+            psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        cursor = conn.cursor()
+        for channel in self.CHANNELS:
+            cursor.execute("LISTEN %s;" % (channel, ))
+        cursor.close()
+        return conn
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2016 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU Lesser General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+
+"""Queries compiled once and prepared on the database server"""
+
+import inspect
+import itertools
+import os
+import re
+import weakref
+
+from storm.exceptions import NotOneError
+from storm.expr import Select, State
+from storm.info import get_cls_info
+from storm.variables import Variable
+
+#: used to give unique names to the prepared statements
+_statement_counter = itertools.count()
+
+#: the statements already prepared on each storm connection, as
+#: a tuple of (raw_connection, set of statement names)
+_prepared = weakref.WeakKeyDictionary()
+
+
+class _Placeholder(Variable):
+    """A parameter of a :class:`PreparedQuery`, filled on execution"""
+
+    __slots__ = ('index', )
+
+    def __init__(self, index):
+        Variable.__init__(self)
+        self.index = index
+
+
+class PreparedQuery(object):
+    """A query on a domain class which is compiled only once
+
+    The query is defined by a function returning the clause of the query.
+    It will be called a single time, with placeholders for the arguments
+    that will be given when executing it::
+
+        by_barcode = PreparedQuery(
+            Sellable, lambda barcode: Sellable.barcode == barcode)
+        sellable = by_barcode.one(store, u'123')
+
+    The compiled statement is also ``PREPARE``d on each connection that
+    executes it, so postgres will not need to parse and plan it again.
+    That can be disabled by setting the ``STOQ_PREPARED_STATEMENTS``
+    environment variable to ``0`` (e.g. when using a connection pooler
+    that does not keep the sessions).
+
+    Note that the arguments are not converted by the columns they are
+    compared to, so pass them as the database expects (e.g. ``obj.id``
+    instead of ``obj``). Also, a ``None`` argument will be compared using
+    ``=``, so it will never match anything.
+    """
+
+    use_prepared_statements = os.environ.get(
+        'STOQ_PREPARED_STATEMENTS', '1') != '0'
+
+    def __init__(self, cls, clause_factory):
+        self.cls = cls
+        self._clause_factory = clause_factory
+        self._name = 'stoqlib_prepared_%d' % (next(_statement_counter), )
+        self._statement = None
+        self._parameters = None
+
+    #
+    #  Public API
+    #
+
+    def find(self, store, *args):
+        """Execute the query
+
+        :param store: a store
+        :param args: the arguments of the query
+        :returns: a list of the objects found
+        """
+        if store._implicit_flush_block_count == 0:
+            store.flush()
+
+        connection = store._connection
+        if self._statement is None:
+            self._compile(connection)
+
+        params = []
+        for param in self._parameters:
+            if isinstance(param, _Placeholder):
+                param = Variable(args[param.index])
+            params.append(param)
+
+        if self.use_prepared_statements:
+            self._prepare(connection)
+            statement = 'EXECUTE %s' % (self._name, )
+            if params:
+                statement += ' (%s)' % (', '.join('?' * len(params)), )
+        else:
+            statement = self._statement
+
+        result = connection.execute(statement, params)
+        cls_info = get_cls_info(self.cls)
+        return [store._load_object(cls_info, result, values)
+                for values in result]
+
+    def one(self, store, *args):
+        """Execute the query and return a single object
+
+        :param store: a store
+        :param args: the arguments of the query
+        :returns: the object found or ``None``
+        :raises: :exc:`storm.exceptions.NotOneError` if more than one
+            object was found
+        """
+        objs = self.find(store, *args)
+        if len(objs) > 1:
+            raise NotOneError("one() used with more than one result available")
+        return objs[0] if objs else None
+
+    #
+    #  Private
+    #
+
+    def _compile(self, connection):
+        n_args = len(inspect.signature(self._clause_factory).parameters)
+        clause = self._clause_factory(
+            *[_Placeholder(i) for i in range(n_args)])
+        cls_info = get_cls_info(self.cls)
+        select = Select(cls_info.columns, clause,
+                        default_tables=cls_info.table)
+
+        state = State()
+        self._statement = connection.compile(select, state)
+        self._parameters = state.parameters
+
+    def _prepare(self, connection):
+        connection._ensure_connected()
+        raw_connection, names = _prepared.get(connection, (None, None))
+        if raw_connection is not connection._raw_connection:
+            # Prepared statements only live as long as the database
+            # session, and storm may have reconnected since the last time
+            names = set()
+            _prepared[connection] = (connection._raw_connection, names)
+        if self._name in names:
+            return
+
+        # Replace storm's "?" marks with postgres' positional "$n"
+        counter = itertools.count(1)
+        tokens = self._statement.split("'")
+        for i in range(0, len(tokens), 2):
+            tokens[i] = re.sub(r'\?', lambda m: '$%d' % next(counter),
+                               tokens[i])
+        connection.execute('PREPARE %s AS %s' % (self._name, "'".join(tokens)),
+                           noresult=True)
+        names.add(self._name)
@@ -24,6 +24,7 @@
 Kiwi integration for Stoq/Storm
 """
 
+import os
 import re
 import threading
 import queue
@@ -33,7 +34,8 @@ from kiwi.python import Settable
 from kiwi.utils import gsignal
 from storm import Undef
 from storm.database import Connection, convert_param_marks
-from storm.expr import compile, And, Or, Like, Not, Alias, State, Lower
+from storm.expr import (compile, And, Or, Like, Not, Alias, State, Lower,
+                        Column, Desc)
 from storm.tracer import trace
 import psycopg2
 import psycopg2.extensions
@@ -207,7 +209,8 @@ class AsyncQueryOperation(GObject.GObject):
         """
         :param store: database store
         :param resultset: resultset that will be used to construct
-           the result from.
+           the result from, or ``None`` to get the raw result (e.g. when
+           executing an aggregate)
         :param expr: query expression to execute
         """
         GObject.GObject.__init__(self)
@@ -221,6 +224,10 @@ class AsyncQueryOperation(GObject.GObject):
         self._async_conn = None
         self._statement = None
         self._parameters = None
+        # Protects the status transitions between the executer thread and
+        # the thread calling cancel(), so that we never send a cancel request
+        # to a connection that is already running another operation
+        self._lock = threading.Lock()
 
     #
     #  Public API
@@ -229,17 +236,18 @@ class AsyncQueryOperation(GObject.GObject):
     def execute(self, async_conn):
         """Executes a query within an asyncronous psycopg2 connection
         """
-        if self.status == self.STATUS_CANCELLED:
-            return
+        with self._lock:
+            if self.status == self.STATUS_CANCELLED:
+                return
 
-        self.status = self.STATUS_EXECUTING
+            self.status = self.STATUS_EXECUTING
+            self._async_conn = async_conn
 
         # Async variant of Connection.execute() in storm/database.py
         state = State()
         statement = compile(self.expr, state)
         stmt = convert_param_marks(statement, "?", "%s")
         self._async_cursor = async_conn.cursor()
-        self._async_conn = async_conn
 
         # This is postgres specific, see storm/databases/postgres.py
         self._statement = stmt
@@ -247,15 +255,25 @@ class AsyncQueryOperation(GObject.GObject):
 
         trace("connection_raw_execute", self._conn,
               self._async_cursor, self._statement, self._parameters)
-        self._async_cursor.execute(self._statement,
-                                   self._parameters)
-
-        # This can happen if another thread cancelled this while the cursor was
-        # executing. In that case, it is not interested in the retval anymore
-        if self.status == self.STATUS_CANCELLED:
+        try:
+            self._async_cursor.execute(self._statement,
+                                       self._parameters)
+        except psycopg2.extensions.QueryCanceledError:
+            # cancel() interrupted the query on the server. The transaction
+            # is aborted now, rollback so the connection can be reused
+            async_conn.rollback()
             return
 
-        self.status = self.STATUS_FINISHED
+        with self._lock:
+            # This can happen if another thread cancelled this while the
+            # cursor was executing. In that case, it is not interested in
+            # the retval anymore
+            if self.status == self.STATUS_CANCELLED:
+                return
+
+            self.status = self.STATUS_FINISHED
+            self._async_conn = None
+
         GLib.idle_add(self._on_finish)
 
     def get_result(self):
@@ -273,11 +291,26 @@ class AsyncQueryOperation(GObject.GObject):
 
         result = self._conn.result_factory(self._conn,
                                            self._async_cursor)
+        if self.resultset is None:
+            return result
         return AsyncResultSet(self.resultset, result)
 
     def cancel(self):
-        """Cancel the operation scheduling"""
-        self.status = self.STATUS_CANCELLED
+        """Cancel the operation
+
+        If the operation is still waiting to be executed, it will
+        just be skipped by the executer. If it is already executing,
+        the query will be interrupted on the server, so it doesn't keep
+        using database time for a result nobody is interested in anymore.
+        """
+        with self._lock:
+            status = self.status
+            self.status = self.STATUS_CANCELLED
+            if status == self.STATUS_EXECUTING:
+                # This is the same as pg_cancel_backend() for the backend
+                # serving this connection, without needing another one
+                self._async_conn.cancel()
+            self._async_conn = None
 
     #
     #  Private
@@ -293,33 +326,86 @@ GObject.type_register(AsyncQueryOperation)
 
 
 class _OperationExecuter(threading.Thread):
+    """A worker thread executing operations from a
+    :class:`_OperationExecuterPool` using its own connection
+    """
 
-    _SINGLETON = None
-
-    def __init__(self):
+    def __init__(self, pool):
         super(_OperationExecuter, self).__init__()
 
+        self.daemon = True
+        self._pool = pool
         self._conn = psycopg2.connect(db_settings.get_store_dsn())
+
+    def run(self):
+        while True:
+            operation = self._pool._get_operation()
+            try:
+                operation.execute(self._conn)
+            finally:
+                self._pool._operation_done()
+
+
+class _OperationExecuterPool(object):
+    """A bounded pool of :class:`_OperationExecuter`
+
+    Each executer holds a psycopg2 connection of its own, so a slow
+    operation will not block the others scheduled after it.
+    Executers are created lazily, when all the existing ones are busy,
+    up to :attr:`.size` of them.
+
+    The size can be configured by the ``STOQ_ASYNC_SEARCH_CONNECTIONS``
+    environment variable.
+    """
+
+    _SINGLETON = None
+
+    #: The default maximum number of executers (and thus connections)
+    DEFAULT_SIZE = 3
+
+    def __init__(self, size=None):
+        if size is None:
+            size = int(os.environ.get('STOQ_ASYNC_SEARCH_CONNECTIONS',
+                                      self.DEFAULT_SIZE))
+        assert size > 0
+
+        self.size = size
+        self._executers = []
+        self._busy = 0
+        self._lock = threading.Lock()
         self._queue = queue.Queue()
 
     @classmethod
     def get_instance(cls):
         if cls._SINGLETON is None:
             cls._SINGLETON = cls()
-            cls._SINGLETON.daemon = True
-            cls._SINGLETON.start()
         return cls._SINGLETON
 
-    def run(self):
-        while True:
-            operation = self._queue.get()
-            operation.execute(self._conn)
-            self._queue.task_done()
-
     def schedule(self, operation):
         assert isinstance(operation, AsyncQueryOperation)
+        with self._lock:
+            if (len(self._executers) - self._busy <= self._queue.qsize() and
+                    len(self._executers) < self.size):
+                executer = _OperationExecuter(self)
+                executer.start()
+                self._executers.append(executer)
         self._queue.put(operation)
 
+    #
+    #  Private
+    #
+
+    def _get_operation(self):
+        operation = self._queue.get()
+        with self._lock:
+            self._busy += 1
+        return operation
+
+    def _operation_done(self):
+        with self._lock:
+            self._busy -= 1
+        self._queue.task_done()
+
 
 class QueryExecuter(object):
     """
@@ -328,8 +414,12 @@ class QueryExecuter(object):
     The query is constructed using storm.
 
     :cvar default_search_limit: The default search limit.
+    :cvar default_page_size: The default number of items returned
+      by :meth:`.get_next_page`
     """
 
+    default_page_size = 100
+
     def __init__(self, store=None):
         self._columns = {}
         self._limit = -1
@@ -340,7 +430,8 @@ class QueryExecuter(object):
         self._filter_query_callbacks = {}
         self._query = self._default_query
         self.post_result = None
-        self._operation_executer = _OperationExecuter.get_instance()
+        self.estimate_post_result = False
+        self._operation_executer = _OperationExecuterPool.get_instance()
 
     # Public API
 
@@ -374,8 +465,10 @@ class QueryExecuter(object):
     def search_async(self, states=None, resultset=None, limit=None):
         """
         Execute a search asynchronously.
-        This uses a separate psycopg2 connection which is lazily
-        created just before executing the first async query.
+        This uses a pool of separate psycopg2 connections which are lazily
+        created just before executing async queries, so a slow query
+        will not block the other ones. Cancelling the returned operation
+        will interrupt its query on the server if it is already executing.
         This method returns an operation for which a signal **finish** is
         emitted when the query has finished executing. In that callback,
         :meth:`.AsyncQueryOperation.finish` should be called, eg:
@@ -495,19 +588,60 @@ class QueryExecuter(object):
 
         self._query = callback
 
+    def set_estimate_post_result(self, estimate):
+        """Sets if the post result should be estimated
+
+        When estimating, the search will use :meth:`.get_estimated_post_result`
+        to get the count immediately and :meth:`.get_post_result_async`
+        to get the exact post result, instead of waiting for
+        :meth:`.get_post_result` to compute it.
+
+        :param estimate: ``True`` if the post result should be estimated
+        """
+        self.estimate_post_result = estimate
+
     def get_post_result(self, result):
-        descs, query = self.search_spec.post_search_callback(result)
-        # This should not be present in the query, since post_search_callback
-        # should only use aggregate functions.
-        query.order_by = Undef
-        query.group_by = Undef
-        store = self.store
-        values = store.execute(query).get_one()
-        assert len(descs) == len(values), (descs, values)
-        data = {}
-        for desc, value in zip(descs, list(values)):
-            data[desc] = value
-        return Settable(**data)
+        descs, query = self._get_post_query(result)
+        values = self.store.execute(query).get_one()
+        return self._build_post_result(descs, values)
+
+    def get_estimated_post_result(self, result):
+        """Get an estimate of the post result
+
+        The count will be the number of rows the database planner estimates
+        the result will have, which is a lot cheaper than counting them.
+        All the other values (e.g. the sum) will be ``None``.
+
+        :param result: the result to estimate the post result for
+        :returns: a Settable, like the one returned by
+          :meth:`.get_post_result`
+        """
+        descs, query = self._get_post_query(result)
+        values = [None] * len(descs)
+        if 'count' in descs:
+            values[descs.index('count')] = self._estimate_count(result)
+        return self._build_post_result(descs, values)
+
+    def get_post_result_async(self, result, callback):
+        """Get the post result asynchronously
+
+        This works like :meth:`.search_async`, so note that the query will
+        be done in another connection and will not see uncommitted changes.
+
+        :param result: the result to get the post result for
+        :param callback: a callable that will be called with the post
+          result (a Settable, like the one returned by
+          :meth:`.get_post_result`) when it is ready
+        :returns: the :class:`AsyncQueryOperation`, which can be cancelled
+          if the post result is not needed anymore
+        """
+        descs, query = self._get_post_query(result)
+        operation = AsyncQueryOperation(self.store, None, query)
+        operation.connect(
+            'finish', lambda op: callback(
+                self._build_post_result(descs, op.get_result().get_one())))
+        self._operation_executer.schedule(operation)
+        return operation
 
     def get_ordered_result(self, result, attribute):
         if issubclass(self.search_spec, Viewable):
@@ -519,8 +653,124 @@ class QueryExecuter(object):
 
         return result.order_by(attribute)
 
+    def supports_keyset_pagination(self, attribute):
+        """Checks if results ordered by attribute can be paginated by keyset
+
+        That is, the attribute is a column of the search spec (and not
+        an aggregate or another expression) and the search spec has an id.
+
+        :param attribute: the name of the attribute the results are
+          ordered by
+        """
+        return self._get_keyset_columns(attribute) is not None
+
+    def get_keyset_ordered_result(self, result, attribute, descending=False):
+        """Order the result by attribute and then by id
+
+        The id makes the order deterministic, which is needed to paginate
+        the results with :meth:`.get_next_page`
+
+        :param result: the result to order
+        :param attribute: the name of the attribute to order by
+        :param descending: if the order should be descending
+        """
+        column, id_column = self._get_keyset_columns(attribute)
+        if descending:
+            return result.order_by(Desc(column), Desc(id_column))
+        return result.order_by(column, id_column)
+
+    def get_next_page(self, result, attribute, last_item=None,
+                      descending=False, page_size=None):
+        """Get the next page of a result using keyset pagination
+
+        Instead of using an OFFSET (which forces the database to go through
+        all the rows before it), the page is fetched by filtering the rows
+        that come after *last_item* in the order, so the cost of fetching
+        a page doesn't depend on how deep it is in the results.
+
+        Note that the result will be ordered as done by
+        :meth:`.get_keyset_ordered_result`
+
+        :param result: the result to paginate
+        :param attribute: the name of the attribute to order by. It
+          must be one that :meth:`.supports_keyset_pagination`
+        :param last_item: the last item of the previous page or
+          ``None`` to get the first page
+        :param descending: if the order should be descending
+        :param page_size: the maximum number of items to return, or
+          ``None`` to use :attr:`.default_page_size`
+        :returns: a list with the items of the page
+        """
+        if last_item is not None:
+            column, id_column = self._get_keyset_columns(attribute)
+            result = result.find(self._get_keyset_query(
+                [(column, getattr(last_item, attribute)),
+                 (id_column, last_item.id)], descending))
+
+        result = self.get_keyset_ordered_result(result, attribute, descending)
+        return list(result.config(limit=page_size or self.default_page_size))
+
     # Private API
 
+    def _get_post_query(self, result):
+        descs, query = self.search_spec.post_search_callback(result)
+        # This should not be present in the query, since post_search_callback
+        # should only use aggregate functions.
+        query.order_by = Undef
+        query.group_by = Undef
+        return descs, query
+
+    def _build_post_result(self, descs, values):
+        assert len(descs) == len(values), (descs, values)
+        data = {}
+        for desc, value in zip(descs, list(values)):
+            data[desc] = value
+        return Settable(**data)
+
+    def _estimate_count(self, result):
+        connection = self.store._connection
+        state = State()
+        statement = connection.compile(result._get_select(), state)
+        # The first line of the plan is the top node, which includes
+        # the number of rows estimated for the whole query, eg:
+        # Sort  (cost=123.10..124.35 rows=500 width=132)
+        plan = self.store.execute('EXPLAIN ' + statement,
+                                  state.parameters).get_one()[0]
+        match = re.search(r'rows=(\d+)', plan)
+        return int(match.group(1)) if match else 0
+
+    def _get_keyset_columns(self, attribute):
+        if self.search_spec is None or not isinstance(attribute, str):
+            return None
+
+        column = getattr(self.search_spec, attribute, None)
+        if isinstance(column, Alias):
+            column = column.expr
+        id_column = getattr(self.search_spec, 'id', None)
+        if not isinstance(column, Column) or not isinstance(id_column, Column):
+            return None
+        return column, id_column
+
+    def _get_keyset_query(self, keys, descending):
+        # Builds the query for the rows after the given (column, value) keys,
+        # eg. (a > 1) OR (a = 1 AND b > 2) OR (a = 1 AND b = 2 AND c > 3).
+        # Note that postgres orders NULLs as larger than any other value
+        # (NULLS LAST when ascending, NULLS FIRST when descending).
+        queries = []
+        for i, (column, value) in enumerate(keys):
+            if descending and value is None:
+                after = column != None
+            elif descending:
+                after = column < value
+            elif value is None:
+                # There's nothing after NULL when ascending
+                continue
+            else:
+                after = Or(column > value, column == None)
+            equals = [c == v for c, v in keys[:i]]
+            queries.append(And(*(equals + [after])))
+        return Or(*queries)
+
     def _default_query(self, store):
         return store.find(self.search_spec)
 
@@ -639,9 +889,14 @@ class QueryExecuter(object):
             return
 
         def _like(value):
+            # Both sides are normalized (and thus lowercased), so there's
+            # no need to use ILIKE. Note that it is important for the
+            # left side to be exactly stoq_normalize_string(column), since
+            # that is what is indexed by the trigram indexes (see
+            # patch-06-19.sql), and for the right side to be a constant
             return Like(StoqNormalizeString(table_field),
                         StoqNormalizeString(u'%%%s%%' % value.lower()),
-                        case_sensitive=False)
+                        case_sensitive=True)
 
         if state.mode == StringQueryState.CONTAINS_ALL:
             queries = [_like(word) for word in re.split('[ \n\r]', state.text) if word]
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2016 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU Lesser General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+
+"""A process-wide cache for rarely changing domain objects"""
+
+import os
+import threading
+
+from stoqlib.database.listener import DatabaseListener
+
+
+class ReferenceCache(object):
+    """A cache of rows shared between all the stores of the process
+
+    Domain classes with ``is_reference_data`` set (e.g. payment methods,
+    sellable units and branches) are cached here when
+    :meth:`StoqlibStore.get <stoqlib.database.runtime.StoqlibStore.get>`
+    fetches them, so short-lived stores don't need to query them again.
+
+    The database notifies ``update_te`` every time a row gets updated
+    (see the ``update_te`` rule of the domain tables) and ``delete_te``
+    every time a row of a reference data table gets deleted (see
+    ``notify_delete_te``, which needs to be set for the tables of new
+    reference data classes). The cached rows of the table are dropped
+    when the :class:`DatabaseListener
+    <stoqlib.database.listener.DatabaseListener>` dispatches them.
+
+    The cache can be disabled by setting the ``STOQ_REFERENCE_CACHE``
+    environment variable to ``0``.
+    """
+
+    _SINGLETON = None
+
+    def __init__(self, enabled=None):
+        if enabled is None:
+            enabled = os.environ.get('STOQ_REFERENCE_CACHE', '1') != '0'
+
+        self.enabled = enabled
+        self._rows = {}
+        self._lock = threading.Lock()
+        DatabaseListener.get_instance().subscribe(self._on_notification)
+
+    @classmethod
+    def get_instance(cls):
+        if cls._SINGLETON is None:
+            cls._SINGLETON = cls()
+        return cls._SINGLETON
+
+    #
+    #  Public API
+    #
+
+    def get_values(self, cls, primary_values):
+        """Get the cached values of a row
+
+        :param cls: the domain class
+        :param primary_values: a tuple with the primary key values of the row
+        :returns: the row values as returned by the database or
+            ``None`` if they are not cached
+        """
+        if not self._poll():
+            return None
+
+        with self._lock:
+            return self._rows.get(cls.__storm_table__, {}).get(
+                (cls, primary_values))
+
+    def set_values(self, cls, primary_values, values):
+        """Cache the values of a row
+
+        :param cls: the domain class
+        :param primary_values: a tuple with the primary key values of the row
+        :param values: the row values as returned by the database
+        """
+        if not self.enabled:
+            return
+
+        with self._lock:
+            table = self._rows.setdefault(cls.__storm_table__, {})
+            table[(cls, primary_values)] = values
+
+    def invalidate(self, cls=None):
+        """Drop cached rows
+
+        :param cls: the domain class to drop the rows or ``None``
+            to drop all of them
+        """
+        with self._lock:
+            if cls is None:
+                self._rows.clear()
+            else:
+                self._rows.pop(cls.__storm_table__, None)
+
+    #
+    #  Private
+    #
+
+    def _poll(self):
+        # Process the notifications that arrived since the last time
+        # we were called. Returns if the cache can be used
+        if not self.enabled:
+            return False
+
+        if not DatabaseListener.get_instance().poll():
+            # Without the notifications, we can't know when the cached
+            # rows get outdated.
+            self.enabled = False
+            self.invalidate()
+            return False
+
+        return True
+
+    #
+    #  Callbacks
+    #
+
+    def _on_notification(self, channel, te_id, table_name):
+        if channel not in ['update_te', 'delete_te']:
+            return
+
+        with self._lock:
+            if table_name:
+                self._rows.pop(table_name, None)
+            else:
+                self._rows.clear()
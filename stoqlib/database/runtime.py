@@ -24,18 +24,27 @@
 """ Runtime routines for applications"""
 
 from collections import namedtuple
+import contextlib
+import itertools
 import logging
+import operator
+import re
 import sys
+import uuid
 import warnings
 import weakref
 import os
 
 from kiwi.component import get_utility, provide_utility
 from storm import Undef
-from storm.expr import SQL, Avg
-from storm.info import get_obj_info
+from storm.database import convert_param_marks
+from storm.exceptions import OrderLoopError
+from storm.cache import GenerationalCache
+from storm.expr import SQL, Avg, Insert, Select, State, compare_columns
+from storm.info import get_cls_info, get_obj_info
 from storm.store import Store, ResultSet, PENDING_REMOVE, PENDING_ADD
 from storm.tracer import trace
+from storm.variables import Variable
 
 from stoqlib.database.exceptions import InterfaceError, OperationalError
 from stoqlib.database.interfaces import (
@@ -43,7 +52,8 @@ from stoqlib.database.interfaces import (
     ICurrentBranchStation, ICurrentUser)
 from stoqlib.database.expr import is_sql_identifier
 from stoqlib.database.orm import ORMObject
-from stoqlib.database.properties import Identifier
+from stoqlib.database.properties import UUIDVariable
+from stoqlib.database.refcache import ReferenceCache
 from stoqlib.database.settings import db_settings
 from stoqlib.database.viewable import Viewable
 from stoqlib.exceptions import DatabaseError, LoginError
@@ -63,6 +73,19 @@ _default_store = None
 #: should not be used by anything except autoreload_object()
 _stores = weakref.WeakSet()
 
+#: used to give unique names to the server side cursors
+_cursor_counter = itertools.count()
+
+#: the size of the storm cache of each store, which keeps strong references
+#: to the last used objects. Can be changed by the STOQ_STORE_CACHE_SIZE
+#: environment variable
+STORE_CACHE_SIZE = int(os.environ.get('STOQ_STORE_CACHE_SIZE', 5000))
+
+#: the raw statements that don't change any row
+_READ_ONLY_RE = re.compile(
+    r'^\s*(SELECT|SHOW|SET|SAVEPOINT|RELEASE|ROLLBACK|EXPLAIN)\b',
+    re.IGNORECASE)
+
 
 def autoreload_object(obj, obj_store=False):
     """Autoreload object in any other existing store.
@@ -117,19 +140,7 @@ class StoqlibResultSet(ResultSet):
         """Converts the result of this result set into an instance of the
         configured viewable.
         """
-        instance = self._viewable()
-        # This will be removed later
-        instance._store = self._store
-        identifiers = []
-        for attr, value in zip(self._viewable.cls_attributes, values):
-            if isinstance(value, Identifier):
-                identifiers.append(value)
-            setattr(instance, attr, value)
-        branch = getattr(instance, 'branch', None)
-        if branch:
-            for i in identifiers:
-                i.prefix = branch.acronym or ''
-        return instance
+        return self._viewable.load_values(self._store, values)
 
     def _load_objects(self, result, values):
         # Overwrite the default _load_objects so we can convert the results to
@@ -176,7 +187,17 @@ class StoqlibResultSet(ResultSet):
         else:
             return objects[0]
 
-    def fast_iter(self):
+    def fast_iter(self, itersize=None):
+        """Iterate over the results bypassing storm object creation
+
+        Each result will be a namedtuple (or a tuple of them, depending on
+        how the query was done) instead of a domain object.
+
+        :param itersize: if not ``None``, the results will be streamed from
+          a server side cursor, fetching *itersize* rows at a time instead of
+          loading all of them in memory at once. Use this when iterating over
+          a really large number of rows (e.g. when exporting them).
+        """
         # First build all named tuples
         named_tuples = []
         for is_expr, info in self._find_spec._cls_spec_info:
@@ -186,14 +207,46 @@ class StoqlibResultSet(ResultSet):
                 named_tuples.append(namedtuple(info.cls.__name__,
                                                [i.name for i in info.columns]))
 
+        if itersize is None:
+            results = self._store._connection.execute(self._get_select())
+        else:
+            results = self._stream_results(itersize)
+
         is_viewable = hasattr(self, '_viewable')
         # Then interate over the results bypassing storm object creation
-        for values in self._store._connection.execute(self._get_select()):
+        for values in results:
             value = self._load_fast_object(named_tuples, values)
             if is_viewable:
                 value = self._load_viewable(value)
             yield value
 
+    def _stream_results(self, itersize):
+        # A variant of storm's Connection.execute() using a named cursor,
+        # so postgres will keep the results on the server side and we will
+        # fetch itersize rows of them at a time. Note that named cursors
+        # only live inside the transaction they were created in.
+        connection = self._store._connection
+        connection._ensure_connected()
+
+        state = State()
+        statement = connection.compile(self._get_select(), state)
+        statement = convert_param_marks(statement, "?", connection.param_mark)
+        params = tuple(connection.to_database(state.parameters))
+
+        cursor = connection._raw_connection.cursor(
+            name='stoqlib_fast_iter_%d' % (next(_cursor_counter), ))
+        cursor.itersize = itersize
+        try:
+            trace('connection_raw_execute', connection, cursor,
+                  statement, params)
+            cursor.execute(statement, params)
+            trace('connection_raw_execute_success', connection, cursor,
+                  statement, params)
+            for values in cursor:
+                yield connection.result_factory.from_database(values)
+        finally:
+            cursor.close()
+
 
 class StoqlibStore(Store):
     """The Stoqlib Store.
@@ -229,6 +282,10 @@ class StoqlibStore(Store):
 
     _result_set_factory = StoqlibResultSet
 
+    #: the maximum number of rows inserted by a single statement
+    #: when flushing inside :meth:`.bulk_flush`
+    bulk_insert_size = 500
+
     def __init__(self, database=None, cache=None):
         """
         Creates a new store
@@ -237,15 +294,22 @@ class StoqlibStore(Store):
         :param cache: storm cache to use or ``None``
         """
         self._committing = False
+        # The classes of the objects changed in this transaction
+        self._dirty_classes = set()
+        # If rows were changed by raw statements in this transaction
+        self._has_raw_writes = False
         self._savepoints = []
         # When using savepoints, this stack will hold what objects were changed
         # (created, deleted or edited) inside that savepoint.
         self._dirties = [[]]
+        self._bulk_flush_count = 0
         self.retval = True
         self.obsolete = False
 
         if database is None:
             database = get_default_store().get_database()
+        if cache is None:
+            cache = GenerationalCache(STORE_CACHE_SIZE)
         Store.__init__(self, database=database, cache=cache)
         _stores.add(self)
         trace('transaction_create', self)
@@ -263,8 +327,62 @@ class StoqlibStore(Store):
         # Store calls _set_dirty when any object inside it gets modified.
         # We use this to count if any change happened inside the actual savepoint
         self._dirties[-1].append((obj_info, obj_info.get("pending")))
+        self._dirty_classes.add(obj_info.cls_info.cls)
         super(StoqlibStore, self)._set_dirty(obj_info)
 
+    def execute(self, statement, params=None, noresult=False):
+        # We can't know which rows a raw statement changes, so after one
+        # the rows of this transaction can't be shared with other stores
+        if isinstance(statement, str):
+            is_read_only = bool(_READ_ONLY_RE.match(statement))
+        else:
+            is_read_only = isinstance(statement, Select)
+        if not is_read_only:
+            self._has_raw_writes = True
+        return super(StoqlibStore, self).execute(statement, params=params,
+                                                 noresult=noresult)
+
+    def get(self, cls, key):
+        # Overwrite the default get method so we can use the reference
+        # cache for the classes that support it. This is the same as
+        # storm's Store.get, but the row values may come from the cache
+        if not self._can_use_reference_cache(cls):
+            return super(StoqlibStore, self).get(cls, key)
+
+        if self._implicit_flush_block_count == 0:
+            self.flush()
+
+        if type(key) != tuple:
+            key = (key, )
+
+        cls_info = get_cls_info(cls)
+        primary_vars = []
+        for column, variable in zip(cls_info.primary_key, key):
+            if not isinstance(variable, Variable):
+                variable = column.variable_factory(value=variable)
+            primary_vars.append(variable)
+
+        primary_values = tuple(var.get(to_db=True) for var in primary_vars)
+        obj_info = self._alive.get((cls_info.cls, primary_values))
+        if obj_info is not None and not obj_info.get("invalidated"):
+            return self._get_object(obj_info)
+
+        cache = ReferenceCache.get_instance()
+        values = cache.get_values(cls_info.cls, primary_values)
+        if values is None:
+            select = Select(cls_info.columns,
+                            compare_columns(cls_info.primary_key, primary_vars),
+                            default_tables=cls_info.table, limit=1)
+            values = self._connection.execute(select).get_one()
+            if values is None:
+                return None
+            cache.set_values(cls_info.cls, primary_values, values)
+
+        # The values are already converted from the database, and
+        # set_variable is all that _load_object needs from the result
+        return self._load_object(cls_info, self._connection.result_factory,
+                                 values)
+
     def find(self, cls_spec, *args, **kwargs):
         # Overwrite the default find method so we can support querying our own
         # viewables. If the cls_spec is a Viewable, we first get the real
@@ -434,6 +552,32 @@ class StoqlibStore(Store):
         """
         return sum(len(i) for i in self._dirties)
 
+    def has_changes(self, cls):
+        """Check if objects of a class were changed in this transaction
+
+        :param cls: a domain class
+        :returns: ``True`` if objects of *cls* were created, modified or
+          removed since the last commit or rollback
+        """
+        return cls in self._dirty_classes
+
+    def autoreload_changed(self, cls, ids):
+        """Reload objects of a class that were changed directly on the database
+
+        The objects of *cls* with one of the *ids* that are alive in this
+        store will be reloaded the next time they are used, and *cls* will
+        be considered changed in this transaction (see :meth:`.has_changes`).
+
+        :param cls: a domain class
+        :param ids: the ids of the changed objects
+        """
+        self._dirty_classes.add(cls)
+        for id_ in ids:
+            obj_info = self._alive.get((cls, (id_, )))
+            obj = obj_info and obj_info.get_obj()
+            if obj is not None:
+                self.autoreload(obj)
+
     @public(since="1.5.0")
     def commit(self, close=False):
         """Commits a database.
@@ -455,8 +599,19 @@ class StoqlibStore(Store):
         super(StoqlibStore, self).commit()
         trace('transaction_commit', self)
 
+        # The notifications from the database may take a while to arrive,
+        # and other stores can use the cache before that
+        cache = ReferenceCache.get_instance()
+        if self._has_raw_writes:
+            cache.invalidate()
+        for cls in self._dirty_classes:
+            if getattr(cls, 'is_reference_data', False):
+                cache.invalidate(cls)
+
         self._savepoints = []
         self._dirties = [[]]
+        self._dirty_classes = set()
+        self._has_raw_writes = False
 
         # Reload objects on all other opened stores
         for obj in touched_objs:
@@ -475,7 +630,10 @@ class StoqlibStore(Store):
         will execute the sql on the transaction, but only will be
         commited when :meth:`.commit` is called.
         """
-        super(StoqlibStore, self).flush()
+        if self._bulk_flush_count:
+            self._flush_bulk()
+        else:
+            super(StoqlibStore, self).flush()
 
         # We only call 'before-commited' when flush is being called by commit
         if not self._committing:
@@ -500,6 +658,31 @@ class StoqlibStore(Store):
         if self._dirty:
             self.flush()
 
+    @contextlib.contextmanager
+    def bulk_flush(self):
+        """Group the inserts done by the flushes inside this context
+
+        Objects of the same table created one after another will be inserted
+        using a single ``INSERT ... VALUES (...), (...) RETURNING`` statement
+        instead of one statement for each of them. The pending changes are
+        flushed when leaving the context. Use this when creating a lot of
+        objects at once, like the items of a big sale or purchase::
+
+            with store.bulk_flush():
+                for product in products:
+                    SaleItem(store=store, sale=sale, sellable=product.sellable)
+
+        Note that an insert will never be moved across an update or a delete,
+        and the order defined by :meth:`.add_flush_order` is respected.
+        """
+        self._bulk_flush_count += 1
+        try:
+            yield self
+            if self._bulk_flush_count == 1:
+                self.flush()
+        finally:
+            self._bulk_flush_count -= 1
+
     @public(since="1.5.0")
     def rollback(self, name=None, close=True):
         """Rollback the transaction
@@ -518,6 +701,8 @@ class StoqlibStore(Store):
             # If we rollback completely, we need to clear all savepoints
             self._savepoints = []
             self._dirties = [[]]
+            self._dirty_classes = set()
+            self._has_raw_writes = False
 
         # Rolling back resets the application name.
         self._setup_application_name()
@@ -615,6 +800,9 @@ class StoqlibStore(Store):
         # Make sure to autorelad the original values after the rollback
         for obj_info in self._cache.get_cached():
             self.autoreload(obj_info.get_obj())
+            # Let the objects know that, like Store.rollback does, so they
+            # can drop anything they calculated from the old values
+            self._run_hook(obj_info, "__storm_invalidated__")
 
     def savepoint_exists(self, name):
         """Checks if the given savepoint's name exists
@@ -667,6 +855,135 @@ class StoqlibStore(Store):
         self.execute("SET application_name = '%s - %s - %s'" % (
             (appname.lower(), get_hostname(), os.getpid())))
 
+    def _can_use_reference_cache(self, cls):
+        if not getattr(cls, 'is_reference_data', False):
+            return False
+        # The cache only knows about the default database
+        if (_default_store is None or
+                self.get_database() is not _default_store.get_database()):
+            return False
+        # The rows could have uncommitted changes in this transaction,
+        # and those can't be shared with the other stores
+        return not self._has_raw_writes and not self.has_changes(cls)
+
+    def _flush_bulk(self):
+        # This is the same as storm's Store.flush, but objects of the same
+        # class waiting to be inserted are grouped and flushed together
+        self._event.emit("flush")
+
+        flushing = {}
+        while self._dirty:
+            (obj_info, obj) = self._dirty.popitem()
+            if obj_info not in flushing:
+                flushing[obj_info] = obj
+                self._run_hook(obj_info, "__storm_pre_flush__")
+        self._dirty = flushing
+
+        predecessors = {}
+        for (before_info, after_info), n in self._order.items():
+            if n > 0:
+                predecessors.setdefault(after_info, set()).add(before_info)
+
+        def is_ready(obj_info):
+            return not any(before_info in self._dirty
+                           for before_info in predecessors.get(obj_info, ()))
+
+        key_func = operator.itemgetter("sequence")
+        while self._dirty:
+            sorted_dirty = sorted(self._dirty, key=key_func)
+            while sorted_dirty:
+                for i, obj_info in enumerate(sorted_dirty):
+                    if is_ready(obj_info):
+                        break
+                else:
+                    raise OrderLoopError("Can't flush due to ordering loop")
+
+                if obj_info.get("pending") is not PENDING_ADD:
+                    del sorted_dirty[i]
+                    self._dirty.pop(obj_info, None)
+                    self._flush_one(obj_info)
+                    continue
+
+                batch = self._get_insert_batch(sorted_dirty, i, is_ready)
+                for batch_info, changes in batch:
+                    self._dirty.pop(batch_info, None)
+                batched = set(batch_info for batch_info, changes in batch)
+                sorted_dirty = [o for o in sorted_dirty if o not in batched]
+                self._flush_inserts(batch)
+
+        self._order.clear()
+        self._sequence = 0
+
+    def _get_insert_batch(self, sorted_dirty, start, is_ready):
+        # Collect the objects that can be inserted together with the one
+        # at sorted_dirty[start]. They need to be of the same class and to
+        # define the same columns. Other inserts can be skipped, but not
+        # updates and deletes since the database may depend on their order
+        # (e.g. unique constraints and triggers)
+        obj_info = sorted_dirty[start]
+        cls_info = obj_info.cls_info
+        changes = self._get_insert_changes(obj_info)
+        columns = set(changes)
+        batch = [(obj_info, changes)]
+        if not self._has_primary_key(obj_info):
+            # The database generates the key (e.g. a serial), and
+            # storm needs to get it back after each insert
+            return batch
+
+        for other_info in sorted_dirty[start + 1:]:
+            if len(batch) >= self.bulk_insert_size:
+                break
+            if other_info.get("pending") is not PENDING_ADD:
+                break
+            if other_info.cls_info is not cls_info or not is_ready(other_info):
+                continue
+            other_changes = self._get_insert_changes(other_info)
+            if (set(other_changes) == columns and
+                    self._has_primary_key(other_info)):
+                batch.append((other_info, other_changes))
+        return batch
+
+    def _get_insert_changes(self, obj_info):
+        cls_info = obj_info.cls_info
+        # Give a chance to the backend to process primary variables.
+        self._connection.preset_primary_key(cls_info.primary_key,
+                                            obj_info.primary_vars)
+        # Generate the uuids here instead of letting the database do it,
+        # so the objects inserted together already know their ids
+        for variable in obj_info.primary_vars:
+            if isinstance(variable, UUIDVariable) and not variable.is_defined():
+                variable.set(uuid.uuid1(), from_db=True)
+        return self._get_changes_map(obj_info, True)
+
+    def _has_primary_key(self, obj_info):
+        return all(variable.is_defined()
+                   for variable in obj_info.primary_vars)
+
+    def _flush_inserts(self, batch):
+        if len(batch) == 1:
+            self._flush_one(batch[0][0])
+            return
+
+        cls_info = batch[0][0].cls_info
+        columns = list(batch[0][1])
+        values = []
+        for obj_info, changes in batch:
+            obj_info.pop("pending", None)
+            values.append(tuple(changes[column] for column in columns))
+
+        # The primary keys were already set by _get_insert_changes
+        self._connection.execute(Insert(columns, cls_info.table, values=values),
+                                 noresult=True)
+
+        for obj_info, changes in batch:
+            # The same as storm's Store._flush_one does after an insert
+            obj_info.pop("invalidated", None)
+            self._fill_missing_values(obj_info, obj_info.primary_vars)
+            self._enable_change_notification(obj_info)
+            self._add_to_alive(obj_info)
+            self._run_hook(obj_info, "__storm_flushed__")
+            obj_info.event.emit("flushed")
+
     def _check_obsolete(self):
         if self.obsolete:
             raise InterfaceError("This transaction has already been closed")
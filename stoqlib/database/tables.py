@@ -48,6 +48,7 @@ _tables = [
     ('system', ["SystemTable", "TransactionEntry"]),
     ('parameter', ["ParameterData"]),
     ('account', ['Account',
+                 'AccountBalance',
                  'AccountTransaction',
                  'BankAccount',
                  'BillOption']),
@@ -64,6 +65,7 @@ _tables = [
                 "Individual",
                 "Company",
                 "Client",
+                "ClientCreditBalance",
                 "Supplier",
                 "Employee",
                 "Branch",
@@ -121,7 +123,8 @@ _tables = [
                  "ProductAttribute",
                  "ProductOptionMap",
                  "Storable",
-                 'StorableBatch']),
+                 'StorableBatch',
+                 'StorableStockSummary']),
     ('purchase', ["PurchaseOrder",
                   "Quotation",
                   "PurchaseItem",
@@ -166,7 +169,8 @@ _tables = [
                    'WorkOrderCategory',
                    'WorkOrderPackage',
                    'WorkOrderPackageItem',
-                   'WorkOrderHistory']),
+                   'WorkOrderHistory',
+                   'WorkOrderSummary']),
     ('event', ['Event']),
     ('certificate', ['Certificate']),
     ('message', ['Message']),
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2013 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU Lesser General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+
+import io
+
+from storm.tracer import install_tracer, remove_tracer
+
+from stoqlib.database.debug import (StoqlibProfileTracer,
+                                    get_statement_fingerprint)
+from stoqlib.domain.person import Person
+from stoqlib.domain.test.domaintest import DomainTest
+
+
+class StoqlibProfileTracerTest(DomainTest):
+
+    def setUp(self):
+        DomainTest.setUp(self)
+        self.stream = io.StringIO()
+        self.tracer = StoqlibProfileTracer(threshold=0, stream=self.stream)
+        install_tracer(self.tracer)
+
+    def tearDown(self):
+        remove_tracer(self.tracer)
+        DomainTest.tearDown(self)
+
+    def test_get_statement_fingerprint(self):
+        self.assertEqual(
+            get_statement_fingerprint(
+                u"SELECT a FROM t\n  WHERE x = 12 AND y IN (%s, %s) "
+                u"AND z = 'it''s' LIMIT 10"),
+            u"SELECT a FROM t WHERE x = ? AND y IN (...) AND z = ? LIMIT ?")
+
+    def test_stats(self):
+        for name in [u'foo', u'bar', u'baz']:
+            list(self.store.find(Person, name=name))
+
+        stats = [s for s in self.tracer.get_stats()
+                 if s.fingerprint.startswith(u'SELECT person.')]
+        self.assertEqual(len(stats), 1)
+        self.assertEqual(stats[0].count, 3)
+        self.assertEqual(sum(stats[0].histogram), 3)
+        self.assertIn(u'Execution', stats[0].plan)
+
+        self.tracer.write_report()
+        self.assertIn(stats[0].fingerprint, self.stream.getvalue())
+
+        self.tracer.reset()
+        self.assertEqual(self.tracer.get_stats(), [])
+
+    def test_plan_without_analyze(self):
+        self.store.execute(u"SELECT id FROM person FOR UPDATE").get_all()
+
+        stats = [s for s in self.tracer.get_stats()
+                 if s.fingerprint.endswith(u'FOR UPDATE')]
+        self.assertEqual(len(stats), 1)
+        self.assertIn(u'LockRows', stats[0].plan)
+        self.assertNotIn(u'Execution', stats[0].plan)
+
+    def test_plan_error(self):
+        # Failing to explain a statement must not abort the transaction
+        list(self.store.find(Person, name=u'foo'))
+        raw_connection = self.store._connection._raw_connection
+        plan = self.tracer._explain(self.store._connection,
+                                    raw_connection.cursor(),
+                                    u"SELECT * FROM invalid_table", [])
+        self.assertIn(u'Could not explain the statement', plan)
+        list(self.store.find(Person, name=u'foo'))
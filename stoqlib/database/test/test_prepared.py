@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2016 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU Lesser General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+
+import mock
+from storm.exceptions import NotOneError
+from storm.expr import And, Lower
+
+from stoqlib.database.prepared import PreparedQuery
+from stoqlib.domain.sellable import Sellable
+from stoqlib.domain.test.domaintest import DomainTest
+
+
+class PreparedQueryTest(DomainTest):
+
+    def test_find(self):
+        sellable = self.create_sellable()
+        sellable.barcode = u'PrePared123'
+        sellable.status = Sellable.STATUS_AVAILABLE
+
+        query = PreparedQuery(
+            Sellable, lambda barcode: And(
+                Sellable.status == Sellable.STATUS_AVAILABLE,
+                Lower(Sellable.barcode) == barcode))
+
+        execute = mock.Mock(wraps=self.store._connection.execute)
+        with mock.patch.object(self.store._connection, 'execute', execute):
+            # The object was not flushed yet, find should flush it
+            self.assertEqual(query.one(self.store, u'prepared123'), sellable)
+            self.assertEqual(query.find(self.store, u'prepared123'), [sellable])
+            self.assertIsNone(query.one(self.store, u'prepared'))
+
+        statements = [args[0] for args, kwargs in execute.call_args_list
+                      if isinstance(args[0], str)]
+        prepares = [s for s in statements if s.startswith('PREPARE ')]
+        self.assertEqual(len(prepares), 1)
+        self.assertIn('$1', prepares[0])
+        self.assertEqual(len([s for s in statements
+                              if s.startswith('EXECUTE ')]), 3)
+
+    def test_one(self):
+        for i in range(2):
+            sellable = self.create_sellable()
+            sellable.barcode = u'Duplicated'
+
+        query = PreparedQuery(
+            Sellable, lambda barcode: Sellable.barcode == barcode)
+        with self.assertRaises(NotOneError):
+            query.one(self.store, u'Duplicated')
+
+    def test_without_prepared_statements(self):
+        sellable = self.create_sellable()
+        sellable.code = u'prepared code'
+
+        query = PreparedQuery(Sellable, lambda code: Sellable.code == code)
+        with mock.patch.object(PreparedQuery, 'use_prepared_statements', False):
+            self.assertEqual(query.one(self.store, u'prepared code'), sellable)
@@ -27,8 +27,10 @@ import mock
 
 from stoqlib.domain.test.domaintest import DomainTest
 from stoqlib.domain.person import ClientCategory
+from stoqlib.domain.views import ProductFullStockView
 from stoqlib.database.queryexecuter import (QueryExecuter,
-                                            StringQueryState)
+                                            StringQueryState,
+                                            _OperationExecuterPool)
 
 
 class QueryExecuterTest(DomainTest):
@@ -135,3 +137,75 @@ class QueryExecuterTest(DomainTest):
         finally:
             self.clean_domain([ClientCategory])
             self.store.commit()
+
+    def test_search_async_cancel(self):
+        op = self.qe.search_async([
+            StringQueryState(filter=self.sfilter,
+                             mode=StringQueryState.CONTAINS_ALL,
+                             text=u'eye')])
+        op.cancel()
+        self.qe._operation_executer._queue.join()
+        self.assertEqual(op.status, op.STATUS_CANCELLED)
+
+    def test_operation_executer_pool_size(self):
+        pool = _OperationExecuterPool(size=2)
+        self.assertEqual(pool.size, 2)
+        with mock.patch.dict('os.environ',
+                             {'STOQ_ASYNC_SEARCH_CONNECTIONS': '5'}):
+            pool = _OperationExecuterPool()
+        self.assertEqual(pool.size, 5)
+
+    def test_supports_keyset_pagination(self):
+        self.assertTrue(self.qe.supports_keyset_pagination('name'))
+        self.assertFalse(self.qe.supports_keyset_pagination('foobar'))
+        self.assertFalse(self.qe.supports_keyset_pagination(
+            ClientCategory.name))
+
+    def test_get_next_page(self):
+        for name in [u'B', u'A', u'C', u'B', u'D', u'B', u'A']:
+            self.create_client_category(name)
+
+        for descending in [False, True]:
+            result = self.store.find(ClientCategory)
+            expected = list(self.qe.get_keyset_ordered_result(
+                result, 'name', descending=descending))
+            self.assertEqual(len(expected), 7)
+
+            items = []
+            page = self.qe.get_next_page(result, 'name', page_size=2,
+                                         descending=descending)
+            while page:
+                self.assertLessEqual(len(page), 2)
+                items.extend(page)
+                page = self.qe.get_next_page(result, 'name', page_size=2,
+                                             last_item=items[-1],
+                                             descending=descending)
+            self.assertEqual(items, expected)
+
+
+class PostResultTest(DomainTest):
+    def setUp(self):
+        DomainTest.setUp(self)
+        self.qe = QueryExecuter(self.store)
+        self.qe.set_search_spec(ProductFullStockView)
+
+    def test_get_estimated_post_result(self):
+        result = self.store.find(ProductFullStockView)
+        post_result = self.qe.get_estimated_post_result(result)
+        self.assertIsNone(post_result.sum)
+        self.assertTrue(isinstance(post_result.count, int))
+        self.assertTrue(post_result.count >= 0)
+
+    def test_get_post_result_async(self):
+        result = self.store.find(ProductFullStockView)
+        expected = self.qe.get_post_result(result)
+
+        callback = mock.Mock()
+        op = self.qe.get_post_result_async(result, callback)
+        self.qe._operation_executer._queue.join()
+        self.assertEqual(op.status, op.STATUS_FINISHED)
+
+        op.emit('finish')
+        post_result = callback.call_args[0][0]
+        self.assertEqual(post_result.count, expected.count)
+        self.assertEqual(post_result.sum, expected.sum)
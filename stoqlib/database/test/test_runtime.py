@@ -28,8 +28,10 @@ import mock
 
 from stoqlib.database.exceptions import InterfaceError
 from stoqlib.database.properties import UnicodeCol
+from stoqlib.database.refcache import ReferenceCache
 from stoqlib.database.runtime import new_store, StoqlibStore, autoreload_object
 from stoqlib.domain.base import Domain
+from stoqlib.domain.payment.method import PaymentMethod
 from stoqlib.domain.person import Person, Client, ClientView
 from stoqlib.domain.test.domaintest import DomainTest
 
@@ -316,6 +318,86 @@ class StoqlibStoreTest(DomainTest):
 
         autoreload_object(obj1)
 
+    def test_bulk_flush(self):
+        store = new_store()
+        existing = WillBeCommitted(store=store, test_var=u'existing')
+        store.flush()
+
+        execute = mock.Mock(wraps=store._connection.execute)
+        with mock.patch.object(store._connection, 'execute', execute):
+            with store.bulk_flush():
+                objs = [WillBeCommitted(store=store, test_var=u'obj %d' % i)
+                        for i in range(3)]
+                existing.test_var = u'changed'
+                objs.append(WillBeCommitted(store=store, test_var=u'last'))
+                self.assertEqual(store.get_pending_count(), 6)
+
+        # The first 3 objects are inserted together. The last one can't
+        # be grouped with them since it would be moved before the update
+        statements = [args[0] for args, kwargs in execute.call_args_list]
+        self.assertEqual(
+            [type(s).__name__ for s in statements],
+            ['Insert', 'Update', 'Insert'])
+        self.assertEqual(len(statements[0].values), 3)
+
+        self.assertEqual(len(set(obj.id for obj in objs)), 4)
+        for i, obj in enumerate(objs[:3]):
+            self.assertEqual(
+                store.find(WillBeCommitted, id=obj.id).one().test_var,
+                u'obj %d' % i)
+            self.assertIsNotNone(obj.te)
+        self.assertEqual(objs[3].test_var, u'last')
+        store.rollback()
+
+    def test_get_reference_data(self):
+        cache = ReferenceCache.get_instance()
+        cache.invalidate()
+        method_id = PaymentMethod.get_by_name(self.store, u'money').id
+
+        store1 = new_store()
+        store2 = new_store()
+        store3 = new_store()
+        self.assertEqual(store1.get(PaymentMethod, method_id).method_name,
+                         u'money')
+
+        # The second store should get it from the cache
+        execute = mock.Mock(wraps=store2._connection.execute)
+        with mock.patch.object(store2._connection, 'execute', execute):
+            method = store2.get(PaymentMethod, method_id)
+        self.assertEqual(method.method_name, u'money')
+        self.assertEqual(execute.call_count, 0)
+
+        # Uncommitted changes should not be shared with the other stores
+        method.max_installments = 99
+        store2.flush()
+        self.assertEqual(store2.get(PaymentMethod, method_id).max_installments, 99)
+        self.assertNotEqual(
+            store3.get(PaymentMethod, method_id).max_installments, 99)
+
+        for store in [store1, store2, store3]:
+            store.rollback()
+
+    def test_get_reference_data_raw_write(self):
+        cache = ReferenceCache.get_instance()
+        cache.invalidate()
+        method_id = PaymentMethod.get_by_name(self.store, u'money').id
+
+        store1 = new_store()
+        store2 = new_store()
+        store1.execute("UPDATE payment_method SET max_installments = 99 "
+                       "WHERE id = ?", (method_id, ))
+
+        # The changed values should not be cached
+        self.assertEqual(store1.get(PaymentMethod, method_id).max_installments, 99)
+        self.assertNotEqual(
+            store2.get(PaymentMethod, method_id).max_installments, 99)
+
+        # The rows are only shared again after the transaction ends
+        store1.rollback(close=False)
+        self.assertFalse(store1._has_raw_writes)
+        for store in [store1, store2]:
+            store.rollback()
+
     def test_transaction_commit_hook(self):
         # Dummy will only be asserted for creation on the first commit.
         # After that it should pass all assert for nothing made.
@@ -462,3 +544,22 @@ class TestStoqlibResultSet(DomainTest):
         for obj, tpl in zip(results, results.fast_iter()):
             for prop in ['name', 'status', 'cpf']:
                 self.assertEqual(getattr(obj, prop), getattr(tpl, prop))
+
+    def test_fast_iter_itersize(self):
+        results = self.store.find(Person).order_by(Person.te_id)
+        # Make sure there are enough results to fetch more than once
+        assert results.count() > 2
+        tpls = list(results.fast_iter(itersize=2))
+        self.assertEqual(len(tpls), results.count())
+        for obj, tpl in zip(results, tpls):
+            for prop in ['name', 'id', 'te_id']:
+                self.assertEqual(getattr(obj, prop), getattr(tpl, prop))
+
+    def test_fast_iter_itersize_viewable(self):
+        results = self.store.find(ClientView).order_by(Client.te_id)
+        # Make sure there are results so the test makes sense
+        assert results.count()
+
+        for obj, tpl in zip(results, results.fast_iter(itersize=1)):
+            for prop in ['name', 'status', 'cpf']:
+                self.assertEqual(getattr(obj, prop), getattr(tpl, prop))
@@ -34,7 +34,7 @@ from stoqlib.domain.commission import Commission
 from stoqlib.domain.payment.method import CheckData
 from stoqlib.domain.payment.payment import Payment
 from stoqlib.domain.payment.views import OutPaymentView
-from stoqlib.domain.person import Person, Client, Individual, Supplier
+from stoqlib.domain.person import Branch, Person, Client, Individual, Supplier
 from stoqlib.domain.sale import Sale
 from stoqlib.domain.sellable import Sellable
 from stoqlib.domain.test.domaintest import DomainTest
@@ -175,3 +175,30 @@ class ViewableTest(DomainTest):
 
         vf = Supplier.status.variable_factory
         self.assertFalse(vf.keywords['allow_none'])
+
+    def test_load_values(self):
+        class SaleBranchViewable(Viewable):
+            branch = Branch
+
+            id = Sale.id
+            identifier = Sale.identifier
+            total_amount = Sale.total_amount
+
+            tables = [Sale,
+                      LeftJoin(Branch, Branch.id == Sale.branch_id)]
+
+        self.assertEqual(SaleBranchViewable._identifier_indexes, (2, ))
+        self.assertEqual(SaleBranchViewable._branch_index, 0)
+
+        sale = self.create_sale()
+        sale.branch.acronym = u'AB'
+        view = self.store.find(SaleBranchViewable, id=sale.id).one()
+        self.assertEqual(view.store, self.store)
+        self.assertEqual(view.branch, sale.branch)
+        self.assertEqual(view.identifier, sale.identifier)
+        self.assertEqual(str(view.identifier),
+                         'AB%05d' % (sale.identifier, ))
+
+        self.assertEqual(ClientView._identifier_indexes,
+                         (ClientView.cls_attributes.index('total_sales'), ))
+        self.assertIsNone(ClientView._branch_index)
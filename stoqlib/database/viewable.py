@@ -126,6 +126,7 @@ from storm.expr import Expr, JoinExpr
 from storm.properties import PropertyColumn
 
 from stoqlib.database.orm import ORMObject
+from stoqlib.database.properties import Identifier, _IdentifierVariable
 
 
 class Viewable(ClassInittableObject):
@@ -141,6 +142,11 @@ class Viewable(ClassInittableObject):
     #: StoqlibStore when the viewable is first used.
     cls_attributes = None
 
+    # Indexes on cls_spec of the values that may be an Identifier, and
+    # the index of the branch (if selected). Used by load_values
+    _identifier_indexes = ()
+    _branch_index = None
+
     #: A list of tables that will be queried, Viewable subclasses should
     # normally make a copy of this to avoid clobbering up the tables of the
     # parent class(es)
@@ -248,11 +254,60 @@ class Viewable(ClassInittableObject):
         cls.cls_spec = tuple(cls_spec)
         cls.cls_attributes = attributes
 
+        # Find out beforehand which values may need to have their prefix
+        # set, so load_values doesn't need to check all of them for each row.
+        # Columns are known, but other expressions could be anything.
+        identifier_indexes = []
+        for i, value in enumerate(cls_spec):
+            if isinstance(value, PropertyColumn):
+                if issubclass(value.variable_factory.func, _IdentifierVariable):
+                    identifier_indexes.append(i)
+            elif isinstance(value, Expr):
+                identifier_indexes.append(i)
+        cls._identifier_indexes = tuple(identifier_indexes)
+        if 'branch' in attributes:
+            cls._branch_index = attributes.index('branch')
+        else:
+            cls._branch_index = None
+
         # We store highjacked classes in this dict. Highjacked viewables
         # are the ones that we create programatically changing one or another
         # attribute (e.g. a join). See ProductFullStockView for more details
         cls.highjacked = {}
 
+    @classmethod
+    def load_values(cls, store, values):
+        """Creates an instance of this viewable from a row of values
+
+        This is used by the resultsets to convert the results of a
+        query into viewable instances.
+
+        :param store: the store the values were queried on
+        :param values: the values, in the same order as :attr:`.cls_spec`
+        :returns: the viewable instance
+        """
+        instance = cls()
+        # This will be removed later
+        instance._store = store
+        # The attributes on the class are columns/expressions (and not
+        # descriptors), so this is the same as calling setattr for each
+        # of them, just a lot faster
+        instance.__dict__.update(zip(cls.cls_attributes, values))
+
+        identifiers = [values[i] for i in cls._identifier_indexes
+                       if isinstance(values[i], Identifier)]
+        if not identifiers:
+            return instance
+
+        if cls._branch_index is not None:
+            branch = values[cls._branch_index]
+        else:
+            branch = getattr(instance, 'branch', None)
+        if branch:
+            for i in identifiers:
+                i.prefix = branch.acronym or ''
+        return instance
+
     @classmethod
     def extend_viewable(cls, new_attrs, new_joins=None):
         """Creates a subclass of this extended with the given columns and joins
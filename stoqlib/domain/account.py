@@ -45,7 +45,7 @@ from storm.info import ClassAlias
 from storm.references import Reference
 from zope.interface import implementer
 
-from stoqlib.database.expr import TransactionTimestamp, Date
+from stoqlib.database.expr import Case, TransactionTimestamp
 from stoqlib.database.properties import (DateTimeCol, EnumCol, IdCol,
                                          IntCol, PriceCol, UnicodeCol)
 from stoqlib.database.viewable import Viewable
@@ -287,18 +287,46 @@ class Account(Domain):
             raise TypeError("end must be a datetime.datetime, not %s" % (
                 type(end), ))
 
-        query = And(Date(AccountTransaction.date) >= start,
-                    Date(AccountTransaction.date) <= end,
-                    AccountTransaction.source_account_id != AccountTransaction.account_id)
-
-        transactions = self.store.find(AccountTransaction, query)
-        incoming = transactions.find(AccountTransaction.account_id == self.id)
-        outgoing = transactions.find(AccountTransaction.source_account_id == self.id)
-
-        positive_values = incoming.sum(AccountTransaction.value) or 0
-        negative_values = outgoing.sum(AccountTransaction.value) or 0
-
-        return currency(positive_values - negative_values)
+        # Comparing Date(AccountTransaction.date) can't use the indexes, so
+        # compare the dates against the beginning of the days instead
+        start_date = datetime.datetime.combine(start.date(), datetime.time())
+        if start_date < start:
+            start_date += datetime.timedelta(days=1)
+        end_date = (datetime.datetime.combine(end.date(), datetime.time()) +
+                    datetime.timedelta(days=1))
+
+        # The months that are complete in the interval are summarized on
+        # AccountBalance, only the transactions of the others are needed
+        first_month = start_date.replace(day=1)
+        if first_month < start_date:
+            first_month = (first_month +
+                           datetime.timedelta(days=32)).replace(day=1)
+        last_month = end_date.replace(day=1)
+        if first_month >= last_month:
+            return currency(self._get_transactions_total(start_date, end_date))
+
+        balances = self.store.find(AccountBalance, And(
+            AccountBalance.account_id == self.id,
+            AccountBalance.month >= first_month,
+            AccountBalance.month < last_month))
+        total = balances.sum(AccountBalance.incoming -
+                             AccountBalance.outgoing) or 0
+        total += self._get_transactions_total(start_date, first_month)
+        total += self._get_transactions_total(last_month, end_date)
+        return currency(total)
+
+    def _get_transactions_total(self, start, end):
+        # The value of the transactions to this account minus the ones from
+        # it, with start <= date < end
+        query = And(Or(AccountTransaction.account_id == self.id,
+                       AccountTransaction.source_account_id == self.id),
+                    AccountTransaction.source_account_id != AccountTransaction.account_id,
+                    AccountTransaction.date >= start,
+                    AccountTransaction.date < end)
+        value = Case(condition=AccountTransaction.account_id == self.id,
+                     result=AccountTransaction.value,
+                     else_=-AccountTransaction.value)
+        return self.store.find(AccountTransaction, query).sum(value) or 0
 
     def can_remove(self):
         """If the account can be removed.
@@ -570,6 +598,32 @@ class AccountTransaction(Domain):
             raise AssertionError
 
 
+class AccountBalance(Domain):
+    """The values of the |accounttransactions| of an |account| in a month
+
+    This is kept updated by the database every time a transaction gets
+    created, changed or removed, so the balance of the account doesn't
+    need to go through all of its transactions. It should not be changed
+    manually.
+    """
+
+    __storm_table__ = 'account_balance'
+
+    account_id = IdCol()
+
+    #: the |account|
+    account = Reference(account_id, 'Account.id')
+
+    #: the beginning of the month
+    month = DateTimeCol()
+
+    #: the value of the transactions to the account in the month
+    incoming = PriceCol(default=0)
+
+    #: the value of the transactions from the account in the month
+    outgoing = PriceCol(default=0)
+
+
 class AccountTransactionView(Viewable):
     """AccountTransactionView provides a fast view
     of the transactions tied to a specific |account|.
@@ -77,6 +77,11 @@ class Domain(ORMObject):
     #: representation of this object (when calling repr())
     repr_fields = []
 
+    #: If the rows of this class should be kept on the process-wide
+    #: :class:`reference cache <stoqlib.database.refcache.ReferenceCache>`.
+    #: Only set this for data that rarely changes, like payment methods
+    is_reference_data = False
+
     #: id of this domain class, it's usually the primary key.
     #: it will automatically update when a new insert is created.
     #: Note that there might be holes in the sequence numbers, which happens
@@ -506,6 +511,61 @@ class Domain(ORMObject):
 
         return obj
 
+    @classmethod
+    def bulk_update(cls, store, values, clause=None, batch_size=None):
+        """Update the objects of this class directly on the database
+
+        This is a lot faster than changing the objects one by one, but their
+        hooks (e.g. :meth:`.on_update`) will not be called. The objects that
+        are alive in the store will be reloaded the next time they are used
+        and their |transactionentry| is updated by the database, just like
+        when the objects are changed normally.
+
+        :param store: a store
+        :param values: a dict mapping the columns of this class to the
+          values (or expressions) to set on them
+        :param clause: a clause to filter the objects that will be updated
+          or ``None`` to update all of them
+        :param batch_size: if not ``None``, the objects will be updated in
+          ranges of this many ids, so each statement only goes through a
+          limited number of rows. Note that all of them are still updated
+          in the store's transaction, so the rows stay locked until it is
+          committed
+        :returns: the number of updated objects
+        """
+        # The pending changes would be lost when reloading the objects
+        store.flush()
+
+        query = [clause] if clause is not None else []
+        count = 0
+        last_id = None
+        while True:
+            batch_query = query[:]
+            if last_id is not None:
+                batch_query.append(cls.id > last_id)
+            results = store.find((cls.id, cls.te_id),
+                                 *batch_query).order_by(cls.id)
+            if batch_size is not None:
+                results.config(limit=batch_size)
+            rows = list(results)
+            if not rows:
+                break
+
+            ids = [id_ for id_, te_id in rows]
+            store.execute(Update(values, And(cls.id >= ids[0],
+                                             cls.id <= ids[-1], *query), cls))
+            store.autoreload_changed(cls, ids)
+            # The update_te rule of the table updates their te_time
+            store.autoreload_changed(TransactionEntry,
+                                     [te_id for id_, te_id in rows])
+            count += len(ids)
+
+            if batch_size is None or len(ids) < batch_size:
+                break
+            last_id = ids[-1]
+
+        return count
+
     @classmethod
     def validate_attr(cls, attr, expected_type=None):
         """Make sure attr belongs to cls and has the expected type
@@ -81,6 +81,56 @@ class CommissionSource(Domain):
     #: the |sellable|
     sellable = Reference(sellable_id, 'Sellable.id')
 
+    @classmethod
+    def get_commission_values(cls, store, sellable_ids):
+        """Get the commission values of the sellables
+
+        The commission source of a |sellable| is its own, or the one of its
+        |sellablecategory| or of the closest parent category that has one.
+        This resolves them for all the sellables with a single query,
+        going up the categories recursively.
+
+        :param store: a store
+        :param sellable_ids: the ids of the |sellables|
+        :returns: a dict mapping the sellable ids to tuples with the
+          ``direct_value`` and ``installments_value`` of their commission
+          sources. The sellables without one are not in the dict
+        """
+        query = """
+            WITH RECURSIVE category_path (sellable_id, category_id, depth) AS (
+                SELECT id, category_id, 1
+                    FROM sellable
+                    WHERE id = ANY(?::uuid[]) AND category_id IS NOT NULL
+                UNION ALL
+                SELECT category_path.sellable_id, sellable_category.category_id,
+                       category_path.depth + 1
+                    FROM category_path
+                    JOIN sellable_category
+                        ON sellable_category.id = category_path.category_id
+                    WHERE sellable_category.category_id IS NOT NULL
+            )
+            SELECT DISTINCT ON (sellable_id)
+                   sellable_id, direct_value, installments_value
+                FROM (
+                    SELECT sellable_id, 0 AS depth,
+                           direct_value, installments_value
+                        FROM commission_source
+                        WHERE sellable_id = ANY(?::uuid[])
+                    UNION ALL
+                    SELECT category_path.sellable_id, category_path.depth,
+                           direct_value, installments_value
+                        FROM category_path
+                        JOIN commission_source
+                            ON commission_source.category_id = category_path.category_id
+                ) AS source
+                ORDER BY sellable_id, depth
+            """
+        sellable_ids = list(sellable_ids)
+        results = store.execute(query, (sellable_ids, sellable_ids))
+        return dict((str(sellable_id), (direct_value, installments_value))
+                    for sellable_id, direct_value, installments_value
+                    in results)
+
 
 class Commission(Domain):
     """Commission object implementation
@@ -135,6 +185,9 @@ class Commission(Domain):
         """Calculates the commission amount to be paid"""
 
         relative_percentage = self._get_payment_percentage()
+        items = list(self.sale.get_items())
+        commissions = self._get_commissions(
+            set(item.sellable_id for item in items))
 
         # The commission is calculated for all sellable items
         # in sale; a relative percentage is given for each payment
@@ -146,8 +199,8 @@ class Commission(Domain):
         #   sales person is also going to be 20% and 80% of the complete
         #   commission amount for the sale when that specific payment is payed.
         value = Decimal(0)
-        for sellable_item in self.sale.get_items():
-            value += (self._get_commission(sellable_item.sellable) *
+        for sellable_item in items:
+            value += (commissions[sellable_item.sellable_id] *
                       sellable_item.get_total() *
                       relative_percentage)
 
@@ -163,33 +216,41 @@ class Commission(Domain):
         else:
             return self.payment.value / total
 
-    def _get_commission(self, sellable):
-        """Return the properly commission percentage to be used to
-        calculate the commission amount, for a given sellable.
+    def _get_commissions(self, sellable_ids):
+        """Return the properly commission percentages to be used to
+        calculate the commission amount, for the given sellables.
         """
+        from stoqlib.domain.sellable import Sellable, SellableCategory
 
+        # The values are the same for all the payments of the sale, so
+        # they are cached there, unless the sources (or the categories
+        # they are resolved from) were changed by this transaction
         store = self.store
-        source = store.find(CommissionSource, sellable=sellable).one()
-        if not source and sellable.category:
-            source = self._get_category_commission(sellable.category)
-
-        value = 0
-        if source:
-            if self.commission_type == self.DIRECT:
-                value = source.direct_value
-            else:
-                value = source.installments_value
-            value /= Decimal(100)
-
-        return value
-
-    def _get_category_commission(self, category):
-        if category:
-            store = self.store
-            source = store.find(CommissionSource, category=category).one()
-            if not source:
-                return self._get_category_commission(category.category)
-            return source
+        sale = self.sale
+        values = sale._commission_values
+        if (values is None or not sellable_ids.issubset(values) or
+                store.has_changes(CommissionSource) or
+                store.has_changes(SellableCategory) or
+                store.has_changes(Sellable)):
+            values = dict.fromkeys(sellable_ids)
+            values.update(CommissionSource.get_commission_values(
+                store, sellable_ids))
+            sale._commission_values = values
+
+        commissions = {}
+        for sellable_id in sellable_ids:
+            source_values = values[sellable_id]
+            value = 0
+            if source_values:
+                direct_value, installments_value = source_values
+                if self.commission_type == self.DIRECT:
+                    value = direct_value
+                else:
+                    value = installments_value
+                value /= Decimal(100)
+            commissions[sellable_id] = value
+
+        return commissions
 
 #
 # Views
@@ -98,6 +98,21 @@ class ProductStockUpdateEvent(Event):
     :param branch: the |branch| on which the stock was modified
     :param old_quantity: the old product stock quantity
     :param new_quantity: the new product stock quantity
+
+    Note that when the stock of many products is decreased at once (e.g.
+    when confirming a |sale|), :class:`ProductsStockUpdateEvent` is
+    emitted instead.
+    """
+
+
+class ProductsStockUpdateEvent(Event):
+    """
+    This event is emitted when the stock of many |products| is decreased
+    at once, see :meth:`stoqlib.domain.product.Storable.decrease_stock_many`
+
+    :param branch: the |branch| on which the stock was modified
+    :param changes: a list of (product, old_quantity, new_quantity) for
+        each stock item that was modified
     """
 
 
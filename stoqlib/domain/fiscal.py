@@ -64,6 +64,7 @@ class CfopData(Domain):
     """
 
     __storm_table__ = 'cfop_data'
+    is_reference_data = True
 
     #: fiscal code, for example. 1.102
     code = UnicodeCol()
@@ -22,8 +22,10 @@
 # Author(s): Stoq Team <stoq-devel@async.com.br>
 #
 
+from storm.expr import And
 from storm.references import Reference
 
+from stoqlib.database.prepared import PreparedQuery
 from stoqlib.database.properties import (BoolCol, DateTimeCol, EnumCol,
                                          IdCol, PercentCol, QuantityCol,
                                          PriceCol, UnicodeCol)
@@ -63,7 +65,16 @@ class SellableBranchOverride(Domain):
 
     @classmethod
     def find_by_sellable(cls, sellable, branch):
-        return sellable.store.find(cls, sellable=sellable, branch=branch).one()
+        if branch is None:
+            return None
+        return _override_by_sellable.one(sellable.store, sellable.id, branch.id)
+
+
+_override_by_sellable = PreparedQuery(
+    SellableBranchOverride,
+    lambda sellable_id, branch_id: And(
+        SellableBranchOverride.sellable_id == sellable_id,
+        SellableBranchOverride.branch_id == branch_id))
 
 
 class ProductBranchOverride(Domain):
@@ -85,6 +85,7 @@ class PaymentMethod(Domain):
     """
 
     __storm_table__ = 'payment_method'
+    is_reference_data = True
 
     method_name = UnicodeCol()
     is_active = BoolCol(default=True)
@@ -1024,9 +1024,7 @@ class Client(Domain):
 
         vals = {Client.credit_limit: Client._salary * percent / 100}
         clause = Client._salary > 0
-        # XXX This will update the table, but storm wont reload the data. Maybe
-        # we should invalidate all clients in cache
-        store.execute(Update(vals, clause, Client))
+        cls.bulk_update(store, vals, clause, batch_size=1000)
 
     def get_client_sales(self):
         """Returns a list of :obj:`sale views <stoqlib.domain.sale.SaleView>`
@@ -1100,15 +1098,13 @@ class Client(Domain):
 
     @property
     def remaining_store_credit(self):
-        from stoqlib.domain.payment.views import InPaymentView
-        status_query = Or(InPaymentView.status == Payment.STATUS_PENDING,
-                          InPaymentView.status == Payment.STATUS_CONFIRMED)
-        query = And(InPaymentView.person_id == self.person.id,
-                    status_query,
-                    InPaymentView.method_name == u'store_credit')
+        """Returns how much store credit this client has left
 
-        debit = self.store.find(InPaymentView, query).sum(InPaymentView.value) or currency('0.0')
-        return currency(self.credit_limit - debit)
+        That is the :obj:`.credit_limit` minus the store credit
+        |payments| that were not paid yet.
+        """
+        credit_balance, store_credit_debit = self._get_credit_balance()
+        return currency(self.credit_limit - store_credit_debit)
 
     def get_credit_transactions(self):
         """Returns all credit payments (in and out) associated  with a client's
@@ -1140,17 +1136,13 @@ class Client(Domain):
     def credit_account_balance(self):
         """Returns a client's credit balance.
 
-        :returns: The client's credit balance."""
-        transactions = self.get_credit_transactions()
-
-        balance = 0
-        for payment in transactions:
-            if payment.payment_type == payment.TYPE_OUT:
-                balance += payment.paid_value
-            else:
-                balance -= payment.paid_value
+        That is the paid value of the credit transactions (see
+        :meth:`.get_credit_transactions`) given to the client minus
+        the ones used by them.
 
-        return currency(balance)
+        :returns: The client's credit balance."""
+        credit_balance, store_credit_debit = self._get_credit_balance()
+        return currency(credit_balance)
 
     @property
     def salary(self):
@@ -1213,6 +1205,45 @@ class Client(Domain):
 
         return True
 
+    #
+    # Private
+    #
+
+    def _get_credit_balance(self):
+        # The balance is updated by the database when the payments change,
+        # so the values are read directly instead of using a possibly
+        # outdated ClientCreditBalance object
+        values = self.store.find(
+            (ClientCreditBalance.credit_balance,
+             ClientCreditBalance.store_credit_debit),
+            ClientCreditBalance.person_id == self.person_id).one()
+        return values or (0, 0)
+
+
+class ClientCreditBalance(Domain):
+    """The credit balances of a |client|
+
+    This is kept updated by the database every time a |payment| of the
+    client (i.e. of a |paymentgroup| they are the payer of) gets created,
+    paid or cancelled, so checking how much credit the client has doesn't
+    need to go through all of their payments. It should not be changed
+    manually.
+    """
+
+    __storm_table__ = 'client_credit_balance'
+
+    person_id = IdCol()
+
+    #: the |person| of the client
+    person = Reference(person_id, 'Person.id')
+
+    #: the paid value of the credit payments given to the client
+    #: minus the ones used by them
+    credit_balance = PriceCol(default=0)
+
+    #: the value of the store credit payments the client still needs to pay
+    store_credit_debit = PriceCol(default=0)
+
 
 @implementer(IActive)
 @implementer(IDescribable)
@@ -1669,6 +1700,7 @@ class Branch(Domain):
     """
 
     __storm_table__ = 'branch'
+    is_reference_data = True
 
     (STATUS_ACTIVE,
      STATUS_INACTIVE) = range(2)
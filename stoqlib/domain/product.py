@@ -104,7 +104,8 @@ from stoqlib.database.runtime import autoreload_object
 from stoqlib.database.viewable import Viewable
 from stoqlib.domain.base import Domain
 from stoqlib.domain.events import (ProductCreateEvent, ProductEditEvent,
-                                   ProductRemoveEvent, ProductStockUpdateEvent)
+                                   ProductRemoveEvent, ProductStockUpdateEvent,
+                                   ProductsStockUpdateEvent)
 from stoqlib.domain.interfaces import IDescribable
 from stoqlib.domain.overrides import ProductBranchOverride
 from stoqlib.domain.person import Person, Branch, LoginUser
@@ -1280,6 +1281,41 @@ class ProductStockItem(Domain):
                                batch=self.batch)
 
 
+class StorableStockSummary(Domain):
+    """The stock of a |storable| on a |branch|
+
+    This is the sum of the |productstockitem| of all the batches of the
+    storable on the branch, kept updated by the database every time one of
+    them changes. There's also a summary without a branch, with the
+    stock on all the branches.
+
+    It allows the stock to be queried without aggregating the stock items
+    (see :class:`stoqlib.domain.views.ProductFullStockView`).
+    Note that objects of this type should never be created or modified
+    manually.
+    """
+
+    __storm_table__ = 'storable_stock_summary'
+
+    storable_id = IdCol()
+
+    #: the |storable| this summary refers to
+    storable = Reference(storable_id, 'Storable.id')
+
+    branch_id = IdCol(default=None)
+
+    #: the |branch| this summary refers to or ``None`` for the summary of
+    #: all the branches
+    branch = Reference(branch_id, 'Branch.id')
+
+    #: the quantity in stock
+    quantity = QuantityCol(default=0)
+
+    #: the total cost of the quantity in stock (the sum of the quantity
+    #: times the stock cost of each stock item)
+    total_cost = PriceCol(default=0)
+
+
 class Storable(Domain):
     '''Storable represents the stock of a |product|.
 
@@ -1339,6 +1375,89 @@ class Storable(Domain):
 
         return store.using(*tables).find((Sellable, Product, Storable), query)
 
+    @classmethod
+    def decrease_stock_many(cls, store, branch, items, type, user: LoginUser,
+                            cost_center=None):
+        """Decrease the stock of many storables at once
+
+        This is the same as calling :meth:`.decrease_stock` for each item,
+        but the stock of all of them is validated with a single query and the
+        stock transactions are inserted in bulk. Instead of a
+        :class:`ProductStockUpdateEvent` for each item, a single
+        :class:`ProductsStockUpdateEvent` is emitted.
+
+        :param store: a store
+        :param branch: a |branch|
+        :param items: a list of (storable, batch, quantity, object_id) for
+            each decrease. The batches should have already been validated
+            (see :meth:`Domain.validate_batch`)
+        :param type: the type of the stock decrease. One of the
+            StockTransactionHistory.types
+        :param user: the |loginuser| responsible for the decreases
+        :param cost_center: the |costcenter| to which the decreases are
+            related, if any
+        :returns: a list with the stock item decreased for each item
+        """
+        if branch is None:
+            raise ValueError(u"branch cannot be None")
+
+        # The same storable/batch may appear more than once
+        quantities = collections.OrderedDict()
+        for storable, batch, quantity, object_id in items:
+            if quantity <= 0:
+                raise ValueError(_(u"quantity must be a positive number"))
+            key = (storable.id, batch and batch.id)
+            quantities[key] = quantities.get(key, 0) + quantity
+
+        storable_ids = list(set(storable_id for storable_id, batch_id in quantities))
+        stock_items = {}
+        for stock_item in store.find(ProductStockItem,
+                                     And(ProductStockItem.branch_id == branch.id,
+                                         In(ProductStockItem.storable_id, storable_ids))):
+            stock_items[(stock_item.storable_id, stock_item.batch_id)] = stock_item
+
+        changes = []
+        for key, quantity in quantities.items():
+            stock_item = stock_items.get(key)
+            if stock_item is None or quantity > stock_item.quantity:
+                raise StockError(
+                    _('Quantity to decrease is greater than the available stock.'))
+            changes.append((stock_item, stock_item.quantity))
+
+        decreased = []
+        transactions = []
+        with store.bulk_flush():
+            for storable, batch, quantity, object_id in items:
+                stock_item = stock_items[(storable.id, batch and batch.id)]
+                stock_transaction = StockTransactionHistory(
+                    store=store,
+                    storable=storable,
+                    branch=branch,
+                    batch=batch,
+                    quantity=-quantity,
+                    unit_cost=stock_item.stock_cost,
+                    responsible=user,
+                    type=type,
+                    object_id=object_id,
+                    flush=False)
+                if cost_center is not None:
+                    cost_center.add_stock_transaction(stock_transaction)
+                decreased.append(stock_item)
+                transactions.append(stock_transaction)
+
+        # The trigger updated the stock items when the transactions got
+        # inserted, reload them (see StockTransactionHistory.__init__)
+        for stock_transaction in transactions:
+            autoreload_object(stock_transaction, obj_store=True)
+        for stock_item, old_quantity in changes:
+            autoreload_object(stock_item, obj_store=True)
+
+        ProductsStockUpdateEvent.emit(
+            branch, [(stock_item.storable.product, old_quantity, stock_item.quantity)
+                     for stock_item, old_quantity in changes])
+
+        return decreased
+
     #
     #  Public API
     #
@@ -1799,7 +1918,7 @@ class StockTransactionHistory(Domain):
     def product_stock_item(self):
         return self.storable.get_stock_item(self.branch, self.batch)
 
-    def __init__(self, **kwargs):
+    def __init__(self, flush=True, **kwargs):
         # In some situations, storm would create the object without passing the
         # id of those reference objects, making the trigger fail to execute.
         # batch is the only one that we check differently because it is
@@ -1814,6 +1933,11 @@ class StockTransactionHistory(Domain):
 
         super(StockTransactionHistory, self).__init__(**kwargs)
 
+        if not flush:
+            # The caller is creating many transactions at once and will
+            # reload the objects itself (see Storable.decrease_stock_many)
+            return
+
         # Flush the store so the trigger that updates the ProductStockItem
         # will run and reload it after
         self.store.flush()
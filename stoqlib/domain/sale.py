@@ -36,8 +36,9 @@ from kiwi.python import Settable
 from stoqdrivers.enum import TaxType
 from storm.expr import (And, Avg, Count, LeftJoin, Join, Max, In,
                         Or, Sum, Alias, Select, Cast, Eq, Coalesce, Ne)
-from storm.info import ClassAlias
+from storm.info import ClassAlias, get_obj_info
 from storm.references import Reference, ReferenceSet
+from storm.store import AutoReload
 from zope.interface import implementer
 
 from stoqlib.database.expr import (Concat, Date, Distinct, Field, NullIf,
@@ -91,6 +92,63 @@ CostCenter  # pylint: disable=W0104
 #
 
 
+class _SaleItemsTotals(object):
+    """The totals of the items of a |sale|, updated incrementally
+
+    The contribution of each item to the totals is kept, so when an item
+    is added, changed or removed only its own contribution needs to be
+    calculated again, instead of going through all the items of the sale.
+    """
+
+    def __init__(self, items):
+        self._contributions = {}
+        self._dirty = set()
+        self._totals = (Decimal(0), Decimal(0), Decimal(0))
+        self._ipi_changes = InvoiceItemIpi.v_ipi_changes
+        for item in items:
+            self.update_item(item)
+
+    def update_item(self, item):
+        """Calculate the contribution of *item* again on the next access"""
+        item._sale_totals = self
+        self._dirty.add(item)
+
+    def remove_item(self, item):
+        """Remove the contribution of *item* from the totals"""
+        item._sale_totals = None
+        self._dirty.discard(item)
+        contribution = self._contributions.pop(item, None)
+        if contribution is not None:
+            self._add(contribution, -1)
+
+    def get_values(self):
+        """Get the totals
+
+        :returns: a tuple with the subtotal, the base subtotal and the
+            quantity of the items
+        """
+        if self._ipi_changes != InvoiceItemIpi.v_ipi_changes:
+            # The ipi value is part of the item total, but it is changed
+            # on the tax object, not on the item itself
+            self._ipi_changes = InvoiceItemIpi.v_ipi_changes
+            self._dirty.update(self._contributions)
+
+        while self._dirty:
+            item = self._dirty.pop()
+            contribution = self._contributions.get(item)
+            if contribution is not None:
+                self._add(contribution, -1)
+            contribution = item._get_totals_contribution()
+            self._contributions[item] = contribution
+            self._add(contribution, 1)
+
+        return self._totals
+
+    def _add(self, contribution, sign):
+        self._totals = tuple(total + sign * value
+                             for total, value in zip(self._totals, contribution))
+
+
 @implementer(IInvoiceItem)
 class SaleItem(Domain):
     """An item of a |sellable| within a |sale|.
@@ -214,6 +272,29 @@ class SaleItem(Domain):
         self.pis_info.set_item_tax(self)
         self.cofins_info.set_item_tax(self)
 
+        if sale is not None:
+            sale._update_item_totals(self)
+
+    #
+    #  Domain hooks
+    #
+
+    def on_object_changed(self, attr, old_value, value):
+        totals = getattr(self, '_sale_totals', None)
+        if totals is None:
+            return
+
+        if attr == 'sale_id':
+            # The item is not part of the sale that cached it anymore
+            totals.remove_item(self)
+        else:
+            totals.update_item(self)
+
+    def on_delete(self):
+        totals = getattr(self, '_sale_totals', None)
+        if totals is not None:
+            totals.remove_item(self)
+
     #
     #  Properties
     #
@@ -315,15 +396,7 @@ class SaleItem(Domain):
     #
 
     def sell(self, user: LoginUser):
-        if not self.sellable.is_available(branch=self.sale.branch):
-            raise SellError(_(u"%s is not available for sale. Try making it "
-                              u"available first and then try again.") % (
-                self.sellable.get_description()))
-
-        # This is emitted here instead of inside the if bellow because one can
-        # connect on it and change this item in a way that, if it wasn't going
-        # to decrease stock before, it will after
-        SaleItemBeforeDecreaseStockEvent.emit(self)
+        self._prepare_to_sell()
 
         quantity_to_decrease = self.quantity - self.quantity_decreased
         storable = self.sellable.product_storable
@@ -499,6 +572,10 @@ class SaleItem(Domain):
         return 0
 
     def update_tax_values(self):
+        totals = getattr(self, '_sale_totals', None)
+        if totals is not None:
+            totals.update_item(self)
+
         if self.icms_info:
             self.icms_info.update_values(self)
         if self.ipi_info:
@@ -522,6 +599,50 @@ class SaleItem(Domain):
                 return component
         return None
 
+    #
+    #  Private
+    #
+
+    def _prepare_to_sell(self):
+        if not self.sellable.is_available(branch=self.sale.branch):
+            raise SellError(_(u"%s is not available for sale. Try making it "
+                              u"available first and then try again.") % (
+                self.sellable.get_description()))
+
+        # This is emitted before checking the quantity to decrease because
+        # one can connect on it and change this item in a way that, if it
+        # wasn't going to decrease stock before, it will after
+        SaleItemBeforeDecreaseStockEvent.emit(self)
+
+    def _get_totals_contribution(self):
+        # The values this item adds to the totals of the sale.
+        # See Sale.get_sale_subtotal and Sale.get_sale_base_subtotal
+        sellable = self.sellable
+        if sellable.product and sellable.product.is_package:
+            # We should not sum package_product
+            base_total = Decimal(0)
+        elif self.parent_item:
+            component = self.get_component(self.parent_item)
+            base_total = quantize(self.quantity * component.price)
+        else:
+            base_total = quantize(self.quantity * self.base_price)
+        return (self.get_total(), base_total, self.quantity)
+
+    def _listen_to_events(self):
+        super(SaleItem, self)._listen_to_events()
+        get_obj_info(self).event.hook('changed', self._on_value_reloaded)
+
+    def _on_value_reloaded(self, obj_info, variable, old_value, value, from_db):
+        # on_object_changed is not called for the values that come from the
+        # database, like when the item gets autoreloaded after it was
+        # changed on another store
+        if not from_db and value is not AutoReload:
+            return
+
+        totals = getattr(self, '_sale_totals', None)
+        if totals is not None:
+            totals.update_item(self)
+
 
 @implementer(IContainer)
 class Delivery(Domain):
@@ -685,10 +806,10 @@ class Delivery(Domain):
 
     @property
     def service_item(self):
-        delivery = sysparam.get_object(self.store, 'DELIVERY_SERVICE').sellable
+        delivery_id = sysparam.get_object_id('DELIVERY_SERVICE')
         operation = self.invoice.operation
         for item in operation.get_items():
-            if item.sellable == delivery:
+            if item.sellable.id == delivery_id:
                 return item
 
     @property
@@ -1045,6 +1166,12 @@ class Sale(IdentifiableDomain):
     #: |loginuser| that cancelled the sale
     cancel_responsible = Reference(cancel_responsible_id, 'LoginUser.id')
 
+    #: the totals of the items, see :meth:`._get_items_totals`
+    _items_totals = None
+
+    #: the commission values of the items, cached by |commission|
+    _commission_values = None
+
     def __init__(self, store, branch: Branch, **kw):
         kw['invoice'] = Invoice(store=store, invoice_type=Invoice.TYPE_OUT, branch=branch)
         super(Sale, self).__init__(store=store, branch=branch, **kw)
@@ -1054,6 +1181,12 @@ class Sale(IdentifiableDomain):
         if not 'cfop' in kw:
             self.cfop = sysparam.get_object(store, 'DEFAULT_SALES_CFOP')
 
+    def __storm_invalidated__(self):
+        # The items may have been changed outside of this store (or
+        # rolled back), so the totals need to be calculated again
+        self._items_totals = None
+        self._commission_values = None
+
     #
     # Classmethods
     #
@@ -1072,6 +1205,7 @@ class Sale(IdentifiableDomain):
     def add_item(self, sale_item):
         assert not sale_item.sale
         sale_item.sale = self
+        self._update_item_totals(sale_item)
 
     def get_items(self, with_children=True):
         store = self.store
@@ -1283,11 +1417,13 @@ class Sale(IdentifiableDomain):
         assert self.can_confirm()
         assert self.branch
 
-        for item in self.get_items():
-            self.validate_batch(item.batch, sellable=item.sellable)
-            if item.sellable.product:
-                ProductHistory.add_sold_item(self.store, self.branch, item)
-            item.sell(user)
+        items = list(self.get_items())
+        with self.store.bulk_flush():
+            for item in items:
+                self.validate_batch(item.batch, sellable=item.sellable)
+                if item.sellable.product:
+                    ProductHistory.add_sold_item(self.store, self.branch, item)
+            self._sell_items(items, user)
 
         self.total_amount = self.get_total_sale_amount()
 
@@ -1559,11 +1695,8 @@ class Sale(IdentifiableDomain):
 
         :returns: subtotal
         """
-        total = 0
-        for sale_item in self.get_items():
-            total += sale_item.get_total()
-
-        return currency(total)
+        subtotal, base_subtotal, quantity = self._get_items_totals()
+        return currency(subtotal)
 
     def get_sale_base_subtotal(self):
         """Get the base subtotal of items
@@ -1573,26 +1706,16 @@ class Sale(IdentifiableDomain):
 
         :returns: the base subtotal
         """
-        items = self.get_items()
-        subtotal = 0
-        for item in items:
-            sellable = item.sellable
-            if sellable.product and sellable.product.is_package:
-                # We should not sum package_product
-                continue
-            if item.parent_item:
-                component = item.get_component(item.parent_item)
-                subtotal += quantize(item.quantity * component.price)
-            else:
-                subtotal += quantize(item.quantity * item.base_price)
-        return currency(subtotal)
+        subtotal, base_subtotal, quantity = self._get_items_totals()
+        return currency(base_subtotal)
 
     def get_items_total_quantity(self):
         """Fetches the total number of items in the sale
 
         :returns: number of items
         """
-        return self.get_items().sum(SaleItem.quantity) or Decimal(0)
+        subtotal, base_subtotal, quantity = self._get_items_totals()
+        return quantity
 
     def get_total_paid(self):
         """Return the total amount already paid for this sale
@@ -2026,6 +2149,50 @@ class Sale(IdentifiableDomain):
     # Private API
     #
 
+    def _get_items_totals(self):
+        # The totals are kept updated while the items change (see
+        # _SaleItemsTotals), so they don't need to be summed every time
+        if self._items_totals is None:
+            self._items_totals = _SaleItemsTotals(self.get_items())
+        return self._items_totals.get_values()
+
+    def _update_item_totals(self, sale_item):
+        if self._items_totals is not None:
+            self._items_totals.update_item(sale_item)
+
+    def _sell_items(self, items, user: LoginUser):
+        # The same as calling SaleItem.sell for each item, but the stock of
+        # all of them is validated and decreased at once
+        to_sell = []
+        for item in items:
+            item._prepare_to_sell()
+            to_sell.append((item, item.quantity - item.quantity_decreased))
+
+        to_decrease = []
+        for item, quantity in to_sell:
+            storable = item.sellable.product_storable
+            if storable and quantity:
+                to_decrease.append((item, storable, quantity))
+
+        if to_decrease:
+            try:
+                stock_items = Storable.decrease_stock_many(
+                    self.store, self.branch,
+                    [(storable, item.batch, quantity, item.id)
+                     for item, storable, quantity in to_decrease],
+                    StockTransactionHistory.TYPE_SELL, user,
+                    cost_center=self.cost_center)
+            except StockError as err:
+                raise SellError(str(err))
+
+            for (item, storable, quantity), stock_item in zip(to_decrease,
+                                                              stock_items):
+                item.average_cost = stock_item.stock_cost
+
+        for item, quantity in to_sell:
+            item.quantity_decreased += quantity
+            item.update_tax_values()
+
     def _set_sale_status(self, status, user: LoginUser):
         old_status = self.status
         self.status = status
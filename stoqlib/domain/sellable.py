@@ -37,13 +37,17 @@ or a |service|.
 
 import collections
 from decimal import Decimal
+import threading
 
 from kiwi.currency import currency
 from stoqdrivers.enum import TaxType, UnitType
-from storm.expr import And, Or, In, Eq
+from storm.expr import (And, Or, In, Eq, Lower, Alias, Join, LeftJoin, Select,
+                        SQL, Union)
 from storm.references import Reference, ReferenceSet
 from zope.interface import implementer
 
+from stoqlib.database.expr import Field
+from stoqlib.database.listener import DatabaseListener
 from stoqlib.database.properties import (BoolCol, DateTimeCol, EnumCol,
                                          IdCol, IntCol, PercentCol,
                                          PriceCol, UnicodeCol)
@@ -82,6 +86,7 @@ class SellableUnit(Domain):
     `schema <http://doc.stoq.com.br/schema/tables/sellable_unit.html>`__
     """
     __storm_table__ = 'sellable_unit'
+    is_reference_data = True
 
     #: The values on the list are enums used to fill
     # ``'unit_index'`` column above. That list is useful for many things,
@@ -124,6 +129,7 @@ class SellableTaxConstant(Domain):
     `schema <http://doc.stoq.com.br/schema/tables/sellable_tax_constant.html>`__
     """
     __storm_table__ = 'sellable_tax_constant'
+    is_reference_data = True
 
     #: description of this constant
     description = UnicodeCol()
@@ -220,6 +226,9 @@ class SellableCategory(Domain):
         """The full description of the category, including its parents,
         for instance: u"Clothes:Shoes:Black Shoe 14 SL"
         """
+        path = SellableCategoryTree.get_instance().get_path(self.store, self)
+        if path is not None:
+            return u':'.join(reversed([node.description for node in path]))
 
         descriptions = [self.description]
 
@@ -246,6 +255,17 @@ class SellableCategory(Domain):
 
         In this example, calling this from A will return ``set([B, C, D, E])``
         """
+        store = self.store
+        ids = SellableCategoryTree.get_instance().get_descendants(store, self)
+        if ids is not None:
+            children = set()
+            if ids:
+                children.update(store.find(SellableCategory,
+                                           SellableCategory.id.is_in(list(ids))))
+            # Make sure none of them was removed
+            if len(children) == len(ids):
+                return children
+
         children = set(self.children)
 
         if not len(children):
@@ -263,6 +283,13 @@ class SellableCategory(Domain):
 
         :returns: the commission
         """
+        path = SellableCategoryTree.get_instance().get_path(self.store, self)
+        if path is not None:
+            for node in path:
+                if node.salesperson_commission:
+                    return node.salesperson_commission
+            return path[-1].salesperson_commission
+
         if self.category:
             return (self.salesperson_commission or
                     self.category.get_commission())
@@ -274,6 +301,14 @@ class SellableCategory(Domain):
 
         :returns: the markup
         """
+        path = SellableCategoryTree.get_instance().get_path(self.store, self)
+        if path is not None:
+            for node in path:
+                # Compare to None as markup can be '0'
+                if node.suggested_markup is not None:
+                    return node.suggested_markup
+            return None
+
         if self.category:
             # Compare to None as markup can be '0'
             if self.suggested_markup is not None:
@@ -287,6 +322,14 @@ class SellableCategory(Domain):
 
         :returns: the tax constant
         """
+        path = SellableCategoryTree.get_instance().get_path(self.store, self)
+        if path is not None:
+            for node in path:
+                if node.tax_constant_id:
+                    return self.store.get(SellableTaxConstant,
+                                          node.tax_constant_id)
+            return None
+
         if self.category:
             return self.tax_constant or self.category.get_tax_constant()
         return self.tax_constant
@@ -315,11 +358,16 @@ class SellableCategory(Domain):
     #
 
     def on_create(self):
+        SellableCategoryTree.get_instance().invalidate()
         CategoryCreateEvent.emit(self)
 
     def on_update(self):
+        SellableCategoryTree.get_instance().invalidate()
         CategoryEditEvent.emit(self)
 
+    def on_delete(self):
+        SellableCategoryTree.get_instance().invalidate()
+
 
 # pylint: enable=E1101
 
@@ -368,6 +416,14 @@ class ClientCategoryPrice(Domain):
         self.store.remove(self)
 
 
+#: The prices and the branch dependent fields of a |sellable|, as
+#: returned by :meth:`Sellable.resolve_prices`
+_ResolvedPrice = collections.namedtuple(
+    '_ResolvedPrice', ['sellable', 'price', 'is_on_sale', 'category_price',
+                       'status', 'max_discount',
+                       'requires_kitchen_production'])
+
+
 def _validate_code(sellable, attr, code):
     if sellable.check_code_exists(code):
         raise SellableError(
@@ -615,8 +671,9 @@ class Sellable(Domain):
     #  Accessors
     #
 
-    def _get_table_price(self, branch):
-        table_price = sysparam.get_object(self.store, 'DEFAULT_TABLE_PRICE')
+    @staticmethod
+    def _get_table_price(store, branch):
+        table_price = sysparam.get_object(store, 'DEFAULT_TABLE_PRICE')
         if branch and branch.default_client_category:
             table_price = branch.default_client_category
         return table_price
@@ -625,7 +682,7 @@ class Sellable(Domain):
         if self.is_on_sale():
             return self.on_sale_price
 
-        category = self._get_table_price(branch)
+        category = self._get_table_price(self.store, branch)
         if category:
             info = self.get_category_price_info(category)
             if info:
@@ -971,6 +1028,120 @@ class Sellable(Domain):
 
         self.store.remove(self)
 
+    @classmethod
+    def resolve_prices(cls, store, sellables, branch=None, category=None):
+        """Resolve the prices of a batch of sellables at once
+
+        This gives the same results as calling :meth:`.get_price`,
+        :meth:`.is_available` and :meth:`.get_requires_kitchen_production`
+        on each one of them, but the |clientcategoryprices| and the
+        branch overrides are fetched together with the sellables in a
+        single query.
+
+        :param store: a store
+        :param sellables: the |sellables| to resolve the prices
+        :param branch: the |branch| to get the overrides from or ``None``
+        :param category: the |clientcategory| to get the prices from. If
+          ``None``, the default table price of the *branch* is used, like
+          :meth:`.get_price` does
+        :returns: a dict mapping the sellable ids to namedtuples with the
+          ``sellable``, its effective ``price``, ``is_on_sale``, the
+          ``category_price`` used (or ``None``), the ``status`` and the
+          ``max_discount`` and ``requires_kitchen_production`` with the
+          overrides applied
+        """
+        ids = list(set(sellable.id for sellable in sellables))
+        if not ids:
+            return {}
+
+        if category is None:
+            category = cls._get_table_price(store, branch)
+
+        tables = [cls]
+        columns = [cls]
+        if branch is not None:
+            tables.append(LeftJoin(SellableBranchOverride, And(
+                SellableBranchOverride.sellable_id == cls.id,
+                SellableBranchOverride.branch_id == branch.id)))
+            columns.append(SellableBranchOverride)
+        if category is not None:
+            tables.append(LeftJoin(ClientCategoryPrice, And(
+                ClientCategoryPrice.sellable_id == cls.id,
+                ClientCategoryPrice.category_id == category.id)))
+            columns.append(ClientCategoryPrice)
+
+        delivery_id = sysparam.get_object_id('DELIVERY_SERVICE')
+        results = {}
+        for row in store.using(*tables).find(tuple(columns), In(cls.id, ids)):
+            row = list(row)
+            sellable = row.pop(0)
+            override = row.pop(0) if branch is not None else None
+            category_price = row.pop(0) if category is not None else None
+
+            def get_value(attr):
+                value = getattr(override, attr, None)
+                return value if value is not None else getattr(sellable, attr)
+
+            is_on_sale = sellable.is_on_sale()
+            if is_on_sale:
+                price = sellable.on_sale_price
+            elif category_price is not None:
+                price = category_price.price
+            else:
+                price = sellable.base_price
+
+            status = get_value('status')
+            if sellable.id == delivery_id:
+                status = cls.STATUS_AVAILABLE
+
+            max_discount = (category_price or sellable).max_discount
+            results[sellable.id] = _ResolvedPrice(
+                sellable=sellable,
+                price=price,
+                is_on_sale=is_on_sale,
+                category_price=category_price,
+                status=status,
+                max_discount=max_discount,
+                requires_kitchen_production=get_value(
+                    'requires_kitchen_production'))
+
+        return results
+
+    @classmethod
+    def find_by_any_code(cls, store, text):
+        """Find sellables given a barcode, code or batch number
+
+        This is done using a single query, comparing *text* case
+        insensitively against the sellable barcode, the sellable code and
+        the |batch| number, in this order of priority.
+
+        :param store: a store
+        :param text: the barcode, code or batch number
+        :returns: a list of tuples with the |sellable| and the |batch|,
+          ordered by priority. The batch will be ``None`` unless the
+          sellable was found by its batch number
+        """
+        from stoqlib.domain.product import StorableBatch
+        text = text.lower()
+        no_batch = SQL('NULL::uuid')
+        match = Alias(Union(
+            Select([Alias(SQL('1'), 'priority'), Alias(cls.id, 'sellable_id'),
+                    Alias(no_batch, 'batch_id')],
+                   Lower(cls.barcode) == text),
+            Select([SQL('2'), cls.id, no_batch],
+                   Lower(cls.code) == text),
+            Select([SQL('3'), StorableBatch.storable_id, StorableBatch.id],
+                   Lower(StorableBatch.batch_number) == text),
+            all=True), '_match')
+
+        tables = [cls, Join(match, Field('_match', 'sellable_id') == cls.id)]
+        results = store.using(*tables).find(
+            (cls, Field('_match', 'batch_id')))
+        results = results.order_by(Field('_match', 'priority'))
+
+        return [(sellable, batch_id and store.get(StorableBatch, batch_id))
+                for sellable, batch_id in results]
+
     @classmethod
     def get_available_sellables_query(cls, store):
         """Get the sellables that are available and can be sold.
@@ -1075,3 +1246,307 @@ class Sellable(Domain):
 
         query = cls.get_unblocked_sellables_query(store)
         return And(query, Or(*queries))
+
+
+class SellableLookupIndex(object):
+    """An in-memory index of the sellable barcodes, codes and batch numbers
+
+    This keeps a map of the lowercased barcodes, codes and batch numbers
+    to the ids of their |sellables| and |batches|, shared by all the stores
+    of the process. That allows the POS and the wizards to find what was
+    typed or scanned without searching the sellable tables, which can't
+    use an index when doing a case insensitive comparison.
+
+    The index is loaded when it is first used (or by :meth:`.warm_up`) and
+    kept up to date by the :class:`DatabaseListener
+    <stoqlib.database.listener.DatabaseListener>`. Since the objects found
+    are always checked, at worst an outdated entry will make us fallback
+    to a query on the database. That will also happen when the store has
+    uncommitted changes on sellables or batches, which the index can't see.
+    """
+
+    _SINGLETON = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._is_warm = False
+        # attribute name -> {lowercased value: set of ids}
+        self._indexes = {}
+        # attribute name -> {id: lowercased value}
+        self._values = {}
+        # table name -> te_ids of the rows changed since they were loaded
+        self._changed = {}
+        for attr in self._get_attributes():
+            self._indexes[attr.name] = collections.defaultdict(set)
+            self._values[attr.name] = {}
+            self._changed[attr.cls.__storm_table__] = set()
+        DatabaseListener.get_instance().subscribe(self._on_notification)
+
+    @classmethod
+    def get_instance(cls):
+        if cls._SINGLETON is None:
+            cls._SINGLETON = cls()
+        return cls._SINGLETON
+
+    #
+    #  Public API
+    #
+
+    def warm_up(self, store):
+        """Load the index from the database
+
+        :param store: a store
+        """
+        if not self._can_use(store):
+            return
+
+        with self._lock:
+            for te_ids in self._changed.values():
+                te_ids.clear()
+            for attr in self._get_attributes():
+                self._indexes[attr.name].clear()
+                self._values[attr.name].clear()
+            self._load(store)
+            self._is_warm = True
+
+    def find_sellable_and_batch(self, store, text, is_valid=None):
+        """Find a sellable given its barcode, code or batch number
+
+        The barcode is tried first, then the code since there might be a
+        sellable with a code equal to another sellable's barcode, and
+        then the batch number. The comparison is case insensitive.
+
+        :param store: a store
+        :param text: the barcode, code or batch number
+        :param is_valid: if not ``None``, a callable that receives a
+          sellable and returns if it can be used
+        :returns: a tuple with the |sellable| and the |batch| found, or
+          ``(None, None)`` if nothing was found. The batch will only be
+          returned if it was found by its batch number
+        """
+        text = text.lower()
+        matches = self._find_matches(store, text)
+        if matches is None:
+            # The index can't be used, ask the database
+            matches = Sellable.find_by_any_code(store, text)
+
+        for sellable, batch in matches:
+            if is_valid is None or is_valid(sellable):
+                return sellable, batch
+
+        return None, None
+
+    #
+    #  Private
+    #
+
+    def _get_attributes(self):
+        from stoqlib.domain.product import StorableBatch
+        return [Sellable.barcode, Sellable.code, StorableBatch.batch_number]
+
+    def _can_use(self, store):
+        if not DatabaseListener.get_instance().poll():
+            return False
+        return not any(store.has_changes(attr.cls)
+                       for attr in self._get_attributes())
+
+    def _find_matches(self, store, text):
+        if not self._is_warm:
+            self.warm_up(store)
+        if not self._is_warm or not self._can_use(store):
+            return None
+
+        attributes = self._get_attributes()
+        with self._lock:
+            self._load_changed(store)
+            found = [(attr, list(self._indexes[attr.name].get(text, [])))
+                     for attr in attributes]
+
+        matches = []
+        for attr, ids in found:
+            for id_ in ids:
+                obj = store.get(attr.cls, id_)
+                # Make sure the entry was not outdated (e.g. the
+                # row was removed)
+                if (obj is None or
+                        (getattr(obj, attr.name) or u'').lower() != text):
+                    return None
+
+                if attr is attributes[-1]:
+                    matches.append((obj.storable.product.sellable, obj))
+                else:
+                    matches.append((obj, None))
+
+        return matches
+
+    def _load(self, store, changed=None):
+        for attr in self._get_attributes():
+            query = None
+            if changed is not None:
+                te_ids = changed[attr.cls.__storm_table__]
+                if not te_ids:
+                    continue
+                query = attr.cls.te_id.is_in(te_ids)
+
+            index = self._indexes[attr.name]
+            values = self._values[attr.name]
+            for id_, value in store.find((attr.cls.id, attr), query):
+                old_value = values.pop(id_, None)
+                if old_value is not None:
+                    index[old_value].discard(id_)
+                    if not index[old_value]:
+                        del index[old_value]
+                if value:
+                    values[id_] = value.lower()
+                    index[value.lower()].add(id_)
+
+    def _load_changed(self, store):
+        if not any(self._changed.values()):
+            return
+
+        changed = {}
+        for table, te_ids in self._changed.items():
+            changed[table] = list(te_ids)
+            te_ids.clear()
+        self._load(store, changed)
+
+    #
+    #  Callbacks
+    #
+
+    def _on_notification(self, channel, te_id, table_name):
+        with self._lock:
+            if table_name in self._changed:
+                self._changed[table_name].add(te_id)
+
+
+_CategoryNode = collections.namedtuple(
+    '_CategoryNode', ['id', 'category_id', 'description',
+                      'salesperson_commission', 'suggested_markup',
+                      'tax_constant_id'])
+
+
+class SellableCategoryTree(object):
+    """An in-memory copy of the |sellablecategory| tree
+
+    The categories are loaded with a single query and shared by all the
+    stores of the process, so the full descriptions, the ancestors and the
+    descendants of a category (and the values it inherits from them) don't
+    need to be loaded one category at a time.
+
+    The tree is loaded again when the :class:`DatabaseListener
+    <stoqlib.database.listener.DatabaseListener>` tells us that a category
+    changed or when one of them is flushed by this process. Stores with
+    uncommitted changes on categories can't use it, so the methods here
+    return ``None`` and the callers should ask the database instead.
+    """
+
+    _SINGLETON = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # A tuple of ({id: node}, {parent id: [children ids]})
+        self._tree = None
+        DatabaseListener.get_instance().subscribe(self._on_notification)
+
+    @classmethod
+    def get_instance(cls):
+        if cls._SINGLETON is None:
+            cls._SINGLETON = cls()
+        return cls._SINGLETON
+
+    #
+    #  Public API
+    #
+
+    def get_path(self, store, category):
+        """Get the category and its ancestors
+
+        :param store: a store
+        :param category: a |sellablecategory|
+        :returns: a list of nodes, with the same attributes as the
+          categories, from *category* to its base category or ``None``
+          if the tree can't be used
+        """
+        tree = self._get_tree(store)
+        if tree is None:
+            return None
+
+        nodes, children = tree
+        path = []
+        category_id = category.id
+        while category_id is not None:
+            node = nodes.get(category_id)
+            if node is None or len(path) > len(nodes):
+                # The tree is outdated, let the database answer that
+                return None
+            path.append(node)
+            category_id = node.category_id
+
+        return path
+
+    def get_descendants(self, store, category):
+        """Get the ids of all the children of the category, recursively
+
+        :param store: a store
+        :param category: a |sellablecategory|
+        :returns: a set of ids or ``None`` if the tree can't be used
+        """
+        tree = self._get_tree(store)
+        if tree is None:
+            return None
+
+        nodes, children = tree
+        if category.id not in nodes:
+            return None
+
+        descendants = set()
+        pending = list(children.get(category.id, []))
+        while pending:
+            category_id = pending.pop()
+            if category_id in descendants:
+                continue
+            descendants.add(category_id)
+            pending.extend(children.get(category_id, []))
+
+        return descendants
+
+    def invalidate(self):
+        """Load the tree again the next time it is used"""
+        with self._lock:
+            self._tree = None
+
+    #
+    #  Private
+    #
+
+    def _get_tree(self, store):
+        if not DatabaseListener.get_instance().poll():
+            return None
+        if store.has_changes(SellableCategory):
+            return None
+
+        with self._lock:
+            if self._tree is None:
+                self._tree = self._load(store)
+            return self._tree
+
+    def _load(self, store):
+        nodes = {}
+        children = collections.defaultdict(list)
+        columns = [getattr(SellableCategory, field)
+                   for field in _CategoryNode._fields]
+        for values in store.find(tuple(columns)):
+            node = _CategoryNode(*values)
+            nodes[node.id] = node
+            children[node.category_id].append(node.id)
+
+        return nodes, children
+
+    #
+    #  Callbacks
+    #
+
+    def _on_notification(self, channel, te_id, table_name):
+        if not table_name or table_name == SellableCategory.__storm_table__:
+            self.invalidate()
@@ -49,6 +49,7 @@ class BranchStation(Domain):
     certain branch company
     """
     __storm_table__ = 'branch_station'
+    is_reference_data = True
 
     name = UnicodeCol()
     is_active = BoolCol(default=False)
@@ -444,10 +444,22 @@ class InvoiceItemIpi(BaseIPI):
 
     __storm_table__ = 'invoice_item_ipi'
 
+    #: incremented every time the :obj:`.v_ipi` of any object changes, so
+    #: the totals cached by the sales know when they need to be updated
+    v_ipi_changes = 0
+
     v_ipi = PriceCol(default=0)
     v_bc = PriceCol(default=None)
     v_unid = PriceCol(default=None)
 
+    #
+    # Domain hooks
+    #
+
+    def on_object_changed(self, attr, old_value, value):
+        if attr == 'v_ipi':
+            InvoiceItemIpi.v_ipi_changes += 1
+
     #
     # Public API
     #
@@ -27,7 +27,8 @@ __tests__ = 'stoqlib/domain/account.py'
 import datetime
 from storm.exceptions import OrderLoopError
 
-from stoqlib.domain.account import (Account, AccountTransaction,
+from stoqlib.domain.account import (Account, AccountBalance,
+                                    AccountTransaction,
                                     AccountTransactionView,
                                     BillOption)
 from stoqlib.domain.purchase import PurchaseOrder
@@ -240,6 +241,43 @@ class TestAccount(DomainTest):
         self.assertRaises(TypeError, a.get_total_for_interval, good, bad)
         self.assertRaises(TypeError, a.get_total_for_interval, bad, good)
 
+    def test_get_total_for_interval_months(self):
+        a = self.create_account()
+        b = self.create_account()
+        for date, value in [(datetime.datetime(2010, 1, 15, 10), 10),
+                            (datetime.datetime(2010, 2, 1), 20),
+                            (datetime.datetime(2010, 3, 10, 23, 59), 40),
+                            (datetime.datetime(2010, 4, 1), 80)]:
+            transaction = self.create_account_transaction(a, value=value)
+            transaction.date = date
+        transaction = self.create_account_transaction(b, source=a, value=5)
+        transaction.date = datetime.datetime(2010, 2, 20)
+
+        balance = self.store.find(AccountBalance, account_id=a.id,
+                                  month=datetime.datetime(2010, 2, 1)).one()
+        self.assertEqual(balance.incoming, 20)
+        self.assertEqual(balance.outgoing, 5)
+
+        # Whole months
+        self.assertEqual(a.get_total_for_interval(
+            datetime.datetime(2010, 1, 1),
+            datetime.datetime(2010, 3, 31)), 65)
+        # Partial months on both ends
+        self.assertEqual(a.get_total_for_interval(
+            datetime.datetime(2010, 1, 15),
+            datetime.datetime(2010, 3, 10)), 65)
+        # The start of the interval is after the beginning of the day
+        self.assertEqual(a.get_total_for_interval(
+            datetime.datetime(2010, 1, 15, 12),
+            datetime.datetime(2010, 4, 1)), 135)
+        # The end of the interval includes the whole day
+        self.assertEqual(a.get_total_for_interval(
+            datetime.datetime(2010, 2, 2),
+            datetime.datetime(2010, 3, 10)), 35)
+        self.assertEqual(b.get_total_for_interval(
+            datetime.datetime(2010, 1, 1),
+            datetime.datetime(2010, 12, 31)), 5)
+
     def test_matches(self):
         a1 = self.create_account()
         a2 = self.create_account()
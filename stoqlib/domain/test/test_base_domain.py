@@ -185,6 +185,22 @@ class TestSelect(DomainTest):
         self.assertEqual(Ding.get_max_value(self.store, Ding.str_field,
                                             query=(Ding.int_field == 2)), u'100')
 
+    def test_bulk_update(self):
+        dings = [Ding(store=self.store, int_field=1) for i in range(5)]
+        other = Ding(store=self.store, int_field=2)
+
+        count = Ding.bulk_update(self.store, {Ding.str_field: u'updated'},
+                                 Ding.int_field == 1, batch_size=2)
+        self.assertEqual(count, 5)
+        for ding in dings:
+            self.assertEqual(ding.str_field, u'updated')
+        self.assertEqual(other.str_field, u'')
+
+        count = Ding.bulk_update(self.store, {Ding.int_field: Ding.int_field + 1})
+        self.assertEqual(count, 6)
+        self.assertEqual(dings[0].int_field, 2)
+        self.assertEqual(other.int_field, 3)
+
     def test_check_unique_value_exists(self):
         ding_1 = Ding(store=self.store, str_field=u'Ding_1')
         ding_2 = Ding(store=self.store, str_field=u'Ding_2')
@@ -31,7 +31,6 @@ from kiwi.currency import currency
 import mock
 from storm.exceptions import NotOneError, IntegrityError
 from storm.expr import And
-from storm.store import AutoReload
 from storm.tracer import BaseStatementTracer, install_tracer, remove_tracer_type
 
 from stoqlib.database.expr import Age, Case, Date, DateTrunc, Interval
@@ -726,7 +725,6 @@ class TestClient(_PersonFacetTest, DomainTest):
 
         # testing if updates
         Client.update_credit_limit(10, self.store)
-        client.credit_limit = AutoReload
         self.assertEqual(client.credit_limit, 10)
 
         # testing if it does not update
@@ -818,6 +816,31 @@ class TestClient(_PersonFacetTest, DomainTest):
         payment.payment_type = payment.TYPE_IN
         self.assertEqual(client.credit_account_balance, -100)
 
+    def test_remaining_store_credit(self):
+        method = self.store.find(PaymentMethod,
+                                 method_name=u'store_credit').one()
+        client = self.create_client()
+        client.credit_limit = 1000
+        self.assertEqual(client.remaining_store_credit, 1000)
+
+        group = self.create_payment_group()
+        payment1 = self.create_payment(payment_type=Payment.TYPE_IN,
+                                       value=100, method=method, group=group)
+        payment2 = self.create_payment(payment_type=Payment.TYPE_IN,
+                                       value=50, method=method, group=group)
+        payment1.set_pending()
+        payment2.set_pending()
+        # The payments are only for the client after they are the payer
+        self.assertEqual(client.remaining_store_credit, 1000)
+        group.payer = client.person
+        self.assertEqual(client.remaining_store_credit, 850)
+
+        payment1.pay()
+        self.assertEqual(client.remaining_store_credit, 950)
+        payment2.cancel()
+        self.assertEqual(client.remaining_store_credit, 1000)
+        self.assertEqual(client.credit_account_balance, 0)
+
 
 class TestClientCategory(DomainTest):
     def test_get_description(self):
@@ -1373,6 +1373,39 @@ class TestStorable(DomainTest):
 
         self.assertFalse(cost_center.get_stock_transaction_entries().is_empty())
 
+    def test_decrease_stock_many(self):
+        branch = self.current_branch
+        storable1 = self.create_storable(branch=branch, stock=10)
+        storable2, batch = self.create_storable(branch=branch, stock=5,
+                                                is_batch=True)
+        cost_center = self.create_cost_center()
+
+        stock_items = Storable.decrease_stock_many(
+            self.store, branch,
+            [(storable1, None, 3, None), (storable2, batch, 2, None),
+             (storable1, None, 4, None)],
+            StockTransactionHistory.TYPE_INITIAL, self.current_user,
+            cost_center=cost_center)
+        self.assertEqual(stock_items, [storable1.get_stock_item(branch, None),
+                                       storable2.get_stock_item(branch, batch),
+                                       storable1.get_stock_item(branch, None)])
+        self.assertEqual(storable1.get_balance_for_branch(branch), 3)
+        self.assertEqual(storable2.get_balance_for_branch(branch), 3)
+        self.assertEqual(cost_center.get_stock_transaction_entries().count(), 3)
+
+        # The quantities of the same storable are validated together
+        with self.assertRaises(StockError):
+            Storable.decrease_stock_many(
+                self.store, branch,
+                [(storable1, None, 2, None), (storable1, None, 2, None)],
+                StockTransactionHistory.TYPE_INITIAL, self.current_user)
+        self.assertEqual(storable1.get_balance_for_branch(branch), 3)
+
+        with self.assertRaises(ValueError):
+            Storable.decrease_stock_many(
+                self.store, branch, [(storable1, None, 0, None)],
+                StockTransactionHistory.TYPE_INITIAL, self.current_user)
+
     def test_update_stock_cost(self):
         stock_item = self.create_product_stock_item(quantity=10, stock_cost=50)
         self.assertEqual(stock_item.quantity, 10)
@@ -584,6 +584,24 @@ class TestSale(DomainTest):
         self.assertEqual(storable3.get_balance_for_branch(branch),
                          stock3 - 10)
 
+    @mock.patch('stoqlib.domain.product.ProductsStockUpdateEvent.emit')
+    def test_confirm_stock_update_event(self, emit):
+        sale = self.create_sale()
+        sellable1 = self.add_product(sale, quantity=2)
+        sellable2 = self.add_product(sale, quantity=3)
+        sale.order(self.current_user)
+        self.add_payments(sale)
+        sale.confirm(self.current_user)
+
+        # A single event for all the products of the sale
+        emit.assert_called_once_with(sale.branch, mock.ANY)
+        changes = emit.call_args[0][1]
+        self.assertEqual(
+            set((product.sellable, old - new) for product, old, new in changes),
+            set([(sellable1, 2), (sellable2, 3)]))
+        for item in sale.get_items():
+            self.assertEqual(item.quantity_decreased, item.quantity)
+
     def test_pay(self):
         sale = self.create_sale()
         self.assertFalse(sale.can_set_paid())
@@ -1427,6 +1445,36 @@ class TestSale(DomainTest):
         self.assertEqual(commissions.count(), 1)
         self.assertEqual(commissions[0].value, Decimal('56.00'))
 
+    def test_commission_amount_from_category(self):
+        parent = self.create_sellable_category()
+        category = self.create_sellable_category(parent=parent)
+        CommissionSource(category=parent,
+                         direct_value=10,
+                         installments_value=5,
+                         store=self.store)
+        sale = self.create_sale()
+        sellable1 = self.add_product(sale, price=200)
+        sellable1.category = category
+        sellable2 = self.add_product(sale, price=300)
+        sellable2.category = category
+        CommissionSource(sellable=sellable2,
+                         direct_value=12,
+                         installments_value=6,
+                         store=self.store)
+        sellable3 = self.add_product(sale, price=100)
+
+        self.assertEqual(
+            CommissionSource.get_commission_values(
+                self.store, [sellable1.id, sellable2.id, sellable3.id]),
+            {sellable1.id: (10, 5), sellable2.id: (12, 6)})
+
+        sale.order(self.current_user)
+        self.add_payments(sale)
+        sale.confirm(self.current_user)
+        commissions = self.store.find(Commission, sale=sale)
+        self.assertEqual(commissions.count(), 1)
+        self.assertEqual(commissions[0].value, Decimal('56.00'))
+
     def test_commission_amount_when_sale_returns_completly(self):
         if True:
             raise SkipTest(u"See stoqlib.domain.returned_sale.ReturnedSale.return_ "
@@ -1739,6 +1787,63 @@ class TestSale(DomainTest):
         self.add_payments(item.sale)
         self.assertEqual(item.sale.get_total_to_pay(), 100)
 
+    def test_get_items_totals(self):
+        sale = self.create_sale()
+
+        def check_totals():
+            items = self.store.find(SaleItem, sale=sale)
+            self.assertEqual(sale.get_sale_subtotal(),
+                             items.sum(SaleItem.price * SaleItem.quantity) or 0)
+            self.assertEqual(sale.get_sale_base_subtotal(),
+                             items.sum(SaleItem.base_price * SaleItem.quantity) or 0)
+            self.assertEqual(sale.get_items_total_quantity(),
+                             items.sum(SaleItem.quantity) or 0)
+
+        check_totals()
+        item1 = sale.add_sellable(self.create_sellable(price=10), quantity=2)
+        item2 = sale.add_sellable(self.create_sellable(price=5), quantity=3)
+        check_totals()
+        self.assertEqual(sale.get_sale_subtotal(), 35)
+
+        item1.price = 8
+        item2.quantity = 4
+        check_totals()
+        self.assertEqual(sale.get_sale_subtotal(), 36)
+        self.assertEqual(sale.get_sale_base_subtotal(), 40)
+
+        sale.remove_item(item1, self.current_user)
+        check_totals()
+        self.assertEqual(sale.get_items_total_quantity(), 4)
+
+        # Changes to the ipi value of an item are also part of the totals
+        item2.ipi_info.v_ipi = 2
+        self.assertEqual(sale.get_sale_subtotal(), 22)
+        item2.ipi_info.v_ipi = 0
+        check_totals()
+
+        # Items added directly to the sale, without add_sellable
+        self.create_sale_item(sale=sale)
+        check_totals()
+
+        # The totals are calculated again after a rollback to a savepoint
+        self.store.savepoint(u'totals')
+        item2.quantity = 10
+        check_totals()
+        self.store.rollback_to_savepoint(u'totals')
+        check_totals()
+
+    def test_get_items_totals_autoreload(self):
+        sale = self.create_sale()
+        item = sale.add_sellable(self.create_sellable(price=10), quantity=2)
+        self.assertEqual(sale.get_sale_subtotal(), 20)
+
+        # Simulate a change done by another store
+        self.store.execute("UPDATE sale_item SET quantity = 3 WHERE id = ?",
+                           (item.id, ))
+        self.store.autoreload(item)
+        self.assertEqual(sale.get_sale_subtotal(), 30)
+        self.assertEqual(sale.get_items_total_quantity(), 3)
+
     def test_set_items_discount(self):
         sale = self.create_sale()
         sale_item1 = sale.add_sellable(self.store.find(Sellable, code=u'01').one())
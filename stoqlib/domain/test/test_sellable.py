@@ -35,8 +35,10 @@ from stoqlib.domain.product import Storable, StockTransactionHistory
 from stoqlib.domain.sale import Sale
 from stoqlib.domain.sellable import (Sellable,
                                      SellableCategory,
+                                     SellableCategoryTree,
                                      SellableUnit,
                                      SellableTaxConstant,
+                                     SellableLookupIndex,
                                      ClientCategoryPrice)
 from stoqlib.domain.taxes import ProductTaxTemplate, ProductIcmsTemplate
 from stoqlib.domain.test.domaintest import DomainTest
@@ -942,3 +944,149 @@ class TestSellable(DomainTest):
         for prop in props:
             # Checking that all attributes have the same value
             self.assertEqual(getattr(sellable, prop), getattr(new_sellable, prop))
+
+    def test_find_by_any_code(self):
+        sellable1 = self.create_sellable()
+        sellable1.barcode = u'AnyCode1'
+        sellable2 = self.create_sellable(code=u'anycode1', storable=True)
+        sellable3 = self.create_sellable(storable=True)
+        batch = self.create_storable_batch(
+            storable=sellable3.product_storable, batch_number=u'ANYCODE1')
+
+        self.assertEqual(Sellable.find_by_any_code(self.store, u'anyCode1'),
+                         [(sellable1, None), (sellable2, None),
+                          (sellable3, batch)])
+        self.assertEqual(Sellable.find_by_any_code(self.store, u'AnyCode2'), [])
+
+    def test_resolve_prices(self):
+        branch = self.create_branch()
+        category = self.create_client_category()
+        sellable1 = self.create_sellable(price=10)
+        sellable2 = self.create_sellable(price=20)
+        sellable2.on_sale_price = 15
+        sellable3 = self.create_sellable(price=30)
+        self.create_client_category_price(category=category,
+                                          sellable=sellable3, price=25)
+        override = self.create_sellable_branch_override(sellable=sellable1,
+                                                        branch=branch)
+        override.status = Sellable.STATUS_CLOSED
+        override.requires_kitchen_production = True
+        sellables = [sellable1, sellable2, sellable3]
+
+        self.assertEqual(Sellable.resolve_prices(self.store, []), {})
+        resolved = Sellable.resolve_prices(self.store, sellables,
+                                           branch=branch, category=category)
+        self.assertEqual(set(resolved), set(s.id for s in sellables))
+        for sellable in sellables:
+            info = resolved[sellable.id]
+            self.assertEqual(info.sellable, sellable)
+            self.assertEqual(info.price,
+                             sellable.get_price_for_category(category))
+            self.assertEqual(info.status == Sellable.STATUS_AVAILABLE,
+                             sellable.is_available(branch))
+            self.assertEqual(info.requires_kitchen_production,
+                             sellable.get_requires_kitchen_production(branch))
+
+        self.assertTrue(resolved[sellable2.id].is_on_sale)
+        self.assertEqual(resolved[sellable3.id].category_price.price, 25)
+
+        # Without the branch, the overrides are not applied
+        resolved = Sellable.resolve_prices(self.store, sellables)
+        self.assertEqual(resolved[sellable1.id].status,
+                         Sellable.STATUS_AVAILABLE)
+        self.assertEqual(resolved[sellable3.id].price, 30)
+
+
+class TestSellableLookupIndex(DomainTest):
+
+    def test_find_sellable_and_batch(self):
+        index = SellableLookupIndex()
+        sellable = self.store.find(Sellable, Sellable.barcode != u'').any()
+        # The store has no changes, so the index can be used
+        self.assertEqual(
+            index.find_sellable_and_batch(self.store, sellable.barcode.upper()),
+            (sellable, None))
+        self.assertTrue(index._is_warm)
+        self.assertEqual(
+            index.find_sellable_and_batch(self.store, sellable.code),
+            (sellable, None))
+        self.assertEqual(
+            index.find_sellable_and_batch(self.store, u'missing barcode'),
+            (None, None))
+        self.assertEqual(
+            index.find_sellable_and_batch(self.store, sellable.barcode,
+                                          is_valid=lambda s: False),
+            (None, None))
+
+        # Uncommitted objects are not on the index, but should be found
+        new_sellable = self.create_sellable(storable=True)
+        new_sellable.barcode = u'LookupBarcode'
+        batch = self.create_storable_batch(
+            storable=new_sellable.product_storable, batch_number=u'LookupBatch')
+        self.assertEqual(
+            index.find_sellable_and_batch(self.store, u'lookupbarcode'),
+            (new_sellable, None))
+        self.assertEqual(
+            index.find_sellable_and_batch(self.store, u'lookupbatch'),
+            (new_sellable, batch))
+
+    def test_on_notification(self):
+        index = SellableLookupIndex()
+        sellable = self.store.find(Sellable, Sellable.barcode != u'').any()
+        index.warm_up(self.store)
+
+        # Simulate a change done by another station
+        self.store.execute("UPDATE sellable SET barcode = 'NotifiedBarcode' "
+                           "WHERE id = ?", (sellable.id, ))
+        self.store.invalidate(sellable)
+        index._on_notification('update_te', sellable.te_id, u'sellable')
+        self.assertEqual(
+            index.find_sellable_and_batch(self.store, u'notifiedbarcode'),
+            (sellable, None))
+
+
+class TestSellableCategoryTree(DomainTest):
+
+    def test_get_path(self):
+        tree = SellableCategoryTree.get_instance()
+        tree.invalidate()
+        self.addCleanup(tree.invalidate)
+
+        base_id = self._insert_category(u'Base', markup=10, commission=5)
+        child_id = self._insert_category(u'Child', base_id)
+        leaf_id = self._insert_category(u'Leaf', child_id, markup=0)
+        base, child, leaf = [self.store.get(SellableCategory, id_)
+                             for id_ in [base_id, child_id, leaf_id]]
+
+        self.assertEqual([node.id for node in tree.get_path(self.store, leaf)],
+                         [leaf_id, child_id, base_id])
+        self.assertEqual(tree.get_descendants(self.store, base),
+                         set([child_id, leaf_id]))
+        self.assertEqual(tree.get_descendants(self.store, leaf), set())
+        self.assertEqual(leaf.full_description, u'Base:Child:Leaf')
+        self.assertEqual(leaf.get_markup(), 0)
+        self.assertEqual(child.get_markup(), 10)
+        self.assertEqual(leaf.get_commission(), 5)
+        self.assertEqual(leaf.get_tax_constant(), None)
+        self.assertEqual(base.get_children_recursively(), set([child, leaf]))
+
+        # Simulate a change done by another station
+        self.store.execute("UPDATE sellable_category SET description = 'Other' "
+                           "WHERE id = ?", (base_id, ))
+        self.store.invalidate(base)
+        tree._on_notification('update_te', base.te_id, u'sellable_category')
+        self.assertEqual(leaf.full_description, u'Other:Child:Leaf')
+
+        # The tree can't see the changes that were not committed yet
+        leaf.description = u'Changed'
+        self.assertIsNone(tree.get_path(self.store, leaf))
+        self.assertEqual(leaf.full_description, u'Other:Child:Changed')
+
+    def _insert_category(self, description, parent_id=None, markup=None,
+                         commission=0):
+        # Insert it directly, like another station would, so the store
+        # has no changes and can use the tree
+        return self.store.execute(
+            "INSERT INTO sellable_category (description, category_id, "
+            "suggested_markup, salesperson_commission) VALUES (?, ?, ?, ?) "
+            "RETURNING id", (description, parent_id, markup, commission)).get_one()[0]
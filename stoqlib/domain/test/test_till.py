@@ -178,6 +178,47 @@ class TestTill(DomainTest):
         till.add_credit_entry(currency(5), u"")
         self.assertEqual(till.get_debits_total(), old - 10)
 
+    def test_get_totals(self):
+        till = Till(store=self.store,
+                    branch=self.current_branch,
+                    station=self.create_station())
+        till.open_till(self.current_user)
+        till.initial_cash_amount = currency(100)
+
+        totals = till.get_totals()
+        self.assertEqual(totals, (100, 100, 0, 0))
+
+        till.add_credit_entry(currency(10), u"")
+        till.add_debit_entry(currency(5), u"")
+        till.add_entry(self._create_inpayment())
+        till.add_entry(self._create_outpayment())
+        totals = till.get_totals()
+        self.assertEqual(totals.balance, till.initial_cash_amount + 5)
+        self.assertEqual(totals.cash_amount, till.initial_cash_amount + 5)
+        self.assertEqual(totals.credits_total, 20)
+        self.assertEqual(totals.debits_total, -15)
+        self.assertEqual(totals, (till.get_balance(), till.get_cash_amount(),
+                                  till.get_credits_total(),
+                                  till.get_debits_total()))
+
+    def test_get_entries_totals(self):
+        till = Till(store=self.store,
+                    branch=self.current_branch,
+                    station=self.create_station())
+        till.open_till(self.current_user)
+        self.assertEqual(till.get_entries_totals(), [])
+
+        till.add_credit_entry(currency(10), u"")
+        till.add_debit_entry(currency(5), u"")
+        till.add_entry(self._create_inpayment())
+        till.add_entry(self._create_inpayment())
+        till.add_entry(self._create_outpayment())
+        bill = PaymentMethod.get_by_name(self.store, u'bill')
+        self.assertEqual(sorted(till.get_entries_totals(),
+                                key=lambda row: row[0] or ''),
+                         [(None, None, None, 10, -5),
+                          (bill.id, None, None, 20, -10)])
+
     def test_till_open_yesterday(self):
         yesterday = localnow() - datetime.timedelta(1)
 
@@ -373,3 +414,6 @@ class TestTillSummary(DomainTest):
 
         card_summary = [i for i in summary if i.method.method_name == 'card'][0]
         self.assertEqual(card_summary.description, 'Card VISA Credit')
+        self.assertEqual(card_summary.system_value, payment.value)
+        money_summary = [i for i in summary if i.method.method_name == 'money'][0]
+        self.assertEqual(money_summary.system_value, 0)
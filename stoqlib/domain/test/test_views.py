@@ -309,17 +309,37 @@ class TestProductFullStockView(DomainTest):
 
         results = ProductFullStockView.find_by_branch(self.store, branch)
         self.assertTrue(list(results))
-        # FIXME: Storm does not support count() with group_by
-        # self.assertEqual(results.count(), 1)
         # The results should have 11 items. 10 for the products that already
         # exists, and 1 more for the one we created
-        self.assertEqual(len(list(results)), 11)
+        self.assertEqual(results.count(), 11)
 
         results = ProductFullStockView.find_by_branch(self.store, branch)
         results = results.find(ProductFullStockView.product_id == p1.id)
         self.assertTrue(list(results))
         self.assertEqual(len(list(results)), 1)
 
+    def test_stock(self):
+        branch1 = self.create_branch()
+        branch2 = self.create_branch()
+        product = self.create_product(branch=branch1, stock=2)
+        storable = product.storable
+        storable.increase_stock(3, branch2, StockTransactionHistory.TYPE_INITIAL,
+                                None, self.current_user, unit_cost=10)
+        storable.decrease_stock(1, branch1, StockTransactionHistory.TYPE_INITIAL,
+                                None, self.current_user)
+
+        def get_view(branch):
+            return ProductFullStockView.find_by_branch(self.store, branch).find(
+                ProductFullStockView.product_id == product.id).one()
+
+        self.assertEqual(get_view(branch1).stock, 1)
+        self.assertEqual(get_view(branch2).stock, 3)
+        self.assertEqual(get_view(None).stock, 4)
+        self.assertEqual(get_view(None).total_stock_cost,
+                         sum(item.quantity * item.stock_cost
+                             for item in storable.get_stock_items()))
+        self.assertEqual(get_view(self.create_branch()).stock, 0)
+
     def test_post_search_callback(self):
         self.clean_domain([StockTransactionHistory, ProductSupplierInfo, ProductStockItem,
                            Storable, Product])
@@ -339,7 +359,7 @@ class TestProductFullStockView(DomainTest):
             # Total stock = (10 * 10) + (20 * 5) = 200
             self.store.execute(postresults[1]).get_one(), (30, 200))
 
-        sresults.having(ProductFullStockView.stock > 5)
+        sresults = sresults.find(ProductFullStockView.stock > 5)
         postresults = ProductFullStockView.post_search_callback(sresults)
         self.assertEqual(postresults[0], ('count', 'sum'))
         self.assertEqual(
@@ -291,6 +291,31 @@ class TestWorkOrder(DomainTest):
         workorder.add_sellable(self.create_sellable(), quantity=quantity, price=2)
         self.assertEqual(workorder.get_total_amount(), Decimal('2.10'))
 
+    def test_is_items_totally_reserved(self):
+        workorder = self.create_workorder()
+        self.assertTrue(workorder.is_items_totally_reserved())
+
+        product = self.create_product(stock=10, branch=workorder.branch)
+        item = workorder.add_sellable(product.sellable, quantity=5)
+        workorder.add_sellable(self.create_sellable(product=False), quantity=2)
+        self.assertFalse(workorder.is_items_totally_reserved())
+
+        item.reserve(self.current_user, 3)
+        self.assertFalse(workorder.is_items_totally_reserved())
+        item.reserve(self.current_user, 2)
+        self.assertTrue(workorder.is_items_totally_reserved())
+
+        item.quantity = 6
+        self.assertFalse(workorder.is_items_totally_reserved())
+        product.manage_stock = False
+        self.assertTrue(workorder.is_items_totally_reserved())
+        product.manage_stock = True
+
+        workorder.remove_item(item, self.current_user)
+        self.assertTrue(workorder.is_items_totally_reserved())
+        view = self.store.find(WorkOrderView, id=workorder.id).one()
+        self.assertEqual(view.quantity, 2)
+
     def test_status_str(self):
         workorder = self.create_workorder()
         for status, status_str in WorkOrder.statuses.items():
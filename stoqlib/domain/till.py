@@ -30,11 +30,12 @@ import collections
 import logging
 
 from kiwi.currency import currency
-from storm.expr import And, Eq, Join, LeftJoin, Or
+from storm.expr import And, Eq, Join, LeftJoin, Or, Sum
 from storm.info import ClassAlias
 from storm.references import Reference, ReferenceSet
 
-from stoqlib.database.expr import Date, TransactionTimestamp
+from stoqlib.database.expr import Case, Date, TransactionTimestamp
+from stoqlib.database.prepared import PreparedQuery
 from stoqlib.database.properties import (PriceCol, DateTimeCol, UnicodeCol,
                                          IdentifierCol, IdCol, EnumCol)
 from stoqlib.database.viewable import Viewable
@@ -55,6 +56,11 @@ _ = stoqlib_gettext
 
 log = logging.getLogger(__name__)
 
+#: The totals of a |till|, as returned by :meth:`Till.get_totals`
+_TillTotals = collections.namedtuple(
+    '_TillTotals', ['balance', 'cash_amount', 'credits_total',
+                    'debits_total'])
+
 #
 # Domain Classes
 #
@@ -157,7 +163,7 @@ class Till(IdentifiableDomain):
         """
         assert station is not None
 
-        till = store.find(cls, status=Till.STATUS_OPEN, station=station).one()
+        till = _current_till.one(store, station.id)
         if till and till.needs_closing():
             fmt = _("You need to close the till opened at %s before "
                     "doing any fiscal operations")
@@ -309,14 +315,44 @@ class Till(IdentifiableDomain):
 
         return True
 
+    def get_totals(self):
+        """Calculates all the totals of this till at once
+
+        This is the same as calling :meth:`.get_balance`,
+        :meth:`.get_cash_amount`, :meth:`.get_credits_total` and
+        :meth:`.get_debits_total`, but with a single query.
+
+        :returns: a namedtuple with the ``balance``, ``cash_amount``,
+          ``credits_total`` and ``debits_total``
+        """
+        store = self.store
+        money = PaymentMethod.get_by_name(store, u'money')
+
+        value = TillEntry.value
+        is_cash = Or(Eq(TillEntry.payment_id, None),
+                     Payment.method_id == money.id)
+        join = LeftJoin(Payment, Payment.id == TillEntry.payment_id)
+        results = store.using(TillEntry, join).find(
+            (Sum(value),
+             Sum(Case(is_cash, value, 0)),
+             Sum(Case(value > 0, value, 0)),
+             Sum(Case(value < 0, value, 0))),
+            TillEntry.till_id == self.id)
+        total, cash, credits, debits = results.one()
+
+        return _TillTotals(
+            balance=currency(self.initial_cash_amount + (total or 0)),
+            cash_amount=currency(self.initial_cash_amount + (cash or 0)),
+            credits_total=currency(credits or 0),
+            debits_total=currency(debits or 0))
+
     def get_balance(self):
         """Returns the balance of all till operations plus the initial amount
         cash amount.
         :returns: the balance
         :rtype: currency
         """
-        total = self.get_entries().sum(TillEntry.value) or 0
-        return currency(self.initial_cash_amount + total)
+        return self.get_totals().balance
 
     def get_cash_amount(self):
         """Returns the total cash amount on the till. That includes "extra"
@@ -325,18 +361,7 @@ class Till(IdentifiableDomain):
         :returns: the cash amount on the till
         :rtype: currency
         """
-        store = self.store
-        money = PaymentMethod.get_by_name(store, u'money')
-
-        clause = And(Or(Eq(TillEntry.payment_id, None),
-                        Payment.method_id == money.id),
-                     TillEntry.till_id == self.id)
-
-        join = LeftJoin(Payment, Payment.id == TillEntry.payment_id)
-        results = store.using(TillEntry, join).find(TillEntry, clause)
-
-        return currency(self.initial_cash_amount +
-                        (results.sum(TillEntry.value) or 0))
+        return self.get_totals().cash_amount
 
     def get_entries(self):
         """Fetches all the entries related to this till
@@ -345,25 +370,48 @@ class Till(IdentifiableDomain):
         """
         return self.store.find(TillEntry, till=self)
 
+    def get_entries_totals(self):
+        """Calculates the totals of the entries of this till by payment method
+
+        The entries are grouped by the |paymentmethod|, the |creditprovider|
+        and the card type of their |payments| using a single query.
+
+        :returns: a list of tuples with the method id, the provider id,
+          the card type, the total of the credit entries and the total
+          of the debit entries. The ids and the card type are ``None`` for
+          the entries without a payment (e.g. cash advances) and the provider
+          id and card type are ``None`` for the payments that were not made
+          with a card
+        """
+        value = TillEntry.value
+        tables = [TillEntry,
+                  LeftJoin(Payment, Payment.id == TillEntry.payment_id),
+                  LeftJoin(CreditCardData,
+                           CreditCardData.payment_id == Payment.id)]
+        group = (Payment.method_id, CreditCardData.provider_id,
+                 CreditCardData.card_type)
+        results = self.store.using(*tables).find(
+            group + (Sum(Case(value > 0, value, 0)),
+                     Sum(Case(value < 0, value, 0))),
+            TillEntry.till_id == self.id)
+        return [(method_id, provider_id, card_type,
+                 currency(credits), currency(debits))
+                for method_id, provider_id, card_type, credits, debits
+                in results.group_by(*group)]
+
     def get_credits_total(self):
         """Calculates the total credit for all entries in this till
         :returns: total credit
         :rtype: currency
         """
-        results = self.store.find(
-            TillEntry, And(TillEntry.value > 0,
-                           TillEntry.till_id == self.id))
-        return currency(results.sum(TillEntry.value) or 0)
+        return self.get_totals().credits_total
 
     def get_debits_total(self):
         """Calculates the total debit for all entries in this till
         :returns: total debit
         :rtype: currency
         """
-        results = self.store.find(
-            TillEntry, And(TillEntry.value < 0,
-                           TillEntry.till_id == self.id))
-        return currency(results.sum(TillEntry.value) or 0)
+        return self.get_totals().debits_total
 
     # FIXME: Rename to create_day_summary
     def get_day_summary(self):
@@ -373,26 +421,21 @@ class Till(IdentifiableDomain):
         will save the values all payment methods used.
         """
         money_method = PaymentMethod.get_by_name(self.store, u'money')
-        day_history = {}
-        # Keys are (method, provider, card_type), provider and card_type may be None if
-        # payment was not with card
-        day_history[(money_method, None, None)] = 0
-
-        for entry in self.get_entries():
-            provider = card_type = None
-            payment = entry.payment
-            method = payment.method if payment else money_method
-            if payment and payment.card_data:
-                provider = payment.card_data.provider
-                card_type = payment.card_data.card_type
-
-            key = (method, provider, card_type)
+        day_history = collections.OrderedDict()
+        # Keys are (method_id, provider_id, card_type), provider_id and card_type may
+        # be None if payment was not with card
+        day_history[(money_method.id, None, None)] = 0
+
+        for (method_id, provider_id, card_type,
+             credits, debits) in self.get_entries_totals():
+            key = (method_id or money_method.id, provider_id, card_type)
             day_history.setdefault(key, 0)
-            day_history[key] += entry.value
+            day_history[key] += credits + debits
 
         summary = []
-        for (method, provider, card_type), value in day_history.items():
-            summary.append(TillSummary(till=self, method=method, provider=provider,
+        for (method_id, provider_id, card_type), value in day_history.items():
+            summary.append(TillSummary(till=self, method_id=method_id,
+                                       provider_id=provider_id,
                                        card_type=card_type, system_value=value))
         return summary
 
@@ -416,6 +459,11 @@ class Till(IdentifiableDomain):
                          store=self.store)
 
 
+_current_till = PreparedQuery(
+    Till, lambda station_id: And(Till.status == Till.STATUS_OPEN,
+                                 Till.station_id == station_id))
+
+
 class TillEntry(IdentifiableDomain):
     """A TillEntry is a representing cash added or removed in a |till|.
      * A positive value represents addition.
@@ -32,7 +32,7 @@ from storm.info import ClassAlias
 from stoqlib.database.expr import (Case, Distinct, Field, NullIf,
                                    StatementTimestamp, Date, Concat, Round)
 from stoqlib.database.viewable import Viewable
-from stoqlib.domain.account import Account, AccountTransaction
+from stoqlib.domain.account import Account, AccountBalance
 from stoqlib.domain.address import Address
 from stoqlib.domain.commission import CommissionSource
 from stoqlib.domain.costcenter import CostCenterEntry
@@ -48,7 +48,8 @@ from stoqlib.domain.product import (Product,
                                     ProductManufacturer,
                                     ProductSupplierInfo,
                                     StockTransactionHistory,
-                                    Storable, StorableBatch)
+                                    Storable, StorableBatch,
+                                    StorableStockSummary)
 from stoqlib.domain.production import ProductionOrder, ProductionItem
 from stoqlib.domain.purchase import (Quotation, QuoteGroup, PurchaseOrder,
                                      PurchaseItem)
@@ -92,6 +93,22 @@ _price_search = Case(
     else_=Sellable.base_price)
 
 
+def _replace_stock_summary_join(tables, *conditions):
+    # Returns a copy of tables (from ProductFullStockView or a subclass)
+    # joining the StorableStockSummary on conditions instead
+    tables = tables[:]
+    for i, table in enumerate(tables):
+        if isinstance(table, JoinExpr) and table.right is StorableStockSummary:
+            tables[i] = LeftJoin(
+                StorableStockSummary,
+                And(StorableStockSummary.storable_id == Storable.id,
+                    *conditions))
+            return tables
+
+    raise AssertionError(  # pragma nocoverage
+        "Did not find StorableStockSummary join")
+
+
 class ProductFullStockView(Viewable):
     """Stores information about products.
     This view is used to query stock information on a certain branch.
@@ -109,8 +126,7 @@ class ProductFullStockView(Viewable):
     :cvar stock: the stock of the product
      """
 
-    # We need to store the Branch.id for the get_parent method, but we don't
-    # want it on the result as it would break the aggregation.
+    # We need to store the Branch.id for the get_parent method
     _branch_id = None
 
     sellable = Sellable
@@ -151,16 +167,19 @@ class ProductFullStockView(Viewable):
     category_description = SellableCategory.description
     unit = SellableUnit.description
 
-    # Aggregates
-    total_stock_cost = Coalesce(Sum(ProductStockItem.quantity *
-                                    ProductStockItem.stock_cost), 0)
-    stock = Coalesce(Sum(ProductStockItem.quantity), 0)
+    # Stock (kept summarized by the database, so there's no need to
+    # aggregate the stock items here)
+    total_stock_cost = Coalesce(StorableStockSummary.total_cost, 0)
+    stock = Coalesce(StorableStockSummary.quantity, 0)
 
     tables = [
         Sellable,
         Join(Product, Product.id == Sellable.id),
         LeftJoin(Storable, Storable.id == Product.id),
-        LeftJoin(ProductStockItem, ProductStockItem.storable_id == Storable.id),
+        # The stock on all the branches. See find_by_branch
+        LeftJoin(StorableStockSummary,
+                 And(StorableStockSummary.storable_id == Storable.id,
+                     Eq(StorableStockSummary.branch_id, None))),
         LeftJoin(SellableTaxConstant,
                  SellableTaxConstant.id == Sellable.tax_constant_id),
         LeftJoin(SellableCategory, SellableCategory.id == Sellable.category_id),
@@ -172,8 +191,6 @@ class ProductFullStockView(Viewable):
     ]
 
     clause = Sellable.status != Sellable.STATUS_CLOSED
-    group_by = [id, product_id, storable_id, category_description,
-                manufacturer, tax_description, unit, image_id]
 
     __hash__ = Viewable.__hash__
 
@@ -202,25 +219,14 @@ class ProductFullStockView(Viewable):
         if branch is None:
             return store.find(cls)
 
-        # Highjack the class being queried, since we need to add the branch
-        # on the ProductStockItem join to filter it.
+        # Highjack the class being queried, since we need to join the stock
+        # summary of the branch instead of the one of all the branches.
         # Make sure to create it only once or else Viewable would fail to
         # compare both objects as their class would be different.
         hv = cls.highjacked.get(branch.id, None)
         if hv is None:
-            tables = cls.tables[:]
-            for i, table in enumerate(tables):
-                if not isinstance(table, JoinExpr):
-                    continue
-                if table.right is ProductStockItem:
-                    tables[i] = LeftJoin(
-                        ProductStockItem,
-                        And(ProductStockItem.storable_id == Storable.id,
-                            ProductStockItem.branch_id == branch.id))
-                    break
-            else:  # pragma nocoverage
-                raise AssertionError("Did not find ProductStockItem join")
-
+            tables = _replace_stock_summary_join(
+                cls.tables, StorableStockSummary.branch_id == branch.id)
             hv = type(
                 "Highjacked%s" % (cls.__name__, ),
                 (cls, ),
@@ -311,7 +317,8 @@ class ProductWithStockView(ProductFullStockView):
     :cvar stock: the stock of the product
      """
 
-    having = ProductFullStockView.stock > 0
+    clause = And(ProductFullStockView.clause,
+                 ProductFullStockView.stock > 0)
 
 
 class ProductWithStockBranchView(ProductFullStockView):
@@ -322,17 +329,19 @@ class ProductWithStockBranchView(ProductFullStockView):
     filter, otherwise, the results may be duplicated (once for each branch in
     the database)
     """
-    branch_id = ProductStockItem.branch_id
+    branch_id = StorableStockSummary.branch_id
     minimum_quantity = Storable.minimum_quantity
     maximum_quantity = Storable.maximum_quantity
 
+    # The stock on each branch, instead of on all of them
+    tables = _replace_stock_summary_join(
+        ProductFullStockView.tables,
+        Ne(StorableStockSummary.branch_id, None))
+
     clause = And(ProductFullStockView.clause,
                  Eq(Product.is_grid, False),
                  Eq(Product.is_package, False))
 
-    group_by = ProductFullStockView.group_by[:]
-    group_by.append(branch_id)
-
 
 # This subselect should query only from PurchaseItem, otherwise, more one
 # product may appear more than once in the results (if there are purchase
@@ -349,11 +358,8 @@ _PurchaseItemTotal = Select(
 
 
 class ProductFullStockItemView(ProductFullStockView):
-    # ProductFullStockView already joins with a 1 to Many table (Sellable
-    # with ProductStockItem).
-    #
-    # This is why we must join PurchaseItem (another 1 to many table) in a
-    # subquery
+    # PurchaseItem is a 1 to many table, so we must join it in a subquery
+    # to not repeat the products in the results
 
     minimum_quantity = Storable.minimum_quantity
     maximum_quantity = Storable.maximum_quantity
@@ -369,9 +375,6 @@ class ProductFullStockItemView(ProductFullStockView):
     clause = And(ProductFullStockView.clause,
                  Eq(Product.is_grid, False))
 
-    group_by = ProductFullStockView.group_by[:]
-    group_by.append(to_receive_quantity)
-
 
 class ProductFullStockItemSupplierView(ProductFullStockItemView):
     """ Just like ProductFullStockView, but will also be joined with
@@ -1432,17 +1435,12 @@ class LoanItemView(Viewable):
     ]
 
 
-_SourceSum = Select(
-    columns=[AccountTransaction.source_account_id,
-             Alias(Sum(AccountTransaction.value), 'value')],
-    tables=[AccountTransaction],
-    group_by=[AccountTransaction.source_account_id])
-
-_DestSum = Select(
-    columns=[AccountTransaction.account_id,
-             Alias(Sum(AccountTransaction.value), 'value')],
-    tables=[AccountTransaction],
-    group_by=[AccountTransaction.account_id])
+_BalanceSum = Select(
+    columns=[AccountBalance.account_id,
+             Alias(Sum(AccountBalance.incoming), 'incoming'),
+             Alias(Sum(AccountBalance.outgoing), 'outgoing')],
+    tables=[AccountBalance],
+    group_by=[AccountBalance.account_id])
 
 
 class AccountView(Viewable):
@@ -1456,15 +1454,13 @@ class AccountView(Viewable):
     description = Account.description
     code = Account.code
 
-    source_value = Field('source_sum', 'value')
-    dest_value = Field('dest_sum', 'value')
+    source_value = Field('balance_sum', 'outgoing')
+    dest_value = Field('balance_sum', 'incoming')
 
     tables = [
         Account,
-        LeftJoin(Alias(_SourceSum, 'source_sum'),
-                 Field('source_sum', 'source_account_id') == Account.id),
-        LeftJoin(Alias(_DestSum, 'dest_sum'),
-                 Field('dest_sum', 'account_id') == Account.id),
+        LeftJoin(Alias(_BalanceSum, 'balance_sum'),
+                 Field('balance_sum', 'account_id') == Account.id),
     ]
 
     @property
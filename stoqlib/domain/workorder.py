@@ -35,7 +35,7 @@ from storm.info import ClassAlias
 from storm.references import Reference, ReferenceSet
 from zope.interface import implementer
 
-from stoqlib.database.expr import Field, NullIf, Concat, Round
+from stoqlib.database.expr import Field, NullIf, Concat
 from stoqlib.database.properties import (IntCol, DateTimeCol, UnicodeCol,
                                          PriceCol, DecimalCol, QuantityCol,
                                          IdentifierCol, IdCol, BoolCol, EnumCol)
@@ -50,11 +50,10 @@ from stoqlib.domain.events import (SaleStatusChangedEvent,
 from stoqlib.domain.interfaces import IDescribable
 from stoqlib.domain.person import (Branch, Client, Person, SalesPerson,
                                    Company, LoginUser, Employee)
-from stoqlib.domain.product import Product, StockTransactionHistory
+from stoqlib.domain.product import StockTransactionHistory
 from stoqlib.domain.sale import Sale
 from stoqlib.domain.sellable import Sellable
 from stoqlib.lib.dateutils import localnow, localtoday
-from stoqlib.lib.defaults import DECIMAL_PRECISION
 from stoqlib.lib.translation import stoqlib_gettext
 
 _ = stoqlib_gettext
@@ -745,10 +744,7 @@ class WorkOrder(IdentifiableDomain):
             sum(item.total for item in :obj:`.order_items`)
 
         """
-        items = self.order_items.find()
-        return (items.sum(Round(WorkOrderItem.price * WorkOrderItem.quantity,
-                                DECIMAL_PRECISION))
-                or currency(0))
+        return currency(self._get_summary_value(WorkOrderSummary.total) or 0)
 
     def add_sellable(self, sellable, price=None, quantity=1, batch=None):
         """Adds a sellable to this work order
@@ -786,15 +782,8 @@ class WorkOrder(IdentifiableDomain):
 
         :returns: ``True`` if all is synchronized, ``False`` otherwise
         """
-        tables = [WorkOrderItem,
-                  Join(Sellable, WorkOrderItem.sellable_id == Sellable.id),
-                  LeftJoin(Product, Product.id == Sellable.id)]
-        # Only products that manage stock should be checked for quantity_decreased
-        return self.store.using(*tables).find(
-            WorkOrderItem,
-            And(WorkOrderItem.order_id == self.id,
-                WorkOrderItem.quantity_decreased != WorkOrderItem.quantity,
-                Eq(Product.manage_stock, True))).is_empty()
+        # Only products that manage stock are checked for quantity_decreased
+        return not self._get_summary_value(WorkOrderSummary.unreserved_items)
 
     def is_in_transport(self):
         """Checks if this work order is in transport
@@ -1220,6 +1209,12 @@ class WorkOrder(IdentifiableDomain):
     #  Private
     #
 
+    def _get_summary_value(self, column):
+        # The summary is updated by the database, so the cached
+        # WorkOrderSummary object could have old values
+        return self.store.find(column,
+                               WorkOrderSummary.work_order_id == self.id).one()
+
     def _change_status(self, new_status, user: LoginUser, notes=None):
         self.store.savepoint('before_change_status')
         old_status = self.status
@@ -1324,16 +1319,31 @@ class WorkOrderHistory(Domain):
                    old_value=old_value, new_value=new_value, notes=notes)
 
 
-_WorkOrderItemsSummary = Alias(Select(
-    columns=[
-        WorkOrderItem.order_id,
-        Alias(Sum(WorkOrderItem.quantity), 'quantity'),
-        Alias(Sum(Round(WorkOrderItem.quantity * WorkOrderItem.price,
-                        DECIMAL_PRECISION)),
-              'total')],
-    tables=[WorkOrderItem],
-    group_by=[WorkOrderItem.order_id]),
-    '_work_order_items')
+class WorkOrderSummary(Domain):
+    """The summary of the |workorderitems| of a |workorder|
+
+    This is kept updated by the database every time an item of the work
+    order gets added, changed, reserved or removed, so the work order
+    views don't need to aggregate all the items. It should not be
+    changed manually.
+    """
+
+    __storm_table__ = 'work_order_summary'
+
+    work_order_id = IdCol()
+
+    #: the |workorder|
+    work_order = Reference(work_order_id, 'WorkOrder.id')
+
+    #: the sum of the items quantities
+    quantity = QuantityCol(default=0)
+
+    #: the sum of the items totals
+    total = PriceCol(default=0)
+
+    #: the number of items of products that manage stock which were not
+    #: totally reserved yet
+    unreserved_items = IntCol(default=0)
 
 
 class WorkOrderView(Viewable):
@@ -1417,9 +1427,9 @@ class WorkOrderView(Viewable):
     # Sellable
     sellable = Sellable.description
 
-    # WorkOrderItem
-    quantity = Coalesce(Field('_work_order_items', 'quantity'), 0)
-    total = Coalesce(Field('_work_order_items', 'total'), 0)
+    # WorkOrderSummary
+    quantity = Coalesce(WorkOrderSummary.quantity, 0)
+    total = Coalesce(WorkOrderSummary.total, 0)
 
     tables = [
         WorkOrder,
@@ -1462,8 +1472,8 @@ class WorkOrderView(Viewable):
         LeftJoin(WorkOrderCategory,
                  WorkOrder.category_id == WorkOrderCategory.id),
 
-        LeftJoin(_WorkOrderItemsSummary,
-                 Field('_work_order_items', 'order_id') == WorkOrder.id),
+        LeftJoin(WorkOrderSummary,
+                 WorkOrderSummary.work_order_id == WorkOrder.id),
     ]
 
     @property
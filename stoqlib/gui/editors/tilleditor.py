@@ -38,6 +38,7 @@ from stoqlib.domain.account import AccountTransaction
 from stoqlib.domain.events import (TillOpenEvent, TillCloseEvent,
                                    TillAddTillEntryEvent,
                                    TillAddCashEvent, TillRemoveCashEvent)
+from stoqlib.domain.payment.method import PaymentMethod
 from stoqlib.domain.person import Employee
 from stoqlib.domain.till import Till
 from stoqlib.exceptions import DeviceError, TillError
@@ -244,18 +245,21 @@ class TillClosingEditor(BaseEditor):
         day_history = {}
         day_history[_(u'Initial Amount')] = self.till.initial_cash_amount
 
-        for entry in self.till.get_entries():
-            payment = entry.payment
-            if payment is not None:
-                desc = payment.method.get_description()
+        for (method_id, provider_id, card_type,
+             credits, debits) in self.till.get_entries_totals():
+            if method_id is not None:
+                method = self.store.get(PaymentMethod, method_id)
+                values = [(method.get_description(), credits + debits)]
             else:
-                if entry.value > 0:
-                    desc = _(u'Cash In')
-                else:
-                    desc = _(u'Cash Out')
-
-            day_history.setdefault(desc, 0)
-            day_history[desc] += entry.value
+                values = []
+                if credits:
+                    values.append((_(u'Cash In'), credits))
+                if debits:
+                    values.append((_(u'Cash Out'), debits))
+
+            for desc, value in values:
+                day_history.setdefault(desc, 0)
+                day_history[desc] += value
 
         for description, value in day_history.items():
             yield Settable(description=description, system_value=value, user_value=0)
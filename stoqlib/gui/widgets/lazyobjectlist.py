@@ -28,6 +28,7 @@ from pygtkcompat.generictreemodel import GenericTreeModel
 from kiwi.datatypes import number
 from kiwi.ui.objectlist import empty_marker, ListLabel
 
+from stoqlib.lib.parameters import sysparam
 from stoqlib.lib.translation import stoqlib_gettext
 
 _ = stoqlib_gettext
@@ -64,13 +65,17 @@ class LazyObjectModel(GenericTreeModel, Gtk.TreeSortable):
 
     __gtype_name__ = 'LazyObjectModel'
 
-    def __init__(self, objectlist, result, executer, initial_count):
+    def __init__(self, objectlist, result, executer, initial_count,
+                 post_result_callback=None):
         """
         :param objectlist: a ObjectList
         :param result: a result set from ORM
         :param executer:
         :param initial_count: number of items to load the first time,
           this should at least be all visible rows
+        :param post_result_callback: if not ``None``, a callable that will
+          be called with the exact post result when the executer is
+          estimating it and it finally arrives
         """
         old_model = objectlist.get_model()
         self._objectlist = objectlist
@@ -80,6 +85,8 @@ class LazyObjectModel(GenericTreeModel, Gtk.TreeSortable):
         self._iters = []
         self._orig_result = result
         self._post_result = None
+        self._post_result_callback = post_result_callback
+        self._post_result_operation = None
         self._result = None
         self._values = []
         self.old_model = old_model
@@ -92,7 +99,16 @@ class LazyObjectModel(GenericTreeModel, Gtk.TreeSortable):
         self._load_result_set(result)
 
     def _load_result_set(self, result):
-        self._post_result = self._executer.get_post_result(result)
+        self._cancel_post_result_operation()
+        if self._executer.estimate_post_result:
+            # Start with an estimate, so we don't need to wait for the
+            # aggregates. The count will be updated when the exact
+            # post result arrives, see _on_exact_post_result
+            self._post_result = self._executer.get_estimated_post_result(result)
+            self._post_result_operation = self._executer.get_post_result_async(
+                result, self._on_exact_post_result)
+        else:
+            self._post_result = self._executer.get_post_result(result)
         if self._post_result is not None:
             count = self._post_result.count
         else:
@@ -227,6 +243,7 @@ class LazyObjectModel(GenericTreeModel, Gtk.TreeSortable):
     # Public API
 
     def clear(self):
+        self._cancel_post_result_operation()
         self._objectlist.set_model(self.old_model)
         self.old_model.clear()
 
@@ -251,25 +268,15 @@ class LazyObjectModel(GenericTreeModel, Gtk.TreeSortable):
         # If we moved the start value in the for above, also move the end value
         end = min(start + load_total, self._count)
 
-        column = self._objectlist.get_columns()[self._sort_column_id]
-        if hasattr(column, 'search_attribute'):
-            # Even if it's defined, it could be None
-            order_attr = column.search_attribute or column.attribute
-        else:
-            order_attr = column.attribute
-        self._result = self._executer.get_ordered_result(self._orig_result,
-                                                         order_attr)
+        order_attr = self._get_order_attribute()
+        descending = self._sort_order == Gtk.SortType.DESCENDING
 
-        if self._sort_order == Gtk.SortType.DESCENDING:
-            # Results should be reversed, so we need to invert the start and
-            # end values, and use the end of the list as a reference.
-            # This should be as easy as reversed(self._results[-end:-start])
-            # but storm does not support this.
-            start_ = self._count - end
-            end_ = self._count - start
-            results = reversed(list(self._result[start_:end_]))
+        if self._executer.supports_keyset_pagination(order_attr):
+            start, results = self._load_keyset_page(order_attr, descending,
+                                                    start, end)
         else:
-            results = list(self._result[start:end])
+            start, results = self._load_offset_page(order_attr, descending,
+                                                    start, end)
 
         has_loaded = False
         for i, item in enumerate(results, start):
@@ -290,6 +297,96 @@ class LazyObjectModel(GenericTreeModel, Gtk.TreeSortable):
     def get_post_data(self):
         return self._post_result
 
+    # Callbacks
+
+    def _on_exact_post_result(self, post_result):
+        self._post_result_operation = None
+        self._post_result = post_result
+        if post_result.count != self._count:
+            self._set_count(post_result.count)
+        if self._post_result_callback is not None:
+            self._post_result_callback(post_result)
+
+    # Private
+
+    def _cancel_post_result_operation(self):
+        if self._post_result_operation is not None:
+            self._post_result_operation.cancel()
+            self._post_result_operation = None
+
+    def _get_order_attribute(self):
+        column = self._objectlist.get_columns()[self._sort_column_id]
+        if hasattr(column, 'search_attribute'):
+            # Even if it's defined, it could be None
+            return column.search_attribute or column.attribute
+        return column.attribute
+
+    def _set_count(self, count):
+        old_count = self._count
+        if (self._sort_order == Gtk.SortType.DESCENDING and
+                not self._executer.supports_keyset_pagination(
+                    self._get_order_attribute())):
+            # The items were loaded using the count as a reference (see
+            # _load_offset_page), so they are not in the right place anymore
+            for i, value in enumerate(self._values):
+                if value is empty_marker:
+                    continue
+                self._values[i] = empty_marker
+                self.row_changed((i, ), self.create_tree_iter(i))
+
+        if count > old_count:
+            self._values.extend([empty_marker] * (count - old_count))
+            self._iters = list(range(0, count))
+            self._count = count
+            for i in range(old_count, count):
+                self.row_inserted((i, ), self.create_tree_iter(i))
+        elif count < old_count:
+            self._count = count
+            # Remove from the end so the paths of the other rows don't change
+            for i in reversed(range(count, old_count)):
+                self.row_deleted((i, ))
+            del self._values[count:]
+            self._iters = list(range(0, count))
+
+        self.load_items_from_results(0, self._initial_count)
+
+    def _load_keyset_page(self, order_attr, descending, start, end):
+        # Note that start may be the last item that is already loaded
+        if self._values[start] is not empty_marker:
+            start += 1
+        if start >= end:
+            return start, []
+
+        if start == 0 or self._values[start - 1] is not empty_marker:
+            # Continue from where the last page stopped. This will cost
+            # the same no matter how deep in the results we are
+            last_item = self._values[start - 1] if start else None
+            return start, self._executer.get_next_page(
+                self._orig_result, order_attr, last_item=last_item,
+                descending=descending, page_size=end - start)
+
+        # The user jumped to the middle of the results. Use an offset
+        # for this one, the next pages will be able to continue from it
+        self._result = self._executer.get_keyset_ordered_result(
+            self._orig_result, order_attr, descending)
+        return start, list(self._result[start:end])
+
+    def _load_offset_page(self, order_attr, descending, start, end):
+        self._result = self._executer.get_ordered_result(self._orig_result,
+                                                         order_attr)
+
+        if descending:
+            # Results should be reversed, so we need to invert the start and
+            # end values, and use the end of the list as a reference.
+            # This should be as easy as reversed(self._results[-end:-start])
+            # but storm does not support this.
+            start_ = self._count - end
+            end_ = self._count - start
+            results = reversed(list(self._result[start_:end_]))
+        else:
+            results = list(self._result[start:end])
+        return start, results
+
 
 class LazyObjectListUpdater(object):
     """This is a helper that updates the list automatically when you
@@ -327,11 +424,14 @@ class LazyObjectListUpdater(object):
         # Limits doesn't make sense when using lazy search, the idea
         # is to always show everything.
         self._executer.set_limit(-1)
+        self._executer.set_estimate_post_result(
+            sysparam.get_bool('ESTIMATE_SEARCH_SUMMARY'))
 
     def add_results(self, results):
-        self._model = LazyObjectModel(self._objectlist, results,
-                                      self._executer,
-                                      initial_count=self.INITIAL_ROWS)
+        self._model = LazyObjectModel(
+            self._objectlist, results, self._executer,
+            initial_count=self.INITIAL_ROWS,
+            post_result_callback=self._on_model__post_result)
         self._objectlist.set_model(self._model)
 
     def _load_result_set(self, start, end):
@@ -390,6 +490,11 @@ class LazyObjectListUpdater(object):
     def _on_resuls__sorting_changed(self, objectlist, attribute, sort_type):
         self._treeview.scroll_to_point(0, 0)
 
+    def _on_model__post_result(self, post_result):
+        summary_label = self._search.get_summary_label()
+        if summary_label is not None:
+            summary_label.update_total(post_result.sum)
+
 
 class LazySummaryLabel(ListLabel):
     __gtype_name__ = 'LazySummaryLabel'
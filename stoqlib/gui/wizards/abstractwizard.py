@@ -39,13 +39,13 @@ from kiwi.datatypes import ValidationError
 from kiwi.ui.objectlist import SummaryLabel
 from kiwi.utils import gsignal
 from kiwi.python import Settable
-from storm.expr import And, Lower
+from storm.expr import And
 
 from stoqlib.api import api
-from stoqlib.domain.sellable import Sellable
+from stoqlib.domain.sellable import Sellable, SellableLookupIndex
 from stoqlib.domain.payment.payment import Payment
 from stoqlib.domain.payment.group import PaymentGroup
-from stoqlib.domain.product import Product, StorableBatch
+from stoqlib.domain.product import Product
 from stoqlib.domain.sale import SaleItem
 from stoqlib.domain.workorder import WorkOrderItem
 from stoqlib.domain.service import ServiceView
@@ -670,34 +670,16 @@ class SellableItemSlave(BaseEditorSlave):
         """
         viewable, default_query = self.get_sellable_view_query()
 
-        # FIXME: Put this logic for getting the sellable based on
-        # barcode/code/batch_number on domain. Note that something very
-        # simular is done on POS app
-
-        # First try barcode, then code since there might be a product
-        # with a code equal to another product's barcode
-        for attr in [viewable.barcode, viewable.code]:
-            query = Lower(attr) == text.lower()
-            if default_query:
-                query = And(query, default_query)
-
-            result = self.store.find(viewable, query).one()
-            if result:
-                return result.sellable, None
-
-        # if none of the above worked, try to find by batch number
-        query = Lower(StorableBatch.batch_number) == text.lower()
-        batch = self.store.find(StorableBatch, query).one()
-        if batch:
-            sellable = batch.storable.product.sellable
+        def is_valid(sellable):
+            # Make sure the sellable is in the view
             query = viewable.id == sellable.id
             if default_query:
                 query = And(query, default_query)
-            # Make sure batch's sellable is in the view
-            if not self.store.find(viewable, query).is_empty():
-                return sellable, batch
+            return not self.store.find(viewable, query).is_empty()
 
-        return None, None
+        index = SellableLookupIndex.get_instance()
+        return index.find_sellable_and_batch(self.store, text,
+                                             is_valid=is_valid)
 
     def _get_sellable_and_batch(self):
         """This method always read the barcode and searches de database.
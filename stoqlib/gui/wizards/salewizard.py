@@ -41,6 +41,7 @@ from stoqlib.domain.payment.method import PaymentMethod
 from stoqlib.domain.payment.payment import Payment
 from stoqlib.domain.person import SalesPerson, Transporter, Person, Client
 from stoqlib.domain.sale import Sale, SaleComment
+from stoqlib.domain.sellable import Sellable
 from stoqlib.enums import CreatePaymentStatus, ChangeSalespersonPolicy
 from stoqlib.exceptions import SellError, StoqlibError, PaymentMethodError
 from stoqlib.lib.formatters import get_formatted_cost
@@ -952,9 +953,11 @@ class ConfirmSaleWizard(BaseWizard):
             run_dialog(MissingItemsDialog, self, self.model, missing)
             return False
 
-        for item in self.model.get_items():
-            sellable = item.sellable
-            if not sellable.is_available(self.model.branch):
+        sellables = [item.sellable for item in self.model.get_items()]
+        resolved = Sellable.resolve_prices(self.store, sellables,
+                                           branch=self.model.branch)
+        for sellable in sellables:
+            if resolved[sellable.id].status != Sellable.STATUS_AVAILABLE:
                 self.close()
                 warning(_("%s is not available for sale. Try making it "
                           "available first or change it on sale and then try again.") % (
@@ -28,22 +28,34 @@ of Tributary Planning)
 According to Law 12,741 of 12/08/2012 - Taxes in Coupon.
 """
 from collections import namedtuple
-
-from kiwi.environ import environ
-
 import csv
 from decimal import Decimal
+import glob
+import logging
+import os
+import sqlite3
+import threading
+
+from kiwi.environ import environ
 
-from stoqlib.database.runtime import get_current_branch, new_store
+from stoqlib.database.runtime import get_current_branch, get_default_store
 from stoqlib.lib.defaults import quantize
+from stoqlib.lib.osutils import get_application_dir
 from stoqlib.lib.parameters import sysparam
 
-taxes_data = {}
+log = logging.getLogger(__name__)
+
 TaxInfo = namedtuple('TaxInfo', 'nacionalfederal, importadosfederal, estadual,'
                      'fonte, chave')
 
+# Increase this when the format of the compiled tables change
+_TABLE_VERSION = 1
+
+# The table of the state of the current branch, see get_taxes_table
+_taxes_table = None
+
 
-def load_taxes_csv():
+def _fill_taxes_database(conn, csv_filename):
     """ Load the fields of IBPT table.
 
     - Fields:
@@ -61,34 +73,152 @@ def load_taxes_csv():
         - versao: Versão das alíquotas usadas para cálculo.
         - Fonte: Fonte
     """
+    conn.execute("""
+        CREATE TABLE taxes (
+            ncm TEXT, ex TEXT, nacionalfederal TEXT, importadosfederal TEXT,
+            estadual TEXT, fonte TEXT, chave TEXT,
+            PRIMARY KEY (ncm, ex)
+        ) WITHOUT ROWID""")
 
-    # Avoid load taxes more than once.
-    if taxes_data:
-        return
+    def get_rows():
+        with open(csv_filename, "r", encoding='latin1') as f:
+            for (ncm, ex, tipo, descricao, nacionalfederal, importadosfederal,
+                 estadual, municipal, vigenciainicio, vigenciafim, chave,
+                 versao, fonte) in csv.reader(f, delimiter=';'):
+                # Ignore the header and the service codes
+                # (NBS - Nomenclatura Brasileira de Serviços)
+                if ncm == 'codigo' or tipo == '1':
+                    continue
+                yield (ncm, ex, nacionalfederal, importadosfederal,
+                       estadual, fonte, chave)
 
-    store = new_store()
-    branch = get_current_branch(store)
-    address = branch.person.get_main_address()
-    state = address.city_location.state
+    conn.executemany("INSERT OR REPLACE INTO taxes VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     get_rows())
+    conn.commit()
 
-    filename = environ.get_resource_filename('stoq', 'csv', 'ibpt_tables',
-                                             'TabelaIBPTax%s.csv' % state)
-    csv_file = (csv.reader(open(filename, "r", encoding='latin1'), delimiter=';'))
 
-    for (ncm, ex, tipo, descricao, nacionalfederal, importadosfederal,
-         estadual, municipal, vigenciainicio, vigenciafim, chave,
-         versao, fonte) in csv_file:
-        # Ignore service codes (NBS - Nomenclatura Brasileira de Serviços)
-        if tipo == '1':
-            continue
-        tax_dict = taxes_data.setdefault(ncm, {})
-        tax_dict[ex] = TaxInfo(nacionalfederal, importadosfederal, estadual,
-                               fonte, chave)
+def build_taxes_table(csv_filename, filename):
+    """Compile an IBPT csv table into a sqlite database
+
+    This can be called at install time, the tables are compiled by
+    :class:`TaxesTable` on first use otherwise.
+
+    :param csv_filename: the ``TabelaIBPTax<UF>.csv`` filename
+    :param filename: the filename of the database to create
+    """
+    tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+    conn = sqlite3.connect(tmp_filename)
+    try:
+        _fill_taxes_database(conn, csv_filename)
+    except Exception:
+        conn.close()
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+    conn.close()
+    os.replace(tmp_filename, filename)
+
+
+class TaxesTable(object):
+    """The IBPT taxes of a state, looked up by the NCM
+
+    Instead of parsing the csv table of the state, which has tens of
+    thousands of rows, on every process, it is compiled to a sqlite
+    database in the application directory the first time it is used
+    (and again when the csv file changes). After that, we just need to
+    open it and look up the NCMs of the items being sold.
+    """
+
+    def __init__(self, csv_filename):
+        self._csv_filename = csv_filename
+        self._conn = None
+        self._options = {}
+        self._lock = threading.Lock()
+
+    #
+    #  Public API
+    #
+
+    def get_options(self, ncm):
+        """Get the taxes of a NCM
+
+        :param ncm: the NCM code
+        :returns: a dict mapping the EX codes of the NCM to their
+          :class:`TaxInfo`, which will be empty if the NCM is not
+          in the table
+        """
+        with self._lock:
+            options = self._options.get(ncm)
+            if options is None:
+                if self._conn is None:
+                    self._conn = self._connect()
+                rows = self._conn.execute(
+                    "SELECT ex, nacionalfederal, importadosfederal, "
+                    "       estadual, fonte, chave "
+                    "FROM taxes WHERE ncm = ?", (ncm, ))
+                options = dict((row[0], TaxInfo(*row[1:])) for row in rows)
+                self._options[ncm] = options
+            return options
+
+    #
+    #  Private
+    #
+
+    def _connect(self):
+        name = os.path.splitext(os.path.basename(self._csv_filename))[0]
+        directory = os.path.join(get_application_dir(), 'ibpt')
+        stat = os.stat(self._csv_filename)
+        filename = os.path.join(directory, '%s-%d-%d-%d.sqlite' % (
+            name, _TABLE_VERSION, stat.st_mtime, stat.st_size))
+
+        if not os.path.exists(filename):
+            try:
+                os.makedirs(directory, exist_ok=True)
+                build_taxes_table(self._csv_filename, filename)
+            except (OSError, sqlite3.Error) as e:
+                log.warning("Could not compile the IBPT table %s: %s" % (
+                    self._csv_filename, e))
+                conn = sqlite3.connect(':memory:', check_same_thread=False)
+                _fill_taxes_database(conn, self._csv_filename)
+                return conn
+
+            # Remove the tables compiled from older csv files
+            for old_filename in glob.glob(
+                    os.path.join(directory, '%s-*.sqlite' % (name, ))):
+                if old_filename == filename:
+                    continue
+                # Another process may have compiled the table and removed
+                # the old ones at the same time
+                try:
+                    os.remove(old_filename)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    log.warning("Could not remove the IBPT table %s: %s" % (
+                        old_filename, e))
+
+        return sqlite3.connect(filename, check_same_thread=False)
+
+
+def get_taxes_table():
+    """Get the IBPT taxes table of the state of the current branch
+
+    :returns: a :class:`TaxesTable`
+    """
+    global _taxes_table
+    if _taxes_table is None:
+        branch = get_current_branch(get_default_store())
+        address = branch.person.get_main_address()
+        state = address.city_location.state
+        filename = environ.get_resource_filename(
+            'stoq', 'csv', 'ibpt_tables', 'TabelaIBPTax%s.csv' % state)
+        _taxes_table = TaxesTable(filename)
+    return _taxes_table
 
 
 class IBPTGenerator(object):
     def __init__(self, items, include_services=False):
-        load_taxes_csv()
+        self.taxes_table = get_taxes_table()
         self.items = items
         self.include_services = include_services
 
@@ -103,18 +233,19 @@ class IBPTGenerator(object):
         sellable = item.sellable
         product = sellable.product
         service = sellable.service
-        delivery = sysparam.get_object(item.store, 'DELIVERY_SERVICE').sellable
         if product:
             code = product.ncm or ''
             ex_tipi = self._format_ex(product.ex_tipi)
         else:
-            if not self.include_services or sellable == delivery:
+            is_delivery = (sellable.id ==
+                           sysparam.get_object_id('DELIVERY_SERVICE'))
+            if not self.include_services or is_delivery:
                 return
 
             code = '%04d' % int(service.service_list_item_code.replace('.', ''))
             ex_tipi = ''
 
-        options = taxes_data.get(code, {})
+        options = self.taxes_table.get_options(code)
         n_options = len(options)
         if n_options == 0:
             tax_values = TaxInfo('0', '0', '0', '', '0')
@@ -27,11 +27,13 @@ import collections
 from decimal import Decimal
 from uuid import uuid4
 import logging
+import time
 
 from kiwi.datatypes import ValidationError
 from kiwi.python import namedAny
 from stoqdrivers.enum import TaxType
 
+from stoqlib.database.listener import DatabaseListener
 from stoqlib.database.runtime import get_default_store
 from stoqlib.domain.parameter import ParameterData
 from stoqlib.enums import (LatePaymentPolicy, ReturnPolicy,
@@ -91,6 +93,7 @@ class ParameterDetails(object):
         self.allow_none = allow_none
         self.is_editable = is_editable
         self.check_missing = check_missing
+        self._parameter_type = None
 
     #
     #  Public API
@@ -98,7 +101,9 @@ class ParameterDetails(object):
 
     def get_parameter_type(self):
         if isinstance(self.type, str):
-            return namedAny('stoqlib.domain.' + self.type)
+            if self._parameter_type is None:
+                self._parameter_type = namedAny('stoqlib.domain.' + self.type)
+            return self._parameter_type
         else:
             return self.type
 
@@ -916,6 +921,17 @@ _details = [
         bool,
         initial=True),
 
+    ParameterDetails(
+        u'ESTIMATE_SEARCH_SUMMARY',
+        _(u'Smart lists'),
+        _(u'Estimate the search summary'),
+        _(u'When loading items intelligently from the database, show an '
+          u'estimate of the number of items found right away and compute '
+          u'the exact count and totals in the background. This makes '
+          u'searches on really large tables faster.'),
+        bool,
+        initial=False),
+
     ParameterDetails(
         u'LOCAL_BRANCH',
         _(u'General'),
@@ -1089,8 +1105,18 @@ _details = [
 class ParameterAccess(object):
     """
     API for accessing and updating system parameters
+
+    The values are loaded from the database once and cached, already
+    converted to their types (the object parameters are cached as their
+    ids). The cache is cleared when the :class:`DatabaseListener
+    <stoqlib.database.listener.DatabaseListener>` tells us that a
+    parameter was changed, possibly by another station.
     """
 
+    #: The minimum interval, in seconds, between checking for
+    #: notifications about changed parameters
+    POLL_INTERVAL = 1
+
     def __init__(self):
         # Mapping of details, name -> ParameterDetail
         self._details = collections.OrderedDict()
@@ -1098,11 +1124,21 @@ class ParameterAccess(object):
             self.register_param(detail)
 
         self._values_cache = None
+        # Mapping of converted values, (name, expected type) -> value
+        self._typed_values = {}
+        self._listening = False
+        self._last_poll = None
 
     # Lazy Mapping of database raw database values, name -> database value
     @property
     def _values(self):
+        if self._values_cache is not None:
+            self._poll()
         if self._values_cache is None:
+            if not self._listening:
+                DatabaseListener.get_instance().subscribe(
+                    self._on_notification)
+                self._listening = True
             self._values_cache = dict(
                 (p.field_name, p.field_value)
                 for p in get_default_store().find(ParameterData))
@@ -1237,6 +1273,7 @@ class ParameterAccess(object):
                              field_value=value,
                              is_editable=detail.is_editable)
         self._values[param_name] = data.field_value
+        self._clear_typed_values(param_name)
         return data.field_value
 
     def _remove_unused_parameters(self, store):
@@ -1250,6 +1287,27 @@ class ParameterAccess(object):
                                    field_name=param_name).one()
                 store.remove(param)
 
+    def _clear_typed_values(self, param_name):
+        for key in list(self._typed_values):
+            if key[0] == param_name:
+                del self._typed_values[key]
+
+    def _poll(self):
+        # Process the notifications that arrived since the last time we
+        # were called. Without them (e.g. when the database can't be
+        # reached), the values are only loaded again by clear_cache.
+        # The parameters are read a lot, so don't do that on every access
+        now = time.monotonic()
+        if (self._last_poll is not None and
+                now - self._last_poll < self.POLL_INTERVAL):
+            return
+        self._last_poll = now
+        DatabaseListener.get_instance().poll()
+
+    def _on_notification(self, channel, te_id, table_name):
+        if table_name in ['', ParameterData.__storm_table__]:
+            self.clear_cache()
+
     #
     # Public API
     #
@@ -1260,6 +1318,7 @@ class ParameterAccess(object):
     def clear_cache(self):
         """Clears the internal cache so it can be rebuilt on next access"""
         self._values_cache = None
+        self._typed_values.clear()
 
     def ensure_system_parameters(self, store, update=False):
         """
@@ -1277,8 +1336,24 @@ class ParameterAccess(object):
         self._create_default_values(store)
 
     def get(self, param_name, expected_type=None, store=None):
+        values = self._values
+        key = (param_name, expected_type)
+        try:
+            value = self._typed_values[key]
+        except KeyError:
+            value = self._get_typed_value(param_name, expected_type, values)
+            self._typed_values[key] = value
+
+        if isinstance(expected_type, str) and value is not None:
+            detail = self._details[param_name]
+            return store.get(detail.get_parameter_type(), value)
+        return value
+
+    def _get_typed_value(self, param_name, expected_type, values):
+        # Converts the database value of the parameter to expected_type.
+        # The object parameters are converted to their ids
         detail = self._verify_detail(param_name, expected_type)
-        value = self._values.get(param_name)
+        value = values.get(param_name)
         if value is None:
             # This parameter should be created on read and not on edit.
             if param_name == 'USER_HASH':
@@ -1298,8 +1373,7 @@ class ParameterAccess(object):
             except ValueError:
                 return expected_type(detail.initial)
         elif isinstance(expected_type, str):
-            field_type = detail.get_parameter_type()
-            return store.get(field_type, str(value))
+            return str(value)
 
         return value
 
@@ -1413,6 +1487,7 @@ class ParameterAccess(object):
         param.field_value = value
         param.is_editable = detail.is_editable
         self._values[param_name] = value
+        self._clear_typed_values(param_name)
 
     def get_object(self, store, param_name):
         """
@@ -1483,6 +1558,7 @@ class ParameterAccess(object):
             threadit(lambda: p.check_running() and p.call('restart'))
 
         self._values[param_name] = value
+        self._clear_typed_values(param_name)
 
     def get_details(self):
         return list(self._details.values())
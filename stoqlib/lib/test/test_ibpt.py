@@ -23,11 +23,18 @@
 ##
 
 from decimal import Decimal
+import os
+import shutil
+import sqlite3
+import tempfile
+
+import mock
 
 from stoqlib.database.runtime import get_current_branch
 from stoqlib.domain.taxes import ProductTaxTemplate, ProductIcmsTemplate
 from stoqlib.domain.test.domaintest import DomainTest
-from stoqlib.lib.ibpt import IBPTGenerator, generate_ibpt_message
+from stoqlib.lib.ibpt import (IBPTGenerator, TaxesTable, build_taxes_table,
+                              generate_ibpt_message, get_taxes_table)
 
 
 class TestCalculateTaxForItem(DomainTest):
@@ -162,3 +169,58 @@ class TestCalculateTaxForItem(DomainTest):
         expected_federal_tax = total_item * (Decimal("21.45") / 100)
         federal = generator._calculate_federal_tax(sale_item, tax_values)
         self.assertEqual(federal, expected_federal_tax)
+
+
+class TestTaxesTable(DomainTest):
+    def setUp(self):
+        super(TestTaxesTable, self).setUp()
+        self.app_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.app_dir)
+
+    def test_get_options(self):
+        filename = get_taxes_table()._csv_filename
+        table = TaxesTable(filename)
+        with mock.patch('stoqlib.lib.ibpt.get_application_dir',
+                        return_value=self.app_dir):
+            options = table.get_options(u'01012100')
+        self.assertEqual(list(options), [''])
+        self.assertEqual(options[''].nacionalfederal, '4.20')
+        self.assertEqual(options[''].estadual, '18.00')
+        self.assertEqual(table.get_options(u'99999999'), {})
+        # The header is not a NCM
+        self.assertEqual(table.get_options(u'codigo'), {})
+
+        # The compiled table is used by the next processes
+        compiled = os.listdir(os.path.join(self.app_dir, 'ibpt'))
+        self.assertEqual(len(compiled), 1)
+        table = TaxesTable(filename)
+        with mock.patch('stoqlib.lib.ibpt.build_taxes_table') as build:
+            with mock.patch('stoqlib.lib.ibpt.get_application_dir',
+                            return_value=self.app_dir):
+                options = table.get_options(u'01012100')
+        self.assertEqual(build.call_count, 0)
+        self.assertEqual(options[''].estadual, '18.00')
+
+    def test_build_taxes_table_error(self):
+        filename = os.path.join(self.app_dir, 'table.sqlite')
+        with mock.patch('stoqlib.lib.ibpt._fill_taxes_database',
+                        side_effect=sqlite3.Error):
+            with self.assertRaises(sqlite3.Error):
+                build_taxes_table(u'TabelaIBPTaxSP.csv', filename)
+        self.assertEqual(os.listdir(self.app_dir), [])
+
+    def test_remove_old_tables(self):
+        filename = get_taxes_table()._csv_filename
+        directory = os.path.join(self.app_dir, 'ibpt')
+        os.makedirs(directory)
+        name = os.path.splitext(os.path.basename(filename))[0]
+        old_filename = os.path.join(directory, '%s-old.sqlite' % (name, ))
+        open(old_filename, 'w').close()
+
+        table = TaxesTable(filename)
+        # Another process removed the old table at the same time
+        with mock.patch('os.remove', side_effect=FileNotFoundError):
+            with mock.patch('stoqlib.lib.ibpt.get_application_dir',
+                            return_value=self.app_dir):
+                options = table.get_options(u'01012100')
+        self.assertEqual(options[''].estadual, '18.00')
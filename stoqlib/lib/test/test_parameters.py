@@ -25,6 +25,8 @@
 
 from decimal import Decimal
 
+import mock
+
 from stoqlib.lib.parameters import sysparam
 from stoqlib.domain.address import CityLocation
 from stoqlib.domain.person import (Branch, Client, Company, Employee,
@@ -222,3 +224,45 @@ class TestParameter(DomainTest):
     def test_default_label_columns(self):
         param = self.sparam.get_string('LABEL_COLUMNS')
         self.assertEqual(param, 'code,barcode,description,price')
+
+    def test_typed_values(self):
+        self.sparam.set_int(self.store, 'MAX_SEARCH_RESULTS', 500)
+        self.assertEqual(self.sparam.get_int('MAX_SEARCH_RESULTS'), 500)
+        self.assertEqual(
+            self.sparam._typed_values[('MAX_SEARCH_RESULTS', int)], 500)
+
+        # Setting the value should not leave an outdated value behind
+        self.sparam.set_int(self.store, 'MAX_SEARCH_RESULTS', 600)
+        self.assertEqual(self.sparam.get_int('MAX_SEARCH_RESULTS'), 600)
+
+        # The object parameters are cached as their ids
+        service = self.sparam.get_object(self.store, 'DELIVERY_SERVICE')
+        self.assertEqual(
+            self.sparam._typed_values[('DELIVERY_SERVICE', 'service.Service')],
+            service.id)
+        self.assertIs(self.sparam.get_object(self.store, 'DELIVERY_SERVICE'),
+                      service)
+
+    def test_on_notification(self):
+        self.sparam.get_bool('POS_FULL_SCREEN')
+        self.sparam._on_notification('update_te', 1, 'sellable')
+        self.assertNotEqual(self.sparam._typed_values, {})
+
+        self.sparam._on_notification('update_te', 1, 'parameter_data')
+        self.assertEqual(self.sparam._typed_values, {})
+        self.assertIsNone(self.sparam._values_cache)
+
+    def test_poll_interval(self):
+        self.sparam.get_bool('POS_FULL_SCREEN')
+        self.sparam._last_poll = None
+        with mock.patch('stoqlib.lib.parameters.DatabaseListener') as listener:
+            with mock.patch('stoqlib.lib.parameters.time.monotonic') as monotonic:
+                monotonic.return_value = 100
+                self.sparam.get_bool('POS_FULL_SCREEN')
+                self.sparam.get_bool('POS_FULL_SCREEN')
+                self.assertEqual(listener.get_instance().poll.call_count, 1)
+
+                # The notifications are checked again after the interval
+                monotonic.return_value = 100 + self.sparam.POLL_INTERVAL
+                self.sparam.get_bool('POS_FULL_SCREEN')
+                self.assertEqual(listener.get_instance().poll.call_count, 2)